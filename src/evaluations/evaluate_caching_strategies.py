@@ -1,37 +1,66 @@
 """
 To run this script:
 docker compose up -d
-DISABLE_AUTO_CACHE=TRUE REDIS_HOST=localhost python -m src.evaluations.evaluate_caching_strategies
+DISABLE_AUTO_CACHE=TRUE REDIS_HOST=localhost python -m src.evaluations.evaluate_caching_strategies [--batch] [--verifier-thresholds 0.3 0.5 0.7] [--replay logs/llm_queries.jsonl]
 
 Notes:
 * The DISABLE_AUTO_CACHE environment variable must be set to "TRUE" before running the script otherwise the evaluations won't be independent.
 * The REDIS_HOST environment variable helps access the redis instance from outside the docker container so the script can be run locally.
+* The aggregated results report each strategy's average cache lookup time (hit or miss) alongside its hit accuracy.
+* With --batch, each strategy is evaluated with a single `/api/query/batch` call instead of one `/api/query` call per test query.
+  The response time of each query is then the time until its result was ready within the batch.
+* With --verifier-thresholds, the vector_embedding strategy is also evaluated with the cross-encoder verifier enabled (see
+  `verifier.py`) at each of the thresholds, to compare their hit accuracy and lookup time.
+* With --replay, the test queries are the requests of a query log (see `query_log.py`) instead of test_queries.csv. They
+  have no expected answers, so only the response time, cost and lookup time are reported.
 """
 
+import argparse
 import pandas as pd
 import time
 import os
 import asyncio
-from src.server import handle_query, QueryRequest
-from src.utils.redis_client import redis_client
+from src.server import handle_query, handle_query_batch, QueryRequest, QueryResponse, BatchQueryRequest
+from src.utils.redis_client import redis_client, redis_binary_client, close_redis_client
+from src.utils.cache_response import calculate_TTL, cache_writer
+from src.utils.get_embeddings import embed_batch
+from src.utils.vector_cache import vector_cache
+from src.utils.fuzzy_cache import fuzzy_cache
+from src.utils.local_cache import local_cache
+from src.utils.cache_entry import CacheEntry, encode_entry
+from src.utils.cache_key import cache_key
+from src.utils.cost_model import calculate_cost
+from src.utils.query_log import read_query_log
 import tracemalloc
 
 tracemalloc.start() # Used to check for memory leaks
 
-async def main():
+async def main(use_batch: bool = False, verifier_thresholds: list[float] | None = None, replay: str | None = None):
     await initialise_cache()
 
-    # Read test queries with proper handling of empty strings
-    test_df = pd.read_csv(
-        "src/evaluations/test_queries.csv",
-        keep_default_na=True,
-        na_values=['']
-    )
+    if replay:
+        test_df = pd.DataFrame({"QueryText": read_query_log(replay)})
+    else:
+        # Read test queries with proper handling of empty strings
+        test_df = pd.read_csv(
+            "src/evaluations/test_queries.csv",
+            keep_default_na=True,
+            na_values=['']
+        )
 
     # Test different caching strategies
-    strategies = ["exact_match_only", "no_cache"]
+    strategies = ["exact_match_only", "fuzzy", "vector_embedding", "hybrid", "no_cache"]
     for strategy in strategies:
-        await evaluate_strategy(strategy, test_df)
+        await evaluate_strategy(strategy, test_df, use_batch)
+
+    # The same semantic lookups, with the verifier deciding which candidates are hits
+    for threshold in verifier_thresholds or []:
+        os.environ["VERIFIER"] = "TRUE"
+        os.environ["VERIFIER_THRESHOLD"] = str(threshold)
+        label = f"vector_embedding+verifier@{threshold}"
+        await evaluate_strategy("vector_embedding", test_df, use_batch, label)
+        strategies.append(label)
+    os.environ.pop("VERIFIER", None)
               
     # Save results with proper handling of empty values
     test_df.to_csv(
@@ -41,33 +70,66 @@ async def main():
     )
         
     await save_aggregated_results(test_df, strategies)
+    await cache_writer.close()
+    await vector_cache.close()
+    await fuzzy_cache.close()
+    await close_redis_client()
 
 async def initialise_cache():
-    redis_client.flushdb()
+    await redis_client.flushdb()
+    local_cache.clear()
     print("Flushed the db")
     
     past_queries = pd.read_csv("src/evaluations/past_queries.csv")
-    for index, row in past_queries.iterrows():
-        redis_client.set(row['QueryText'], row['ResponseText'])
+    # Send all the writes in a single round-trip
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for index, row in past_queries.iterrows():
+            pipe.set(cache_key(row['QueryText']), encode_entry(CacheEntry(row['ResponseText'], row['QueryText'])))
+        await pipe.execute()
+
+    # Seed the semantic and fuzzy caches too, skipping the queries that mustn't be cached (a TTL of 0 would expire them at once)
+    cacheable = [
+        (query, response, ttl)
+        for query, response in zip(past_queries['QueryText'], past_queries['ResponseText'])
+        if (ttl := calculate_TTL(query)) > 0
+    ]
+    # Embedding all the past queries in one batch
+    vector_cache.clear()
+    embeddings = await asyncio.to_thread(embed_batch, [query for query, _, _ in cacheable])
+    await vector_cache.add_many([
+        (query, response, embedding, ttl)
+        for (query, response, ttl), embedding in zip(cacheable, embeddings)
+    ])
+
+    # And the fuzzy cache, which indexes the canonical queries as they're written
+    fuzzy_cache.clear()
+    await fuzzy_cache.add_many([(query, CacheEntry(response, query), ttl) for query, response, ttl in cacheable])
 
     print("Cached all queries.")
 
-async def evaluate_strategy(strategy: str, test_queries: pd.DataFrame) -> pd.DataFrame:
-    print(f"\n## Testing strategy: {strategy}")
+async def evaluate_strategy(strategy: str, test_queries: pd.DataFrame, use_batch: bool = False, label: str | None = None) -> pd.DataFrame:
+    """Evaluates a caching strategy, storing the results in columns prefixed by `label` (defaults to the strategy name)."""
     os.environ["CACHING_STRATEGY"] = strategy
+    strategy = label or strategy
+    print(f"\n## Testing strategy: {strategy}")
     test_queries[strategy + '_response_time'] = 0.0
     test_queries[strategy + '_cost'] = 0.0
     test_queries[strategy + '_cache_hit_correctly'] = False
+    test_queries[strategy + '_cache_lookup_time'] = 0.0
 
-    # Process all queries concurrently
-    tasks = [process_query(index, row) for index, row in test_queries.iterrows()]
-    results = await asyncio.gather(*tasks)
+    if use_batch:
+        results = await process_batch(test_queries)
+    else:
+        # Process all queries concurrently
+        tasks = [process_query(index, row) for index, row in test_queries.iterrows()]
+        results = await asyncio.gather(*tasks)
     
     # Update the dataframe with results
-    for index, response_time, cost, cache_hit_correctly in results:
+    for index, response_time, cost, cache_hit_correctly, cache_lookup_time in results:
         test_queries.at[index, strategy + '_response_time'] = response_time
         test_queries.at[index, strategy + '_cost'] = cost
         test_queries.at[index, strategy + '_cache_hit_correctly'] = cache_hit_correctly
+        test_queries.at[index, strategy + '_cache_lookup_time'] = cache_lookup_time
     
     return test_queries
 
@@ -77,54 +139,64 @@ async def save_aggregated_results(test_results: pd.DataFrame, strategies: list[s
         # Calculate summary statistics for this strategy
         avg_response_time = test_results[strategy + '_response_time'].mean()
         avg_cost = test_results[strategy + '_cost'].mean()
-        avg_accuracy = test_results[strategy + '_cache_hit_correctly'].mean()
+        # Replayed queries have no expected answers to score the hits against
+        if "ExpectedCacheHit" in test_results:
+            accuracy = f"{test_results[strategy + '_cache_hit_correctly'].mean():.2%}"
+        else:
+            accuracy = "n/a"
+        avg_lookup_time = test_results[strategy + '_cache_lookup_time'].mean()
         
         # Create markdown content
         markdown_content += f"""
 ## Strategy: {strategy}
 - Average response time: {avg_response_time:.4f} seconds
 - Average cost per query: ${avg_cost:.6f}
-- Average cache hit accuracy: {avg_accuracy:.2%}
+- Average cache hit accuracy: {accuracy}
+- Average cache lookup time: {avg_lookup_time * 1000:.3f} ms
 
 """ 
     # Write to file
     with open("src/evaluations/test_results_aggregated.md", "w") as f:
         f.write(markdown_content)
 
-async def process_query(index: int, row: pd.Series) -> tuple[int, float, float, bool]:
+async def process_query(index: int, row: pd.Series) -> tuple[int, float, float, bool, float]:
     print(f"Handling test query {index}")
     queryText = row["QueryText"]
-    expected_cache_hit = row["ExpectedCacheHit"]
     
     start_time = time.time()
     response = await handle_query(QueryRequest(query=queryText))
     end_time = time.time()
     
-    response_time = end_time - start_time
+    return score_response(index, row, response, end_time - start_time)
+
+async def process_batch(test_queries: pd.DataFrame) -> list[tuple[int, float, float, bool, float]]:
+    print(f"Handling {len(test_queries)} test queries in one batch")
+    batch = await handle_query_batch(BatchQueryRequest(queries=[QueryRequest(query=row["QueryText"]) for _, row in test_queries.iterrows()]))
+    return [
+        score_response(index, row, response, response.metadata.timing['total'])
+        for (index, row), response in zip(test_queries.iterrows(), batch.results)
+    ]
+
+def score_response(index: int, row: pd.Series, response: QueryResponse, response_time: float) -> tuple[int, float, float, bool, float]:
+    queryText = row["QueryText"]
+    expected_cache_hit = row.get("ExpectedCacheHit")
     cost = calculate_cost(queryText, response.response, response.metadata.source)
     
-    if expected_cache_hit == "": # if we don't expect cache hit
-        cache_hit_correctly: bool = (response.metadata.source == 'llm')
+    if "ExpectedCacheHit" not in row: # replayed query, nothing to score against
+        cache_hit_correctly = False
+    elif expected_cache_hit == "": # if we don't expect cache hit
+        cache_hit_correctly: bool = (response.metadata.source in ('llm', 'coalesced'))
     else: # we expect cache hit
         cache_hit_correctly: bool = (response.response == expected_cache_hit)
         
-    return index, response_time, cost, cache_hit_correctly
-
-def calculate_cost(queryText: str, responseText: str, source: str) -> float:
-    """Calculate the cost of a request based on its source and query length."""
-    match source:
-      case "cache":
-        return 0.0 # Cache hits are free
-      case "llm":
-        # This is just a rough estimate. For some reason, OpenAI api doesn't simply return the cost per request, so doing the actual computation is complicated; but this rough estimate is good enough for our purposes.
-        
-        # Assuming that 1 token ~= 4 characters & no cached tokens & GPT4o is used.
-        input_tokens = len(queryText) / 4
-        output_tokens = len(responseText) / 4
-        return (input_tokens * 2.5 + output_tokens * 10) / 1_000_000
-      case _:
-        print(f"Warning: unsupported response source: {source}")
-        return 0.0
+    # Time spent looking up the cache, whether it hit or not (0 for no_cache)
+    cache_lookup_time = response.metadata.timing.get('cache_lookup', 0.0)
+    return index, response_time, cost, cache_hit_correctly, cache_lookup_time
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", action="store_true", help="Send each strategy's test queries as one batch request")
+    parser.add_argument("--verifier-thresholds", type=float, nargs="+", help="Also evaluate vector_embedding with the verifier at these thresholds")
+    parser.add_argument("--replay", help="JSONL query log to take the test queries from, instead of test_queries.csv")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch, args.verifier_thresholds, args.replay))
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""
+Measures how many bytes a cache entry takes with each compression setting of the entry format (see `cache_entry.py`),
+compared with the legacy format where the value was the plain response string.
+
+To run this script:
+python -m src.evaluations.measure_cache_entry_size [--dictionary-out cache_dictionary.bin]
+
+Notes:
+* The new entries also hold the query, model and token counts, which the legacy values didn't.
+* A dictionary trained on the same entries it compresses is optimistic, so the dictionaries are also evaluated on held-out
+  entries (2-fold: trained on one half, measured on the other).
+* With --dictionary-out, a dictionary trained on all of past_queries.csv is written out, to be used with CACHE_COMPRESSION_DICTIONARY.
+  The dictionary bundled with the cache (`src/utils/cache_dictionary.bin`) was written this way.
+"""
+import argparse
+import pandas as pd
+from src.utils.cache_entry import CacheEntry, CompressionDictionary, EntryCodec, train_dictionary, zstandard
+
+MODEL = "gpt-4o"
+
+def load_entries() -> list[CacheEntry]:
+    past_queries = pd.read_csv("src/evaluations/past_queries.csv")
+    return [
+        # Token counts estimated at ~4 characters per token, as in the evaluation's cost estimate
+        CacheEntry(response, query, model=MODEL, input_tokens=len(query) // 4, output_tokens=len(response) // 4)
+        for query, response in zip(past_queries["QueryText"], past_queries["ResponseText"])
+    ]
+
+def payload(entry: CacheEntry) -> bytes:
+    """What the codec compresses, and so what dictionaries are trained on."""
+    return (entry.model + entry.query + entry.response).encode()
+
+def mean_size(codec: EntryCodec, entries: list[CacheEntry]) -> float:
+    return sum(len(codec.encode(entry)) for entry in entries) / len(entries)
+
+def held_out_size(compression: str, entries: list[CacheEntry]) -> float:
+    half = len(entries) // 2
+    folds = [(entries[:half], entries[half:]), (entries[half:], entries[:half])]
+    total = 0.0
+    for train, test in folds:
+        dictionary = CompressionDictionary(train_dictionary([payload(entry) for entry in train], compression=compression))
+        total += mean_size(EntryCodec(compression, dictionary=dictionary), test) * len(test)
+    return total / len(entries)
+
+def main(args):
+    entries = load_entries()
+    legacy = sum(len(entry.response.encode()) for entry in entries) / len(entries)
+    print(f"{len(entries)} entries, legacy format (plain response string): {legacy:.1f} bytes/entry\n")
+    print(f"{'compression':<12} {'dictionary':<12} {'bytes/entry':>12} {'vs legacy':>10}")
+
+    compressions = ["none", "zlib"] + (["zstd"] if zstandard is not None else [])
+    for compression in compressions:
+        results = [("-", mean_size(EntryCodec(compression), entries))]
+        if compression != "none":
+            dictionary = CompressionDictionary(train_dictionary([payload(entry) for entry in entries], compression=compression))
+            results.append(("in-sample", mean_size(EntryCodec(compression, dictionary=dictionary), entries)))
+            results.append(("held-out", held_out_size(compression, entries)))
+        for dictionary_label, size in results:
+            print(f"{compression:<12} {dictionary_label:<12} {size:>12.1f} {size / legacy - 1:>+10.1%}")
+
+    if args.dictionary_out:
+        compression = "zstd" if zstandard is not None else "zlib"
+        with open(args.dictionary_out, "wb") as f:
+            f.write(train_dictionary([payload(entry) for entry in entries], compression=compression))
+        print(f"\nWrote a {compression} dictionary to {args.dictionary_out}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dictionary-out", help="Where to write a dictionary trained on all the past queries")
+    main(parser.parse_args())
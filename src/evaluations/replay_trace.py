@@ -0,0 +1,441 @@
+"""
+Replays a query trace against an in-memory model of the cache, to compare caching strategies and their settings offline:
+no redis and no LLM calls, and the configurations of a sweep are replayed in parallel in a process pool.
+
+To run this script:
+python -m src.evaluations.replay_trace [--trace logs/llm_queries.jsonl] [--strategies exact_match_only hybrid]
+    [--similarity-thresholds 0.8 0.85 0.9] [--fuzzy-thresholds 0.8] [--ttls policy 3600] [--cache-sizes 0 10000]
+
+Notes:
+* The trace is a CSV with a QueryText column, or JSONL: a query log (see `query_log.py`) or lines with a "query" field.
+  Optional columns (fields): Timestamp ("ts", unix seconds; otherwise requests are spaced 1/--qps apart), Group ("group":
+  queries that the same answer is right for), ResponseText ("response") and InputTokens/OutputTokens ("input_tokens"/
+  "output_tokens"). In a query log, the LLM call events give the token counts and latency of their query's misses.
+  Without --trace, the past queries then the test queries of this folder are replayed, grouped by the past query they
+  should hit (SourceQueryIndex).
+* Each strategy is modelled as the stages it looks up, as in `query_cache.py`: exact_match_only the exact query, fuzzy its
+  canonical query (see `fuzzy_cache.py`) then its trigram near-duplicates, vector_embedding the most similar cached query,
+  hybrid all of them in that order, and no_cache nothing. The L1 cache isn't modelled (it holds a subset of redis). Misses
+  are cached for their TTL (the policy of `ttl_policy.py`, or a fixed TTL), and with a cache size, the least recently used
+  entry is evicted once there are more entries than that.
+* Similarities are computed once for the whole sweep: the NEIGHBOURS nearest distinct queries of each distinct query of the
+  trace, by cosine similarity (NumPy matrix products of the normalized embeddings, a block of queries at a time) and by
+  trigram similarity for the fuzzy stage (searched in the process pool). A lookup hits the most similar of them that is cached and above the threshold,
+  so it can miss when more than NEIGHBOURS more similar queries aren't cached. --embeddings keeps the embeddings in a
+  .npy file, so that sweeps of the same trace don't embed it again.
+* A hit is false if the entry was cached for a query of another group or, without groups, with another response. Without
+  either, only exact hits are known to be right, and the false-hit rate isn't reported.
+* Costs are `calculate_cost` of the misses (hits are free), or `llm_cost` of their token counts when they're known.
+  Latencies are modelled as STAGE_LATENCY_MS for every stage looked up, plus the LLM latency of misses (the query log's
+  for that query if it has one, --llm-latency otherwise).
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from src.utils.cache_key import canonical_query
+from src.utils.clean_query import canonicalize_query
+from src.utils.cost_model import calculate_cost, llm_cost, estimate_tokens
+from src.utils.fuzzy_cache import differing_words_match
+from src.utils.query_log import query_hash
+from src.utils.trigram_index import TrigramIndex
+from src.utils import ttl_policy
+
+STRATEGY_STAGES = {
+    "exact_match_only": ["exact"],
+    "fuzzy": ["normalized", "lexical"],
+    "vector_embedding": ["semantic"],
+    "hybrid": ["exact", "normalized", "lexical", "semantic"],
+    "no_cache": [],
+}
+# Rough time of each lookup stage; the llm_cache_stage_seconds histograms of /metrics give the real ones
+STAGE_LATENCY_MS = {"exact": 1.0, "normalized": 1.5, "lexical": 2.5, "semantic": 15.0}
+NEIGHBOURS = 8
+SIMILARITY_BLOCK_BYTES = 256 * 1024 ** 2 # memory of a block of the similarity matrix
+
+@dataclass
+class Trace:
+    queries: list[str]
+    timestamps: np.ndarray # unix seconds, non-decreasing
+    groups: list | None = None # which answers are right for each request, to tell false hits apart
+    responses: list[str] | None = None
+    input_tokens: list[float | None] | None = None
+    output_tokens: list[float | None] | None = None
+    llm_latencies: dict[str, float] | None = None # query hash -> seconds, from the LLM call events of a query log
+
+@dataclass
+class ReplayModel:
+    """A trace prepared for replay: requests are ids of distinct queries, with everything a configuration needs precomputed."""
+    query_ids: np.ndarray # distinct query of each request
+    timestamps: np.ndarray
+    labels: list | None # of each request, None if false hits can't be told apart
+    canonical_ids: np.ndarray # canonical query (fuzzy stage) of each distinct query
+    policy_ttls: np.ndarray # TTL of each distinct query under the TTL policy
+    miss_costs: np.ndarray # dollars, of each distinct query
+    llm_latencies: np.ndarray # seconds, of each distinct query
+    lexical_neighbours: list[list[tuple[int, float]]] | None = None # of each canonical query: (canonical query, similarity), most similar first
+    semantic_neighbours: list[list[tuple[int, float]]] | None = None # of each distinct query: (distinct query, similarity), most similar first
+
+@dataclass(frozen=True)
+class ReplayConfig:
+    strategy: str
+    similarity_threshold: float | None = None
+    fuzzy_threshold: float | None = None
+    ttl: int | None = None # None for the TTL policy
+    cache_size: int = 0 # entries, 0 for unbounded
+
+def load_trace(path: str, qps: float = 10.0) -> Trace:
+    if path.endswith(".jsonl"):
+        rows, llm_calls = [], defaultdict(list)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("event") == "llm_call":
+                    llm_calls[record["query_hash"]].append(record)
+                elif record.get("event", "request") == "request" and record.get("query") is not None:
+                    rows.append(record)
+        # The token counts of a query's misses come from its LLM calls
+        usage = {digest: calls[-1] for digest, calls in llm_calls.items()}
+        tokens = [usage.get(row.get("query_hash") or query_hash(row["query"]), row) for row in rows]
+        trace = Trace(
+            queries=[row["query"] for row in rows],
+            timestamps=timestamps([row.get("ts") for row in rows], qps),
+            groups=[row.get("group") for row in rows] if any("group" in row for row in rows) else None,
+            responses=[row.get("response") for row in rows] if any("response" in row for row in rows) else None,
+            input_tokens=[record.get("input_tokens") for record in tokens],
+            output_tokens=[record.get("output_tokens") for record in tokens],
+            llm_latencies={digest: float(np.mean([call["latency"] for call in calls])) for digest, calls in llm_calls.items()},
+        )
+    else:
+        df = pd.read_csv(path, keep_default_na=False, na_values=[""])
+        column = lambda name: [None if pd.isna(value) else value for value in df[name]] if name in df else None
+        trace = Trace(
+            queries=df["QueryText"].tolist(),
+            timestamps=timestamps(column("Timestamp") or [None] * len(df), qps),
+            groups=column("Group"),
+            responses=column("ResponseText"),
+            input_tokens=column("InputTokens"),
+            output_tokens=column("OutputTokens"),
+        )
+    return trace
+
+def timestamps(values: list[float | None], qps: float) -> np.ndarray:
+    """The timestamps of the requests, or 1/qps apart if they don't have any."""
+    if values and all(value is not None for value in values):
+        return np.asarray(values, dtype=np.float64)
+    return np.arange(len(values), dtype=np.float64) / qps
+
+def evaluation_trace(qps: float = 10.0) -> Trace:
+    """The past queries, then the test queries, labelled with the past query each test query should hit (if any)."""
+    past = pd.read_csv("src/evaluations/past_queries.csv")
+    test = pd.read_csv("src/evaluations/test_queries.csv", keep_default_na=False)
+    groups = past["Index"].tolist() + [
+        int(source) if expected != "" else f"test-{i}"
+        for i, (source, expected) in enumerate(zip(test["SourceQueryIndex"], test["ExpectedCacheHit"]))
+    ]
+    queries = past["QueryText"].tolist() + test["QueryText"].tolist()
+    return Trace(queries=queries, timestamps=timestamps([None] * len(queries), qps), groups=groups)
+
+def lexical_neighbours(canonicals: list[str], threshold: float, k: int = NEIGHBOURS, workers: int | None = None) -> list[list[tuple[int, float]]]:
+    """
+    The near-duplicates of each canonical query that the fuzzy stage would accept, above `threshold`. The searches are
+    spread over `workers` processes (one per CPU by default), each with its own copy of the index.
+    """
+    workers = min(workers or os.cpu_count() or 1, max(1, len(canonicals) // 1000))
+    if workers == 1:
+        _init_lexical_worker(canonicals, threshold, k)
+        return _search_lexical((0, len(canonicals)))
+    chunk = -(-len(canonicals) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_lexical_worker, initargs=(canonicals, threshold, k)) as pool:
+        chunks = pool.map(_search_lexical, [(start, min(start + chunk, len(canonicals))) for start in range(0, len(canonicals), chunk)])
+        return [neighbours for chunk_neighbours in chunks for neighbours in chunk_neighbours]
+
+_lexical_search: tuple[TrigramIndex, list[str], dict[str, int], float, int] | None = None # of each worker process
+
+def _init_lexical_worker(canonicals: list[str], threshold: float, k: int) -> None:
+    global _lexical_search
+    index = TrigramIndex()
+    for canonical in canonicals:
+        index.add(canonical)
+    _lexical_search = (index, canonicals, {canonical: i for i, canonical in enumerate(canonicals)}, threshold, k)
+
+def _search_lexical(bounds: tuple[int, int]) -> list[list[tuple[int, float]]]:
+    index, canonicals, ids, threshold, k = _lexical_search
+    return [
+        [
+            (ids[candidate], similarity) for candidate, similarity in index.search(canonical, threshold, k=k + 1)
+            if candidate != canonical and differing_words_match(canonical, candidate)
+        ][:k]
+        for canonical in canonicals[bounds[0]:bounds[1]]
+    ]
+
+def semantic_neighbours(embeddings: np.ndarray, threshold: float, k: int = NEIGHBOURS) -> list[list[tuple[int, float]]]:
+    """
+    The `k` most similar other rows of each row of `embeddings` (unit-normalized), above `threshold`. The similarity matrix
+    is computed a block of rows at a time, so that memory stays bounded.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n = len(embeddings)
+    k = min(k, n - 1)
+    neighbours = []
+    if k <= 0:
+        return [[] for _ in range(n)]
+    block = max(1, SIMILARITY_BLOCK_BYTES // (4 * n))
+    for start in range(0, n, block):
+        similarities = embeddings[start:start + block] @ embeddings.T
+        rows = np.arange(len(similarities))
+        similarities[rows, rows + start] = -np.inf # not its own neighbour
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1)
+        top, top_similarities = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_similarities, order, axis=1)
+        for ids, values in zip(top.tolist(), top_similarities.tolist()):
+            neighbours.append([(i, value) for i, value in zip(ids, values) if value >= threshold])
+    return neighbours
+
+def embed_queries(queries: list[str], path: str | None = None, batch_size: int = 1024) -> np.ndarray:
+    """Embeds the distinct queries of a trace, or loads their embeddings from `path` if it was saved for the same queries."""
+    if path and os.path.exists(path):
+        embeddings = np.load(path)
+        if len(embeddings) == len(queries):
+            return embeddings
+        print(f"{path} has {len(embeddings)} embeddings for {len(queries)} queries, embedding them again")
+    from src.utils.get_embeddings import embed_batch
+    embeddings = np.concatenate([embed_batch(queries[start:start + batch_size]) for start in range(0, len(queries), batch_size)])
+    if path:
+        np.save(path, embeddings)
+    return embeddings
+
+def prepare(
+    trace: Trace,
+    strategies: list[str],
+    min_similarity: float,
+    min_fuzzy_similarity: float,
+    embeddings: np.ndarray | str | None = None,
+    llm_latency: float = 2.0,
+    default_output_tokens: float = 500,
+    workers: int | None = None,
+) -> ReplayModel:
+    """
+    Precomputes what replaying the trace needs for `strategies`, for thresholds down to `min_similarity` (semantic) and
+    `min_fuzzy_similarity` (lexical). `embeddings` are those of the distinct queries, in order of first appearance, or a
+    .npy file to keep them in.
+    """
+    ids: dict[str, int] = {}
+    query_ids = np.fromiter((ids.setdefault(canonical_query(query), len(ids)) for query in trace.queries), dtype=np.int64, count=len(trace.queries))
+    first = np.unique(query_ids, return_index=True)[1]
+    distinct = [trace.queries[i] for i in first]
+
+    canonical_index: dict[str, int] = {}
+    stem = os.getenv("FUZZY_STEMMING") == "TRUE"
+    canonical_ids = np.array([canonical_index.setdefault(canonicalize_query(query, stem), len(canonical_index)) for query in distinct], dtype=np.int64)
+
+    # Labels tell whether a hit was right: groups, or else the responses
+    labels = trace.groups if trace.groups is not None else trace.responses
+    if labels is not None and all(label is None for label in labels):
+        labels = None
+
+    miss_costs = np.empty(len(distinct))
+    latencies = np.full(len(distinct), llm_latency)
+    for distinct_id, i in enumerate(first):
+        query = trace.queries[i]
+        input_tokens = trace.input_tokens[i] if trace.input_tokens else None
+        output_tokens = trace.output_tokens[i] if trace.output_tokens else None
+        response = trace.responses[i] if trace.responses else None
+        if output_tokens is not None:
+            miss_costs[distinct_id] = llm_cost(input_tokens if input_tokens is not None else estimate_tokens(query), output_tokens)
+        elif response is not None:
+            miss_costs[distinct_id] = calculate_cost(query, response, "llm")
+        else:
+            miss_costs[distinct_id] = llm_cost(estimate_tokens(query), default_output_tokens)
+        if trace.llm_latencies:
+            latencies[distinct_id] = trace.llm_latencies.get(query_hash(query), llm_latency)
+
+    stages = {stage for strategy in strategies for stage in STRATEGY_STAGES[strategy]}
+    model = ReplayModel(
+        query_ids=query_ids,
+        timestamps=trace.timestamps,
+        labels=labels,
+        canonical_ids=canonical_ids,
+        policy_ttls=np.array([ttl_policy.ttl_policy.ttl(query) for query in distinct], dtype=np.int64),
+        miss_costs=miss_costs,
+        llm_latencies=latencies,
+    )
+    if "lexical" in stages:
+        model.lexical_neighbours = lexical_neighbours(list(canonical_index), min_fuzzy_similarity, workers=workers)
+    if "semantic" in stages:
+        if embeddings is None or isinstance(embeddings, str):
+            embeddings = embed_queries(distinct, embeddings)
+        if len(embeddings) != len(distinct):
+            raise ValueError(f"Expected the embeddings of {len(distinct)} distinct queries, got {len(embeddings)}")
+        model.semantic_neighbours = semantic_neighbours(embeddings, min_similarity)
+    return model
+
+def replay(model: ReplayModel, config: ReplayConfig) -> dict:
+    """Replays the trace against a model of the cache with `config`'s settings."""
+    stages = STRATEGY_STAGES[config.strategy]
+    query_ids, timestamps = model.query_ids.tolist(), model.timestamps.tolist()
+    canonical_ids = model.canonical_ids.tolist()
+    ttls = model.policy_ttls.tolist() if config.ttl is None else [config.ttl] * len(canonical_ids)
+    labels = model.labels
+    stage_latencies = [STAGE_LATENCY_MS[stage] / 1000 for stage in stages]
+    lookup_latency = sum(stage_latencies)
+    llm_latencies, miss_costs = model.llm_latencies.tolist(), model.miss_costs.tolist()
+    cache_size = config.cache_size
+
+    cache: OrderedDict[int, tuple[float, object]] = OrderedDict() # distinct query -> (expiry, label), least recently used first
+    by_canonical: dict[int, int] = {} # canonical query -> the distinct query last cached for it
+    latencies = np.empty(len(query_ids))
+    stage_hits = dict.fromkeys(stages, 0)
+    hits = false_hits = 0
+    cost = 0.0
+
+    def cached(entry_id: int | None, now: float) -> bool:
+        entry = cache.get(entry_id)
+        if entry is None:
+            return False
+        if entry[0] <= now:
+            del cache[entry_id] # expired
+            return False
+        return True
+
+    for i, (query_id, now) in enumerate(zip(query_ids, timestamps)):
+        hit_id = None
+        latency = 0.0
+        for stage, stage_latency in zip(stages, stage_latencies):
+            latency += stage_latency
+            match stage:
+                case "exact":
+                    candidates = (query_id,)
+                case "normalized":
+                    candidates = (by_canonical.get(canonical_ids[query_id]),)
+                case "lexical":
+                    candidates = [
+                        by_canonical.get(canonical) for canonical, similarity in model.lexical_neighbours[canonical_ids[query_id]]
+                        if similarity >= config.fuzzy_threshold
+                    ]
+                case "semantic":
+                    candidates = [query_id] + [
+                        neighbour for neighbour, similarity in model.semantic_neighbours[query_id]
+                        if similarity >= config.similarity_threshold
+                    ]
+            hit_id = next((candidate for candidate in candidates if cached(candidate, now)), None)
+            if hit_id is not None:
+                stage_hits[stage] += 1
+                break
+
+        if hit_id is not None:
+            hits += 1
+            if labels is not None and cache[hit_id][1] != labels[i]:
+                false_hits += 1
+            if cache_size:
+                cache.move_to_end(hit_id)
+        else:
+            latency = lookup_latency + llm_latencies[query_id]
+            cost += miss_costs[query_id]
+            if stages and ttls[query_id] > 0:
+                cache[query_id] = (now + ttls[query_id], labels[i] if labels is not None else None)
+                cache.move_to_end(query_id)
+                by_canonical[canonical_ids[query_id]] = query_id
+                if cache_size and len(cache) > cache_size:
+                    cache.popitem(last=False)
+        latencies[i] = latency
+
+    requests = len(query_ids)
+    return {
+        "strategy": config.strategy,
+        "similarity_threshold": config.similarity_threshold,
+        "fuzzy_threshold": config.fuzzy_threshold,
+        "ttl": "policy" if config.ttl is None else config.ttl,
+        "cache_size": config.cache_size or "unbounded",
+        "hit_rate": hits / requests if requests else 0.0,
+        "false_hit_rate": (false_hits / hits if hits else 0.0) if labels is not None else None,
+        "cost": cost,
+        "mean_latency_ms": latencies.mean() * 1000 if requests else 0.0,
+        "p95_latency_ms": np.percentile(latencies, 95) * 1000 if requests else 0.0,
+        **{f"{stage}_hits": count for stage, count in stage_hits.items()},
+    }
+
+def sweep_configs(
+    strategies: list[str],
+    similarity_thresholds: list[float],
+    fuzzy_thresholds: list[float],
+    ttls: list[int | None],
+    cache_sizes: list[int],
+) -> list[ReplayConfig]:
+    """Every combination of the settings that apply to each strategy."""
+    configs = []
+    for strategy in strategies:
+        stages = STRATEGY_STAGES[strategy]
+        semantic = similarity_thresholds if "semantic" in stages else [None]
+        fuzzy = fuzzy_thresholds if "lexical" in stages else [None]
+        # Without a cache, TTLs and sizes don't matter
+        settings = itertools.product(ttls, cache_sizes) if stages else [(None, 0)]
+        configs += [
+            ReplayConfig(strategy, similarity, fuzzy_threshold, ttl, size)
+            for (ttl, size), similarity, fuzzy_threshold in itertools.product(settings, semantic, fuzzy)
+        ]
+    return configs
+
+_model: ReplayModel | None = None # of each worker process
+
+def _init_worker(model: ReplayModel) -> None:
+    global _model
+    _model = model
+
+def _replay_in_worker(config: ReplayConfig) -> dict:
+    return replay(_model, config)
+
+def sweep(model: ReplayModel, configs: list[ReplayConfig], workers: int | None = None) -> pd.DataFrame:
+    """Replays every configuration, in parallel across `workers` processes (one per CPU by default, none if 1)."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(configs) == 1:
+        return pd.DataFrame([replay(model, config) for config in configs])
+    # The model is sent to each worker once, rather than with every configuration
+    with ProcessPoolExecutor(max_workers=min(workers, len(configs)), initializer=_init_worker, initargs=(model,)) as pool:
+        return pd.DataFrame(list(pool.map(_replay_in_worker, configs)))
+
+def parse_ttl(value: str) -> int | None:
+    return None if value == "policy" else int(value)
+
+def main(args):
+    start = time.perf_counter()
+    trace = load_trace(args.trace, args.qps) if args.trace else evaluation_trace(args.qps)
+    model = prepare(
+        trace, args.strategies, min(args.similarity_thresholds), min(args.fuzzy_thresholds),
+        embeddings=args.embeddings, llm_latency=args.llm_latency, workers=args.workers,
+    )
+    prepared = time.perf_counter()
+    print(f"{len(trace.queries)} requests, {len(model.miss_costs)} distinct queries, prepared in {prepared - start:.1f}s")
+
+    configs = sweep_configs(args.strategies, args.similarity_thresholds, args.fuzzy_thresholds, args.ttls, args.cache_sizes)
+    results = sweep(model, configs, args.workers)
+    print(f"Replayed {len(configs)} configurations in {time.perf_counter() - prepared:.1f}s\n")
+    columns = ["strategy", "similarity_threshold", "fuzzy_threshold", "ttl", "cache_size", "hit_rate", "false_hit_rate", "cost", "mean_latency_ms", "p95_latency_ms"]
+    print(results[columns].to_string(index=False, na_rep="-", float_format=lambda value: f"{value:.4g}"))
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print(f"\nSaved the results to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a query trace against models of the caching strategies")
+    parser.add_argument("--trace", help="CSV or JSONL trace to replay; the evaluation queries are used otherwise")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGY_STAGES), default=list(STRATEGY_STAGES))
+    parser.add_argument("--similarity-thresholds", type=float, nargs="+", default=[float(os.getenv("SIMILARITY_THRESHOLD", "0.85"))])
+    parser.add_argument("--fuzzy-thresholds", type=float, nargs="+", default=[float(os.getenv("FUZZY_THRESHOLD", "0.8"))])
+    parser.add_argument("--ttls", type=parse_ttl, nargs="+", default=[None], help='TTLs in seconds, or "policy" for the TTL policy')
+    parser.add_argument("--cache-sizes", type=int, nargs="+", default=[0], help="maximum entries, 0 for unbounded")
+    parser.add_argument("--qps", type=float, default=10.0, help="request rate of traces without timestamps")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="seconds, for misses the trace has no LLM latency for")
+    parser.add_argument("--embeddings", help=".npy file to load the embeddings of the distinct queries from, or save them to")
+    parser.add_argument("--workers", type=int, help="processes, defaults to one per CPU")
+    parser.add_argument("--output", default="src/evaluations/replay_results.csv")
+    main(parser.parse_args())
@@ -0,0 +1,201 @@
+"""
+Replays a query log against caches of a fixed byte budget, to compare eviction policies by the LLM dollars they save:
+* LRU: evicts the least recently used entry
+* LFU: evicts the least frequently used entry (least recently used among ties)
+* GDSF: the cost-aware policy of `src/utils/eviction.py` (frequency * cost / size, aged by inflation), with its admission rule
+
+To run this script:
+python -m src.evaluations.simulate_eviction [--log queries.csv|queries.jsonl] [--budgets-mb 1 5 20]
+
+Notes:
+* The log is either a CSV with QueryText and ResponseText columns (like past_queries.csv), or JSONL with "query" and
+  "response" fields. Optional InputTokens/OutputTokens columns ("input_tokens"/"output_tokens" fields) give the real token
+  counts; otherwise they are estimated from the text, as in `cost_model.py`.
+* Without a log, a synthetic workload is generated: Zipf-distributed query popularity and heavy-tailed response lengths
+  (a few long, expensive answers among many short ones), independent of each other. With --churn, the popularity of that
+  fraction of the queries is reshuffled ten times over the log, like topics that trend and fade.
+* Entry sizes are the uncompressed query and response, plus a small per-entry overhead.
+"""
+import argparse
+import heapq
+import itertools
+import json
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from src.utils.cost_model import llm_cost, estimate_tokens
+from src.utils.eviction import priority
+
+ENTRY_OVERHEAD_BYTES = 64 # key, header and redis bookkeeping
+BYTES_PER_GB = 1024 ** 3
+
+@dataclass
+class Request:
+    key: str
+    size: int
+    cost: float
+
+class LRUCache:
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._entries: OrderedDict[str, int] = OrderedDict() # key -> size, least recently used first
+
+    def access(self, request: Request) -> bool:
+        if request.key in self._entries:
+            self._entries.move_to_end(request.key)
+            return True
+        if request.size <= self.budget:
+            self._entries[request.key] = request.size
+            self.used += request.size
+            while self.used > self.budget:
+                _, size = self._entries.popitem(last=False)
+                self.used -= size
+        return False
+
+class HeapCache(ABC):
+    """A cache that evicts the entry with the lowest priority, using a heap with lazy deletion."""
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._entries: dict[str, tuple[float, int, int]] = {} # key -> (priority, size, frequency)
+        self._heap: list[tuple[float, int, str]] = []
+        self._order = itertools.count() # breaks ties by least recent update
+
+    @abstractmethod
+    def priority(self, request: Request, frequency: int) -> float:
+        """The priority of the entry of `request` once it has been requested `frequency` times."""
+
+    def admit(self, request: Request) -> bool:
+        return request.size <= self.budget
+
+    def evicted(self, priority: float) -> None:
+        pass
+
+    def access(self, request: Request) -> bool:
+        entry = self._entries.get(request.key)
+        if entry is not None:
+            _, size, frequency = entry
+            self._set(request.key, self.priority(request, frequency + 1), size, frequency + 1)
+            return True
+        if self.admit(request):
+            self._set(request.key, self.priority(request, 1), request.size, 1)
+            self.used += request.size
+            while self.used > self.budget:
+                self._evict()
+        return False
+
+    def lowest_priority(self) -> float:
+        while self._heap:
+            priority, _, key = self._heap[0]
+            if key in self._entries and self._entries[key][0] == priority:
+                return priority
+            heapq.heappop(self._heap) # stale
+        return 0.0
+
+    def _set(self, key: str, priority: float, size: int, frequency: int) -> None:
+        self._entries[key] = (priority, size, frequency)
+        heapq.heappush(self._heap, (priority, next(self._order), key))
+
+    def _evict(self) -> None:
+        priority = self.lowest_priority()
+        _, _, key = heapq.heappop(self._heap)
+        _, size, _ = self._entries.pop(key)
+        self.used -= size
+        self.evicted(priority)
+
+class LFUCache(HeapCache):
+    def priority(self, request: Request, frequency: int) -> float:
+        return frequency
+
+class GDSFCache(HeapCache):
+    def __init__(self, budget: int):
+        super().__init__(budget)
+        self.inflation = 0.0
+
+    def priority(self, request: Request, frequency: int) -> float:
+        return priority(self.inflation, frequency, request.cost, request.size)
+
+    def admit(self, request: Request) -> bool:
+        # Same rule as `eviction.admit`: once full, only admit entries worth more than the least valuable one
+        if request.size > self.budget:
+            return False
+        return self.used + request.size <= self.budget or self.priority(request, 1) > self.lowest_priority()
+
+    def evicted(self, priority: float) -> None:
+        self.inflation = priority
+
+POLICIES = {"LRU": LRUCache, "LFU": LFUCache, "GDSF": GDSFCache}
+
+def load_log(path: str) -> list[Request]:
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        records = [(row["query"], row["response"], row.get("input_tokens"), row.get("output_tokens")) for row in rows]
+    else:
+        df = pd.read_csv(path)
+        records = list(zip(
+            df["QueryText"], df["ResponseText"],
+            df["InputTokens"] if "InputTokens" in df else [None] * len(df),
+            df["OutputTokens"] if "OutputTokens" in df else [None] * len(df),
+        ))
+    requests = []
+    for query, response, input_tokens, output_tokens in records:
+        input_tokens = input_tokens if input_tokens is not None else estimate_tokens(query)
+        output_tokens = output_tokens if output_tokens is not None else estimate_tokens(response)
+        size = len(query.encode()) + len(response.encode()) + ENTRY_OVERHEAD_BYTES
+        requests.append(Request(query, size, llm_cost(input_tokens, output_tokens)))
+    return requests
+
+def synthetic_log(distinct_queries: int, requests: int, zipf_exponent: float, churn: float = 0.0, phases: int = 10, seed: int = 0) -> list[Request]:
+    rng = np.random.default_rng(seed)
+    # Most answers are a few hundred tokens, some are thousands
+    output_tokens = np.clip(rng.lognormal(mean=5.5, sigma=1.0, size=distinct_queries), 20, 4000).astype(int)
+    input_tokens = rng.integers(10, 60, size=distinct_queries)
+    popularity = 1 / np.arange(1, distinct_queries + 1) ** zipf_exponent
+    popularity = rng.permutation(popularity) # independent of the answer length
+    queries = [
+        Request(f"query {i}", int(input_tokens[i] * 4 + output_tokens[i] * 4 + ENTRY_OVERHEAD_BYTES), llm_cost(input_tokens[i], output_tokens[i]))
+        for i in range(distinct_queries)
+    ]
+    log = []
+    for phase in range(phases):
+        if phase and churn:
+            reshuffled = rng.choice(distinct_queries, size=int(distinct_queries * churn), replace=False)
+            popularity[reshuffled] = rng.permutation(popularity[reshuffled])
+        phase_requests = requests // phases + (1 if phase < requests % phases else 0)
+        log += [queries[i] for i in rng.choice(distinct_queries, size=phase_requests, p=popularity / popularity.sum())]
+    return log
+
+def simulate(policy: str, budget: int, requests: list[Request]) -> dict:
+    cache = POLICIES[policy](budget)
+    hits, saved = 0, 0.0
+    for request in requests:
+        if cache.access(request):
+            hits += 1
+            saved += request.cost
+    return {"hit_rate": hits / len(requests), "dollars_saved": saved, "dollars_saved_per_gb": saved / (budget / BYTES_PER_GB)}
+
+def main(args):
+    requests = load_log(args.log) if args.log else synthetic_log(args.distinct_queries, args.requests, args.zipf_exponent, args.churn)
+    total_cost = sum(request.cost for request in requests)
+    working_set = sum({request.key: request.size for request in requests}.values())
+    print(f"{len(requests)} requests, {len({request.key for request in requests})} distinct queries, "
+          f"{working_set / 1024 ** 2:.1f}MB working set, ${total_cost:.2f} without a cache\n")
+    print(f"{'budget (MB)':>11} {'policy':>7} {'hit rate':>9} {'$ saved':>9} {'$ saved/GB':>11}")
+    for budget_mb in args.budgets_mb:
+        for policy in POLICIES:
+            result = simulate(policy, int(budget_mb * 1024 ** 2), requests)
+            print(f"{budget_mb:>11g} {policy:>7} {result['hit_rate']:>9.1%} {result['dollars_saved']:>9.2f} {result['dollars_saved_per_gb']:>11.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", help="CSV or JSONL query log to replay; a synthetic workload is used otherwise")
+    parser.add_argument("--budgets-mb", type=float, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--distinct-queries", type=int, default=50_000)
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--zipf-exponent", type=float, default=0.9)
+    parser.add_argument("--churn", type=float, default=0.0, help="fraction of the synthetic queries whose popularity changes over time")
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+"""
+Bulk loads historical (query, response) pairs into the cache, eg: to warm up the cache of a new region.
+
+To run this script:
+REDIS_HOST=localhost python -m src.scripts.bulk_load past_queries.csv [--strategy vector_embedding] [--embedding-workers 4]
+
+Notes:
+* The input is a CSV file with QueryText and ResponseText columns (like `src/evaluations/past_queries.csv`) or a JSONL file
+  with one {"QueryText": ..., "ResponseText": ...} object per line. --query-field and --response-field pick other names.
+  It is streamed in chunks of --chunk-size rows, so it never has to fit in memory.
+* Each chunk is written to the store(s) of the caching strategy (--strategy, defaults to CACHING_STRATEGY) in one redis
+  pipeline. Entries expire after `calculate_TTL` seconds like any other cache entry, and rows that shouldn't be cached
+  (too time-sensitive, or missing a query or response) are skipped.
+* For the vector_embedding and hybrid strategies, the embeddings of a chunk are computed in batches of --embedding-batch-size
+  by a pool of --embedding-workers processes (each loading the model once), while the previous chunk is being written.
+  The IVF centroids of the vector index are then trained offline on a sample of the embeddings and stored in redis, so that
+  workers start with a trained index (see `vector_cache.py`).
+* The number of input rows done is checkpointed after every chunk (to <input>.checkpoint by default), and a rerun resumes
+  from there. Use --restart to load the whole file again. After resuming, the centroids are only trained on the new rows.
+* The rows/sec achieved is printed after every chunk and at the end.
+"""
+
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+import numpy as np
+from src.utils.redis_client import redis_binary_client, close_redis_client
+from src.utils.cache_entry import CacheEntry, encode_entry
+from src.utils.cache_key import cache_key
+from src.utils.cache_response import calculate_TTL
+from src.utils.get_embeddings import embed_batch
+from src.utils.query_cache import strategy_stores
+from src.utils.fuzzy_cache import fuzzy_cache, queue_write as queue_fuzzy_write
+from src.utils.vector_cache import save_centroids, queue_write as queue_vector_write
+from src.utils.vector_index import train_centroids
+from src.utils import eviction, ttl_policy
+
+TRAIN_FACTOR = 16 # same as VectorIndex: the centroids are trained once there are nlist * TRAIN_FACTOR vectors
+
+def read_rows(path: str, file_format: str, query_field: str, response_field: str) -> Iterator[tuple[str | None, str | None]]:
+    """Yields the (query, response) of every row of the input file, one at a time."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "jsonl":
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row.get(query_field), row.get(response_field)
+        else:
+            for row in csv.DictReader(f):
+                yield row.get(query_field), row.get(response_field)
+
+def read_checkpoint(checkpoint_path: str, input_path: str) -> int:
+    """Returns the number of input rows already loaded, according to the checkpoint (0 if there's none for this input)."""
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return 0
+    return checkpoint["rows"] if checkpoint.get("input") == os.path.abspath(input_path) else 0
+
+def write_checkpoint(checkpoint_path: str, input_path: str, rows: int) -> None:
+    # Written to a temporary file first, so that a crash never leaves a truncated checkpoint behind
+    with open(f"{checkpoint_path}.tmp", "w") as f:
+        json.dump({"input": os.path.abspath(input_path), "rows": rows}, f)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+class Reservoir:
+    """A uniform random sample of up to `size` of the vectors added to it (reservoir sampling), to train the centroids on."""
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.seen = 0
+        self.vectors: np.ndarray | None = None
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, vectors: np.ndarray) -> None:
+        if self.vectors is None:
+            self.vectors = np.empty((self.size, vectors.shape[1]), dtype=np.float32)
+        positions = self.seen + np.arange(len(vectors)) # position of each vector in the stream
+        filling = positions < self.size
+        self.vectors[positions[filling]] = vectors[filling]
+        # Every later vector replaces a random one of the sample with probability size / (position + 1)
+        slots = self._rng.integers(0, positions[~filling] + 1)
+        replacing = slots < self.size
+        self.vectors[slots[replacing]] = vectors[~filling][replacing]
+        self.seen += len(vectors)
+
+    def sample(self) -> np.ndarray:
+        return self.vectors[:min(self.seen, self.size)]
+
+async def embed_queries(queries: list[str], pool: ProcessPoolExecutor | None, batch_size: int) -> np.ndarray:
+    """Embeds the queries in batches, spread over the process pool (or in a thread, without one)."""
+    if pool is None:
+        return await asyncio.to_thread(embed_batch, queries)
+    loop = asyncio.get_running_loop()
+    batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+    return np.concatenate(await asyncio.gather(*(loop.run_in_executor(pool, embed_batch, batch) for batch in batches)))
+
+async def write_chunk(entries: list[tuple[str, str, int]], embeddings: np.ndarray | None, stores: set[str]) -> None:
+    """Writes (query, response, ttl) entries to every store in one redis pipeline."""
+    stale_ttl = ttl_policy.stale_ttl()
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for i, (query, response, ttl) in enumerate(entries):
+            entry = CacheEntry(response, query)
+            if "exact" in stores:
+                key, value = cache_key(query), encode_entry(entry)
+                pipe.set(key, value, ex=ttl + stale_ttl)
+                if eviction.is_enabled():
+                    eviction.track(pipe, key, len(key) + len(value), eviction.entry_cost(query, response))
+            if "fuzzy" in stores:
+                queue_fuzzy_write(pipe, fuzzy_cache.canonicalize(query), entry, ttl)
+            if "vector" in stores:
+                queue_vector_write(pipe, query, entry, embeddings[i], ttl)
+        await pipe.execute()
+
+async def bulk_load(
+    path: str,
+    strategy: str,
+    chunk_size: int = 10_000,
+    embedding_workers: int = 0,
+    embedding_batch_size: int = 256,
+    checkpoint_path: str | None = None,
+    restart: bool = False,
+    file_format: str | None = None,
+    query_field: str = "QueryText",
+    response_field: str = "ResponseText",
+) -> dict:
+    """Loads the input file into the cache of the strategy. Returns the number of rows loaded and skipped, and the rows/sec."""
+    stores = strategy_stores(strategy)
+    file_format = file_format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    done = 0 if restart else read_checkpoint(checkpoint_path, path)
+    if done:
+        print(f"Resuming after row {done}")
+    rows = itertools.islice(read_rows(path, file_format, query_field, response_field), done, None)
+
+    embed = "vector" in stores
+    nlist = int(os.getenv("VECTOR_INDEX_NLIST", "1024"))
+    reservoir = Reservoir(nlist * TRAIN_FACTOR) if embed else None
+    # Spawned rather than forked, so that the workers don't inherit the event loop or the redis connections
+    pool = ProcessPoolExecutor(embedding_workers, mp_context=multiprocessing.get_context("spawn")) if embed and embedding_workers > 0 else None
+
+    async def prepare(chunk: list[tuple[str | None, str | None]]) -> tuple[int, list[tuple[str, str, int]], np.ndarray | None]:
+        entries = [(query, response, ttl) for query, response in chunk if query and response and (ttl := calculate_TTL(query)) > 0]
+        embeddings = await embed_queries([query for query, _, _ in entries], pool, embedding_batch_size) if embed and entries else None
+        return len(chunk), entries, embeddings
+
+    loaded = skipped = 0
+    start_time = time.perf_counter()
+    try:
+        pending = asyncio.create_task(prepare(list(itertools.islice(rows, chunk_size))))
+        while True:
+            size, entries, embeddings = await pending
+            if size == 0:
+                break
+            # The next chunk is read and embedded while this one is written
+            pending = asyncio.create_task(prepare(list(itertools.islice(rows, chunk_size))))
+            if entries and stores:
+                await write_chunk(entries, embeddings, stores)
+            if embeddings is not None:
+                reservoir.add(embeddings)
+            done += size
+            loaded += len(entries)
+            skipped += size - len(entries)
+            write_checkpoint(checkpoint_path, path, done)
+            print(f"Loaded {loaded} rows, skipped {skipped} ({loaded / (time.perf_counter() - start_time):.0f} rows/s)")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if reservoir is not None:
+        if reservoir.seen >= reservoir.size:
+            centroids = await asyncio.to_thread(train_centroids, reservoir.sample(), nlist)
+            await save_centroids(centroids)
+            print(f"Trained {len(centroids)} centroids on {len(reservoir.sample())} embeddings")
+        else:
+            print(f"Not enough embeddings to train {nlist} centroids: workers will search the vector index exactly")
+
+    elapsed = time.perf_counter() - start_time
+    rows_per_second = loaded / elapsed if elapsed > 0 else 0.0
+    print(f"Done: loaded {loaded} rows and skipped {skipped} in {elapsed:.1f}s ({rows_per_second:.0f} rows/s)")
+    return {"loaded": loaded, "skipped": skipped, "seconds": elapsed, "rows_per_second": rows_per_second}
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        await bulk_load(
+            args.input,
+            args.strategy,
+            chunk_size=args.chunk_size,
+            embedding_workers=args.embedding_workers,
+            embedding_batch_size=args.embedding_batch_size,
+            checkpoint_path=args.checkpoint,
+            restart=args.restart,
+            file_format=args.format,
+            query_field=args.query_field,
+            response_field=args.response_field,
+        )
+    finally:
+        await close_redis_client()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load (query, response) pairs into the cache")
+    parser.add_argument("input", help="CSV or JSONL file of (query, response) pairs")
+    parser.add_argument("--strategy", default=os.getenv("CACHING_STRATEGY", "exact_match_only"), help="Caching strategy whose stores are loaded")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Input format, guessed from the file extension by default")
+    parser.add_argument("--query-field", default="QueryText")
+    parser.add_argument("--response-field", default="ResponseText")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="Rows per redis pipeline")
+    parser.add_argument("--embedding-workers", type=int, default=os.cpu_count(), help="Embedding processes (0 embeds in a thread)")
+    parser.add_argument("--embedding-batch-size", type=int, default=256)
+    parser.add_argument("--checkpoint", help="Checkpoint file, defaults to <input>.checkpoint")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and load the whole file")
+    asyncio.run(main(parser.parse_args()))
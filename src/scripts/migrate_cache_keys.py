@@ -0,0 +1,185 @@
+"""
+Migrates cache entries to the hashed keys of a namespace (see `src/utils/cache_key.py`): the entries of the exact match
+cache, and those of the fuzzy and vector stores.
+
+To run this script:
+REDIS_HOST=localhost python -m src.scripts.migrate_cache_keys [--namespace default] [--from-namespace old] [--keep-old] [--dry-run]
+
+Notes:
+* By default, the entries that are still keyed on their raw query (written before keys were hashed) are migrated. For the
+  exact match cache, those are the string keys outside the prefixes the cache uses for everything else (INTERNAL_PREFIXES);
+  for the fuzzy and vector stores, the `fuzzy_cache:<canonical query>` and `vector_cache:<digest>` keys, without a namespace.
+  The TTL adjustments of their queries (see `ttl_policy.py`) are migrated too.
+* With --from-namespace, the entries of another namespace are copied instead, eg: to rename a namespace. Their keys are
+  derived again from the query stored in each entry, with the current LLM_MODEL.
+* Entries keep their remaining TTL, and never overwrite an entry that already exists under the new key. The old keys are
+  deleted unless --keep-old is passed; with cost-aware eviction, their bookkeeping is dropped by the next sweeps. Migrated
+  fuzzy and vector entries are appended to their store's changelog, so that running workers add them to their index.
+* Keys are scanned and migrated in batches of --batch-size, one pipeline each, so redis is never blocked for long.
+"""
+
+import argparse
+import asyncio
+from src.utils.redis_client import redis_binary_client, close_redis_client
+from src.utils.cache_entry import CacheEntry, encode_entry, decode_entry
+from src.utils.cache_key import cache_key, canonical_query, namespace, KEY_PREFIX
+from src.utils.ttl_policy import ADJUSTMENTS_KEY
+from src.utils import fuzzy_cache, vector_cache
+
+# Keys written by the other stores and components, never exact match entries
+INTERNAL_PREFIXES = (
+    KEY_PREFIX, "vector_cache:", "vector_index:", "vector_changelog", "fuzzy_cache:", "fuzzy_changelog", "embedding:",
+    "eviction:", "coalesce:", "refresh_lock:", ADJUSTMENTS_KEY,
+)
+
+# The prefix of each store's keys, followed by `<namespace>:<digest>`
+STORE_PREFIXES = {"exact": KEY_PREFIX, "fuzzy": fuzzy_cache.KEY_PREFIX, "vector": vector_cache.KEY_PREFIX}
+
+def legacy_store(key: str) -> str | None:
+    """The store of an entry keyed on its raw query (or digest), without a namespace, or None if the key isn't one."""
+    for store in ("fuzzy", "vector"):
+        if key.startswith(STORE_PREFIXES[store]):
+            return store if ":" not in key[len(STORE_PREFIXES[store]):] else None
+    return None if key.startswith(INTERNAL_PREFIXES) else "exact"
+
+def is_legacy_key(key: str) -> bool:
+    return legacy_store(key) == "exact"
+
+def plan_migration(store: str, key: str, value, target_namespace: str, legacy: bool) -> tuple[str, object, tuple | None] | None:
+    """
+    Returns the new key of an entry, the value to write there and the changelog message announcing it (stream,
+    fields and maximum length, if the store has a changelog), or None if the entry can't be migrated.
+    """
+    if store == "vector":
+        # The query is in the hash, and the id is derived from it
+        query = value.get(b"query")
+        if query is None or b"embedding" not in value:
+            return None
+        new_id = vector_cache.entry_id(query.decode(), target_namespace)
+        return f"{vector_cache.KEY_PREFIX}{new_id}", value, (vector_cache.CHANGELOG_STREAM, {"id": new_id}, vector_cache.CHANGELOG_MAX_LENGTH)
+
+    entry = decode_entry(value)
+    if entry is None:
+        return None
+    if store == "fuzzy":
+        if legacy:
+            canonical = key[len(fuzzy_cache.KEY_PREFIX):] # legacy keys are the canonical query itself
+        elif entry.query is not None:
+            canonical = fuzzy_cache.fuzzy_cache.canonicalize(entry.query)
+        else:
+            return None
+        new_key = fuzzy_cache.entry_key(canonical, target_namespace)
+        changelog_message = (fuzzy_cache.CHANGELOG_STREAM, {"key": canonical, "entry_key": new_key}, fuzzy_cache.CHANGELOG_MAX_LENGTH)
+        return new_key, value, changelog_message
+
+    if legacy:
+        # Legacy keys are the query itself; entries that say otherwise aren't exact match entries
+        if entry.query is not None and canonical_query(entry.query) != canonical_query(key):
+            return None
+        query = key
+    elif entry.query is None:
+        return None # can't derive the new key without the query
+    else:
+        query = entry.query
+    # The query is kept in the entry for collision checks
+    new_value = value if entry.query is not None else encode_entry(CacheEntry(entry.response, query))
+    return cache_key(query, target_namespace), new_value, None
+
+async def migrate_batch(
+    keys: list[tuple[bytes, str]], target_namespace: str, legacy: bool, keep_old: bool, dry_run: bool,
+) -> tuple[int, int]:
+    """Migrates a batch of (key, store) pairs. Returns how many entries were migrated and skipped."""
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for key, store in keys:
+            pipe.type(key)
+            if store == "vector":
+                pipe.hgetall(key)
+            else:
+                pipe.get(key)
+            pipe.pttl(key)
+        replies = await pipe.execute()
+
+    skipped = 0
+    planned = []
+    for (key, store), key_type, value, ttl_ms in zip(keys, replies[::3], replies[1::3], replies[2::3]):
+        expected_type = b"hash" if store == "vector" else b"string"
+        plan = plan_migration(store, key.decode(errors="replace"), value, target_namespace, legacy) if key_type == expected_type and value else None
+        if plan is None or plan[0] == key.decode(errors="replace"):
+            skipped += 1 # not an entry of the store, or already there
+            continue
+        planned.append((key, store, ttl_ms, *plan))
+    if dry_run or not planned:
+        return len(planned), skipped
+
+    # Entries never overwrite an entry that already exists under the new key
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for _, _, _, new_key, _, _ in planned:
+            pipe.exists(new_key)
+        existing = await pipe.execute()
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for (key, store, ttl_ms, new_key, value, changelog_message), exists in zip(planned, existing):
+            if not exists:
+                if store == "vector":
+                    pipe.hset(new_key, mapping=value)
+                    if ttl_ms > 0:
+                        pipe.pexpire(new_key, ttl_ms)
+                else:
+                    pipe.set(new_key, value, px=ttl_ms if ttl_ms > 0 else None, nx=True)
+                if changelog_message is not None:
+                    stream, fields, max_length = changelog_message
+                    pipe.xadd(stream, fields, maxlen=max_length, approximate=True)
+            if not keep_old:
+                pipe.delete(key)
+        await pipe.execute()
+    return len(planned), skipped
+
+async def migrate_adjustments(target_namespace: str, dry_run: bool) -> int:
+    """Re-keys the TTL adjustments of raw queries. Returns how many were migrated."""
+    adjustments = await redis_binary_client.hgetall(ADJUSTMENTS_KEY)
+    legacy = {field: factor for field, factor in adjustments.items() if not field.startswith(KEY_PREFIX.encode())}
+    if legacy and not dry_run:
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for field, factor in legacy.items():
+                pipe.hsetnx(ADJUSTMENTS_KEY, cache_key(field.decode(errors="replace"), target_namespace), factor)
+            pipe.hdel(ADJUSTMENTS_KEY, *legacy)
+            await pipe.execute()
+    return len(legacy)
+
+async def migrate(target_namespace: str, from_namespace: str | None = None, keep_old: bool = False, dry_run: bool = False, batch_size: int = 1000) -> dict:
+    legacy = from_namespace is None
+    # Legacy keys are found by scanning every key, the entries of a namespace by scanning each store's prefix
+    scans = [(None, None)] if legacy else [(f"{prefix}{from_namespace}:*", store) for store, prefix in STORE_PREFIXES.items()]
+    migrated = skipped = 0
+    batch: list[tuple[bytes, str]] = []
+    for match, scanned_store in scans:
+        async for key in redis_binary_client.scan_iter(match=match, count=batch_size):
+            store = legacy_store(key.decode(errors="replace")) if legacy else scanned_store
+            if store is None:
+                continue
+            batch.append((key, store))
+            if len(batch) >= batch_size:
+                counts = await migrate_batch(batch, target_namespace, legacy, keep_old, dry_run)
+                migrated, skipped = migrated + counts[0], skipped + counts[1]
+                batch = []
+                print(f"Migrated {migrated} entries, skipped {skipped}")
+    if batch:
+        counts = await migrate_batch(batch, target_namespace, legacy, keep_old, dry_run)
+        migrated, skipped = migrated + counts[0], skipped + counts[1]
+    adjustments = await migrate_adjustments(target_namespace, dry_run) if legacy else 0
+    print(f"Done: {'would migrate' if dry_run else 'migrated'} {migrated} entries and {adjustments} TTL adjustments to namespace {target_namespace!r}, skipped {skipped} keys")
+    return {"migrated": migrated, "skipped": skipped, "adjustments": adjustments}
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        await migrate(args.namespace, args.from_namespace, keep_old=args.keep_old, dry_run=args.dry_run, batch_size=args.batch_size)
+    finally:
+        await close_redis_client()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate cache entries to hashed, namespaced keys")
+    parser.add_argument("--namespace", default=namespace(), help="Namespace to migrate to, defaults to CACHE_NAMESPACE")
+    parser.add_argument("--from-namespace", help="Copy the entries of this namespace, instead of the raw query keys")
+    parser.add_argument("--keep-old", action="store_true", help="Don't delete the old keys")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the entries that would be migrated")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,41 @@
+"""
+Writes a snapshot of the semantic cache's vector index, for workers to open at startup instead of rebuilding the index
+from redis (see `src/utils/index_snapshot.py`).
+
+To run this script:
+REDIS_HOST=localhost VECTOR_INDEX_SNAPSHOT=snapshots/vector_index python -m src.scripts.snapshot_vector_index
+
+Notes:
+* If there is already a snapshot, the index is opened from it and caught up from the changelog, so only the entries
+  written since the last snapshot are read from redis. Run it periodically (eg: from cron) so that the changelog that
+  workers replay at startup stays short, and after a bulk load (see `bulk_load.py`).
+* The snapshot directory must be readable by the workers. Workers on the same host share the snapshot's pages.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from src.utils.redis_client import close_redis_client
+from src.utils.vector_cache import VectorCache
+
+async def main(directory: str) -> None:
+    cache = VectorCache()
+    try:
+        start_time = time.perf_counter()
+        path = await cache.save_snapshot(directory)
+        if path is None:
+            print("The vector cache is empty, no snapshot written")
+        else:
+            print(f"Wrote a snapshot of {len(cache.index)} entries to {path} in {time.perf_counter() - start_time:.1f}s")
+    finally:
+        await cache.close()
+        await close_redis_client()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot the vector index of the semantic cache")
+    parser.add_argument("--directory", default=os.getenv("VECTOR_INDEX_SNAPSHOT"), help="Snapshot directory, defaults to VECTOR_INDEX_SNAPSHOT")
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error("set VECTOR_INDEX_SNAPSHOT or pass --directory")
+    asyncio.run(main(args.directory))
@@ -1,22 +1,59 @@
+import asyncio
 import os
 from dotenv import load_dotenv
 import time
+import json
 
 # Load environment variables once at application startup; need to do this before importing any other modules
 load_dotenv()
 
-from fastapi import FastAPI, BackgroundTasks
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict
-from src.utils.query_llm import query_llm
-from src.utils.query_cache import query_cache
+from typing import Optional, Dict, List, AsyncIterator
+from src.utils.query_llm import query_llm, stream_llm
+from src.utils.query_cache import query_cache, query_cache_many, CacheHit
+from src.utils.coalesce_requests import coalesce
+from src.utils.redis_client import close_redis_client, pool_utilisation
+from src.utils.vector_cache import vector_cache
+from src.utils.fuzzy_cache import fuzzy_cache
+from src.utils.get_embeddings import get_batcher
+from src.utils.embedding_memo import embedding_memo
+from src.utils.local_cache import local_cache, stop_invalidation_listener
+from src.utils.cache_response import cache_writer
+from src.utils.upstream_scheduler import upstream_scheduler, INTERACTIVE, BACKGROUND
+from src.utils.eviction import stop_sweeper
+from src.utils.warm_up import warm_up
+from src.utils.refresh_ahead import refresher
+from src.utils.query_log import query_log
+from src.utils import verifier, metrics
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the local indexes and models of the caching strategy in the background, rather than on the first requests
+    warm_up.start()
+    yield
+    await warm_up.stop()
+    await refresher.close()
+    # Finish the queued cache writes before the redis connections are closed
+    await cache_writer.close(timeout=float(os.getenv("CACHE_WRITE_SHUTDOWN_TIMEOUT", "10")))
+    await stop_invalidation_listener()
+    await stop_sweeper()
+    await vector_cache.close()
+    await fuzzy_cache.close()
+    # Release the pooled redis connections when the worker shuts down
+    await close_redis_client()
+    # Write the queued query log records
+    await asyncio.to_thread(query_log.close)
 
 # Configure FastAPI app
 app = FastAPI(
     title="LLM Response Caching System",
     description="API for caching LLM responses",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 class QueryRequest(BaseModel):
@@ -24,17 +61,65 @@ class QueryRequest(BaseModel):
     forceRefresh: Optional[bool] = False
 
 class QueryMetadata(BaseModel):
-    source: str # "cache" or "llm"
+    source: str # "cache_l1" (in-process cache), "cache_l2" (redis), "llm" or "coalesced" (another concurrent request for the same query called the LLM)
     timing: Dict[str, float] # Added timing information
+    stage: Optional[str] = None # The stage of the hybrid caching strategy that answered, for cache hits
 
 class QueryResponse(BaseModel):
     response: str
     metadata: QueryMetadata
 
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+    stream: Optional[bool] = False # Return NDJSON lines as the results complete, rather than all the results at the end
+
+class BatchQueryResponse(BaseModel):
+    results: List[QueryResponse] # In the same order as the queries
+
+ERROR_RESPONSE = "An error occurred while processing your request. Please try again later."
+
 @app.get("/")
 def health_check():
     return {"status": "The server is working."}
 
+@app.get("/ready")
+def readiness_check():
+    """Whether this worker has finished warming up (see `warm_up.py`): 200 once it has, 503 until then."""
+    status = warm_up.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/api/stats")
+def get_stats():
+    """Internal counters and histograms of this worker process, useful for sizing and tuning."""
+    return {
+        "embedding_batcher": get_batcher().stats(),
+        "embedding_memo": embedding_memo.stats(),
+        "verifier": verifier.stats(),
+        "local_cache": local_cache.stats(),
+        "cache_writer": cache_writer.stats(),
+        "upstream": upstream_scheduler.stats(),
+        "refresh": refresher.stats(),
+        "query_log": query_log.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    """Prometheus metrics of this worker process (see `metrics.py`)."""
+    pool = pool_utilisation()
+    upstream = upstream_scheduler.stats()
+    gauges = [
+        ("llm_cache_redis_connections", "Redis connections of this worker, by state.", {"state": "in_use"}, pool["in_use"]),
+        ("llm_cache_redis_connections", "Redis connections of this worker, by state.", {"state": "max"}, pool["max"]),
+        ("llm_cache_upstream_queue_depth", "LLM calls waiting for the rate limiter.", {}, upstream["queue_depth"]),
+        ("llm_cache_upstream_in_flight", "LLM calls in flight.", {}, upstream["in_flight"]),
+        ("llm_cache_write_queue_depth", "Cache writes waiting to be written.", {}, cache_writer.queue_depth),
+        ("llm_cache_local_entries", "Entries in the in-process (L1) cache.", {}, len(local_cache)),
+        ("llm_cache_ready", "Whether this worker has finished warming up.", {}, int(warm_up.ready)),
+    ]
+    # The pool figures are left out if this version of redis-py doesn't let us read them
+    gauges = [gauge for gauge in gauges if gauge[3] is not None]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/query", response_model=QueryResponse)
 async def handle_query(request: QueryRequest) -> QueryResponse:
     timing = {}
@@ -43,34 +128,189 @@ async def handle_query(request: QueryRequest) -> QueryResponse:
     try:
         # Try cache first
         if not request.forceRefresh:
-            cache_start = time.time()
-            cache_response: str | None = await query_cache(request.query)
-            timing['cache_lookup'] = time.time() - cache_start
+            cache_start = time.perf_counter()
+            cache_hit: CacheHit | None = await query_cache(request.query, timing)
+            timing['cache_lookup'] = time.perf_counter() - cache_start
+            metrics.observe("cache_lookup", timing['cache_lookup'])
             
-            if cache_response is not None:
+            if cache_hit is not None:
                 timing['total'] = time.time() - timing['start_time']
+                metrics.record_request(request.query, cache_hit.response, cache_hit.source)
+                query_log.record_request(request.query, cache_hit.source, timing['total'], cache_hit.stage)
                 return QueryResponse(
-                    response=cache_response,
-                    metadata=QueryMetadata(source="cache", timing=timing)
+                    response=cache_hit.response,
+                    metadata=QueryMetadata(source=cache_hit.source, timing=timing, stage=cache_hit.stage)
                 )
         
-        # Query LLM otherwise
+        # Query LLM otherwise; concurrent misses for the same query share a single LLM call
         llm_start = time.time()
-        llm_response = await query_llm(request.query)
+        # forceRefresh calls aren't waited on by anyone else, so they yield to interactive calls when we're near the rate limits
+        priority = BACKGROUND if request.forceRefresh else INTERACTIVE
+        llm_response, is_leader = await coalesce(request.query, lambda: query_llm(request.query, timing, priority))
         timing['llm_query'] = time.time() - llm_start
         
         timing['total'] = time.time() - timing['start_time']
+        metrics.record_request(request.query, llm_response, "llm" if is_leader else "coalesced")
+        query_log.record_request(request.query, "llm" if is_leader else "coalesced", timing['total'], force_refresh=bool(request.forceRefresh))
         return QueryResponse(
             response=llm_response,
-            metadata=QueryMetadata(source="llm", timing=timing)
+            metadata=QueryMetadata(source="llm" if is_leader else "coalesced", timing=timing)
         )
         
     except Exception as e:
         # Log the error for debugging
         print(f"Error in handle_query: {e}")
         timing['total'] = time.time() - timing['start_time']
+        metrics.record_request(request.query, ERROR_RESPONSE, "error")
+        query_log.record_request(request.query, "error", timing['total'], force_refresh=bool(request.forceRefresh))
         return QueryResponse(
-            response="An error occurred while processing your request. Please try again later.",
+            response=ERROR_RESPONSE,
             metadata=QueryMetadata(source="error", timing=timing)
         )
+
+@app.post("/api/query/stream")
+async def handle_query_stream(request: QueryRequest) -> StreamingResponse:
+    """
+    Same as /api/query, but streams the response as server-sent events: one `data: {"delta": "..."}` event per chunk of
+    the response, then a final `event: done` event whose data is the QueryMetadata.
+    LLM responses are forwarded as they are generated and cached once complete; cached responses are sent in chunks.
+    """
+    return StreamingResponse(stream_query(request), media_type="text/event-stream")
+
+def sse_event(data: dict, event: str | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+async def chunk_text(text: str) -> AsyncIterator[str]:
+    chunk_size = int(os.getenv("STREAM_CHUNK_SIZE", "64"))
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+async def stream_query(request: QueryRequest) -> AsyncIterator[str]:
+    timing = {}
+    timing['start_time'] = time.time()
+    source = "llm"
+    stage = None
+    
+    try:
+        deltas = None
+        # Try cache first
+        if not request.forceRefresh:
+            cache_start = time.perf_counter()
+            cache_hit: CacheHit | None = await query_cache(request.query, timing)
+            timing['cache_lookup'] = time.perf_counter() - cache_start
+            metrics.observe("cache_lookup", timing['cache_lookup'])
+            if cache_hit is not None:
+                source, stage = cache_hit.source, cache_hit.stage
+                deltas = chunk_text(cache_hit.response)
+        
+        # Stream from the LLM otherwise
+        if deltas is None:
+            llm_start = time.time()
+            deltas = stream_llm(request.query, timing, BACKGROUND if request.forceRefresh else INTERACTIVE)
+        
+        async for delta in deltas:
+            if 'time_to_first_byte' not in timing:
+                timing['time_to_first_byte'] = time.time() - timing['start_time']
+            yield sse_event({"delta": delta})
+        
+        if source == "llm":
+            timing['llm_query'] = time.time() - llm_start
+    
+    except Exception as e:
+        # Log the error for debugging
+        print(f"Error in handle_query_stream: {e}")
+        source = "error"
+        yield sse_event({"message": ERROR_RESPONSE}, event="error")
+    
+    timing['total'] = time.time() - timing['start_time']
+    metrics.record_request(request.query, cache_hit.response if source.startswith("cache") else "", source)
+    query_log.record_request(request.query, source, timing['total'], stage, bool(request.forceRefresh))
+    yield sse_event(QueryMetadata(source=source, timing=timing, stage=stage).model_dump(), event="done")
+
+
+@app.post("/api/query/batch", response_model=None)
+async def handle_query_batch(request: BatchQueryRequest) -> BatchQueryResponse | StreamingResponse:
+    """
+    Resolves a list of queries in one request, for offline jobs. All the cache lookups are done at once (one redis
+    round-trip, or one batched embedding and similarity search), identical queries are only resolved once, and the misses
+    are sent to the LLM with at most BATCH_MAX_CONCURRENCY (defaults to 16) calls in flight per batch.
+    With `stream`, each result is sent as an NDJSON line (a QueryResponse plus its `index` in the batch) as soon as it is
+    ready, so results arrive out of order.
+    """
+    if request.stream:
+        return StreamingResponse(ndjson_lines(resolve_batch(request.queries)), media_type="application/x-ndjson")
+    results: list[QueryResponse | None] = [None] * len(request.queries)
+    async for index, response in resolve_batch(request.queries):
+        results[index] = response
+    return BatchQueryResponse(results=results)
+
+async def ndjson_lines(results: AsyncIterator[tuple[int, QueryResponse]]) -> AsyncIterator[str]:
+    async for index, response in results:
+        yield json.dumps({"index": index, **response.model_dump()}) + "\n"
+
+async def resolve_batch(requests: list[QueryRequest]) -> AsyncIterator[tuple[int, QueryResponse]]:
+    """Yields (position in the batch, response) pairs as they are resolved: cache hits first, then LLM calls as they finish."""
+    start_time = time.time()
+    # Identical requests are only resolved once; the first one is reported as the LLM call and the others as coalesced
+    positions: dict[tuple[str, bool], list[int]] = {}
+    for index, request in enumerate(requests):
+        positions.setdefault((request.query, bool(request.forceRefresh)), []).append(index)
+    
+    def responses(key: tuple[str, bool], response: str, source: str, timing: dict[str, float], stage: str | None = None) -> list[tuple[int, QueryResponse]]:
+        timing['total'] = time.time() - start_time
+        first, *duplicates = positions[key]
+        duplicate_source = "coalesced" if source == "llm" else source
+        metrics.record_request(key[0], response, source)
+        query_log.record_request(key[0], source, timing['total'], stage, key[1])
+        for _ in duplicates:
+            metrics.record_request(key[0], response, duplicate_source)
+            query_log.record_request(key[0], duplicate_source, timing['total'], stage, key[1])
+        return [(first, QueryResponse(response=response, metadata=QueryMetadata(source=source, timing=timing, stage=stage)))] + [
+            (index, QueryResponse(response=response, metadata=QueryMetadata(source=duplicate_source, timing=dict(timing), stage=stage)))
+            for index in duplicates
+        ]
+    
+    # Try the cache first, for every query at once
+    lookups = [query for query, force_refresh in positions if not force_refresh]
+    cache_start = time.perf_counter()
+    cache_timing = {} # time spent in each stage of the hybrid strategy, for the whole batch
+    try:
+        cache_hits = dict(zip(lookups, await query_cache_many(lookups, cache_timing)))
+    except Exception as e:
+        print(f"Error in handle_query_batch: {e}")
+        cache_hits = {}
+    cache_lookup = time.perf_counter() - cache_start
+    if lookups:
+        metrics.observe("cache_lookup", cache_lookup)
+    
+    misses = []
+    for key in positions:
+        query, force_refresh = key
+        cache_hit = cache_hits.get(query) if not force_refresh else None
+        if cache_hit is None:
+            misses.append(key)
+            continue
+        timing = {'start_time': start_time, 'cache_lookup': cache_lookup, **cache_timing}
+        for result in responses(key, cache_hit.response, cache_hit.source, timing, cache_hit.stage):
+            yield result
+    
+    # Query the LLM for the rest, with bounded concurrency. Batch jobs yield to interactive requests near the rate limits.
+    semaphore = asyncio.Semaphore(int(os.getenv("BATCH_MAX_CONCURRENCY", "16")))
+    async def resolve_miss(key: tuple[str, bool]) -> tuple[tuple[str, bool], str, str, dict[str, float]]:
+        query, force_refresh = key
+        timing = {'start_time': start_time} if force_refresh else {'start_time': start_time, 'cache_lookup': cache_lookup, **cache_timing}
+        async with semaphore:
+            llm_start = time.time()
+            try:
+                llm_response, is_leader = await coalesce(query, lambda: query_llm(query, timing, BACKGROUND))
+                response, source = llm_response, "llm" if is_leader else "coalesced"
+            except Exception as e:
+                print(f"Error in handle_query_batch: {e}")
+                response, source = ERROR_RESPONSE, "error"
+            timing['llm_query'] = time.time() - llm_start
+        return key, response, source, timing
     
+    for next_resolved in asyncio.as_completed([resolve_miss(key) for key in misses]):
+        for result in responses(*await next_resolved):
+            yield result
@@ -0,0 +1,52 @@
+import hashlib
+import os
+import numpy as np
+import pytest
+
+# The OpenAI client is created when src.utils.query_llm is imported; tests never call the real API
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from src.utils.clean_query import clean_query
+
+class StubEmbedder:
+    """
+    A deterministic, offline stand-in for a sentence-transformers model.
+    Each word of the cleaned text is hashed to a fixed random direction, so texts that share most of their words get
+    similar embeddings.
+    """
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+        self.calls: list[int] = [] # batch size of every encode call
+
+    def encode(self, texts: list[str], **kwargs) -> np.ndarray:
+        self.calls.append(len(texts))
+        return np.stack([self._embed(text) for text in texts])
+
+    def _embed(self, text: str) -> np.ndarray:
+        embedding = np.zeros(self.dim, dtype=np.float32)
+        for word in clean_query(text).split():
+            seed = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+            embedding += np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return embedding
+
+@pytest.fixture
+def stub_embedder(monkeypatch) -> StubEmbedder:
+    from src.utils import get_embeddings
+    embedder = StubEmbedder()
+    monkeypatch.setattr(get_embeddings, "_embedder", embedder)
+    return embedder
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Points every module that talks to redis at an in-memory fake redis server."""
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    binary_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=False)
+    from src.utils import cache_response, coalesce_requests, embedding_memo, eviction, fuzzy_cache, local_cache, query_cache, refresh_ahead, ttl_policy, vector_cache, warm_up
+    for module in (cache_response, coalesce_requests, embedding_memo, eviction, fuzzy_cache, local_cache, query_cache, refresh_ahead, ttl_policy, vector_cache, warm_up):
+        if hasattr(module, "redis_client"):
+            monkeypatch.setattr(module, "redis_client", client)
+        if hasattr(module, "redis_binary_client"):
+            monkeypatch.setattr(module, "redis_binary_client", binary_client)
+    return client
@@ -0,0 +1,74 @@
+import asyncio
+import json
+from fastapi.testclient import TestClient
+from src import server
+from src.utils.query_cache import query_cache_many, CacheHit
+from src.utils.cache_key import cache_key
+
+def use_fake_cache_and_llm(monkeypatch, cached: dict[str, str]) -> list[str]:
+    lookups = []
+    async def fake_query_cache_many(queries: list[str], timing: dict | None = None) -> list[CacheHit | None]:
+        lookups.append(queries)
+        return [CacheHit(cached[query], "cache_l2") if query in cached else None for query in queries]
+    monkeypatch.setattr(server, "query_cache_many", fake_query_cache_many)
+
+    llm_calls = []
+    async def fake_query_llm(query: str, timing: dict, priority: int) -> str:
+        llm_calls.append(query)
+        await asyncio.sleep(0.01)
+        return f"answer to {query}"
+    monkeypatch.setattr(server, "query_llm", fake_query_llm)
+    return lookups, llm_calls
+
+def test_batch_results_are_in_order_and_deduplicated(monkeypatch):
+    lookups, llm_calls = use_fake_cache_and_llm(monkeypatch, {"cached": "from the cache"})
+    queries = ["new", "cached", "new", "other", "cached"]
+
+    response = TestClient(server.app).post("/api/query/batch", json={"queries": [{"query": query} for query in queries]})
+    results = response.json()["results"]
+
+    assert [result["response"] for result in results] == [
+        "answer to new", "from the cache", "answer to new", "answer to other", "from the cache",
+    ]
+    assert [result["metadata"]["source"] for result in results] == ["llm", "cache_l2", "coalesced", "llm", "cache_l2"]
+    assert lookups == [["new", "cached", "other"]] # one lookup for the whole batch, without duplicates
+    assert sorted(llm_calls) == ["new", "other"]
+
+def test_force_refresh_skips_the_cache(monkeypatch):
+    lookups, llm_calls = use_fake_cache_and_llm(monkeypatch, {"cached": "from the cache"})
+
+    response = TestClient(server.app).post("/api/query/batch", json={"queries": [
+        {"query": "cached"}, {"query": "cached", "forceRefresh": True},
+    ]})
+
+    assert [result["metadata"]["source"] for result in response.json()["results"]] == ["cache_l2", "llm"]
+    assert lookups == [["cached"]] and llm_calls == ["cached"]
+
+def test_batch_streams_ndjson(monkeypatch):
+    use_fake_cache_and_llm(monkeypatch, {"cached": "from the cache"})
+
+    response = TestClient(server.app).post("/api/query/batch", json={
+        "queries": [{"query": "new"}, {"query": "cached"}],
+        "stream": True,
+    })
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    # Cache hits are sent before the LLM calls finish
+    assert [(line["index"], line["metadata"]["source"]) for line in lines] == [(1, "cache_l2"), (0, "llm")]
+
+def test_exact_match_lookups_share_one_round_trip(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    from src.utils import query_cache as query_cache_module
+    # The listener clears L1 once subscribed, and so keeps the reads in flight meanwhile out of it
+    monkeypatch.setattr(query_cache_module, "ensure_invalidation_listener", lambda: None)
+
+    async def run():
+        await fake_redis.set(cache_key("in redis"), "cached answer", ex=60)
+        first = await query_cache_many(["in redis", "missing"])
+        second = await query_cache_many(["in redis"])
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == [CacheHit("cached answer", "cache_l2"), None]
+    assert second == [CacheHit("cached answer", "cache_l1")]
@@ -0,0 +1,59 @@
+import asyncio
+import csv
+import json
+from src.scripts import bulk_load
+from src.utils.fuzzy_cache import FuzzyCache
+from src.utils.vector_cache import VectorCache
+from src.utils.cache_entry import decode_entry
+from src.utils.cache_key import cache_key
+
+def write_past_queries(path, count: int) -> list[str]:
+    queries = [f"What is the population of city number {i}?" for i in range(count)]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["QueryText", "ResponseText"])
+        writer.writerows((query, f"About {i} thousand people.") for i, query in enumerate(queries))
+        writer.writerow(["What time is it in Tokyo?", "9pm"]) # too time-sensitive to be cached
+        writer.writerow(["", "A response without a query"])
+    return queries
+
+def test_bulk_load_resumes_and_trains_the_vector_index(tmp_path, monkeypatch, fake_redis, stub_embedder):
+    from src.utils import vector_cache as vector_cache_module
+    binary_client = vector_cache_module.redis_binary_client # the fake one
+    monkeypatch.setattr(bulk_load, "redis_binary_client", binary_client)
+    monkeypatch.setenv("VECTOR_INDEX_NLIST", "2")
+    path = str(tmp_path / "past_queries.csv")
+    queries = write_past_queries(path, 60)
+    # A previous run got through the first 20 rows before stopping
+    bulk_load.write_checkpoint(f"{path}.checkpoint", path, 20)
+
+    async def run():
+        stats = await bulk_load.bulk_load(path, "hybrid", chunk_size=8)
+        vector, fuzzy = VectorCache(), FuzzyCache()
+        await vector.ensure_loaded()
+        await fuzzy.ensure_loaded()
+        loaded = {
+            "exact": [await fake_redis.exists(cache_key(query)) for query in queries],
+            "vector": len(vector.index),
+            "fuzzy": len(fuzzy.index),
+            "response": decode_entry(await binary_client.get(cache_key(queries[-1]))).response,
+        }
+        trained = vector.index.is_trained
+        await vector.close()
+        await fuzzy.close()
+        return stats, loaded, trained
+
+    stats, loaded, trained = asyncio.run(run())
+    assert (stats["loaded"], stats["skipped"]) == (40, 2)
+    assert loaded["exact"] == [0] * 20 + [1] * 40
+    assert loaded["vector"] == loaded["fuzzy"] == 40
+    assert loaded["response"] == "About 59 thousand people."
+    # The centroids trained by the loader are picked up by workers building their index
+    assert trained
+    with open(f"{path}.checkpoint") as f:
+        assert json.load(f)["rows"] == 62
+
+def test_read_rows_streams_jsonl(tmp_path):
+    path = tmp_path / "past_queries.jsonl"
+    path.write_text('{"QueryText": "What is 2+2?", "ResponseText": "4"}\n\n{"QueryText": "Who wrote Hamlet?", "ResponseText": "Shakespeare"}\n')
+    assert list(bulk_load.read_rows(str(path), "jsonl", "QueryText", "ResponseText")) == [("What is 2+2?", "4"), ("Who wrote Hamlet?", "Shakespeare")]
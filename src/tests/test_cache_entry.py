@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from src.utils.cache_entry import COMPRESSION_NONE, CacheEntry, CompressionDictionary, EntryCodec, create_codec, train_dictionary, zstandard
+
+COMPRESSIONS = ["none", "zlib"] + (["zstd"] if zstandard is not None else [])
+RESPONSE = "Photosynthesis is the process where plants use sunlight to convert carbon dioxide and water into glucose and oxygen. " * 3
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_entries_round_trip(compression):
+    codec = EntryCodec(compression)
+    entry = CacheEntry(
+        response=RESPONSE,
+        query="Explain photosynthesis",
+        created_at=1_700_000_000.0,
+        model="gpt-4o",
+        input_tokens=12,
+        output_tokens=345,
+        embedding=np.arange(8, dtype=np.float32),
+    )
+    encoded = codec.encode(entry)
+    decoded = codec.decode(encoded)
+
+    assert decoded.response == RESPONSE and decoded.query == entry.query
+    assert (decoded.created_at, decoded.model, decoded.input_tokens, decoded.output_tokens) == (1_700_000_000.0, "gpt-4o", 12, 345)
+    assert np.array_equal(decoded.embedding, entry.embedding)
+    if compression != "none":
+        assert len(encoded) < len(RESPONSE)
+
+def test_legacy_plain_strings_are_read():
+    codec = EntryCodec("zlib")
+    assert codec.decode("Paris").response == "Paris"
+    assert codec.decode("¿Cómo estás?".encode()).response == "¿Cómo estás?"
+    assert codec.decode(b"").response == ""
+
+@pytest.mark.parametrize("compression", [c for c in COMPRESSIONS if c != "none"])
+def test_dictionary_shrinks_short_entries(compression):
+    samples = [f"gpt-4oWhat's the current time in {city}?The current time in {city} is not something I can know.".encode() for city in
+               ["London", "Paris", "Tokyo", "Dubai", "Cairo", "Mumbai", "Sydney", "Moscow"]]
+    dictionary = CompressionDictionary(train_dictionary(samples, compression=compression))
+    entry = CacheEntry("The current time in Lima is not something I can know.", "What's the current time in Lima?", model="gpt-4o")
+
+    with_dictionary = EntryCodec(compression, dictionary=dictionary)
+    encoded = with_dictionary.encode(entry)
+    assert len(encoded) < len(EntryCodec(compression).encode(entry))
+    assert with_dictionary.decode(encoded).response == entry.response
+    # Readers without the dictionary treat the entry as a miss rather than returning garbage
+    assert EntryCodec(compression).decode(encoded) is None
+
+@pytest.mark.parametrize("compression", [c for c in COMPRESSIONS if c != "none"])
+def test_entries_that_dont_shrink_are_stored_uncompressed(compression):
+    entry = CacheEntry("Paris is the capital city of France.", "What is the capital of France?", model="gpt-4o")
+    encoded = EntryCodec(compression).encode(entry)
+
+    assert len(encoded) <= len(EntryCodec("none").encode(entry))
+    assert EntryCodec("none").decode(encoded).response == entry.response
+
+def test_the_bundled_dictionary_is_used_by_default(monkeypatch):
+    monkeypatch.delenv("CACHE_COMPRESSION", raising=False)
+    monkeypatch.delenv("CACHE_COMPRESSION_DICTIONARY", raising=False)
+    assert create_codec().dictionary is not None and create_codec().compression != COMPRESSION_NONE
+    # Without a dictionary, short answers don't compress: compression is opt-in
+    monkeypatch.setenv("CACHE_COMPRESSION_DICTIONARY", "none")
+    assert create_codec().dictionary is None and create_codec().compression == COMPRESSION_NONE
@@ -0,0 +1,116 @@
+import asyncio
+from src.scripts import migrate_cache_keys
+from src.utils.cache_entry import CacheEntry, encode_entry, decode_entry
+from src.utils.cache_key import cache_key
+from src.utils.local_cache import local_cache
+from src.utils.query_cache import query_exact_match
+from src.utils import ttl_policy
+
+def test_keys_are_fixed_size_and_depend_on_the_model_and_namespace(monkeypatch):
+    long_prompt = "Summarize this document: " + "lorem ipsum " * 1000
+    assert len(cache_key(long_prompt)) == len(cache_key("hi")) == len("cache:default:") + 32
+    assert cache_key("  What is DNS?\n") == cache_key("What is DNS?")
+
+    default = cache_key("What is DNS?")
+    monkeypatch.setenv("LLM_MODEL", "gpt-4.1")
+    upgraded_model = cache_key("What is DNS?")
+    monkeypatch.setenv("CACHE_NAMESPACE", "canary")
+    assert len({default, upgraded_model, cache_key("What is DNS?")}) == 3
+    assert cache_key("What is DNS?").startswith("cache:canary:")
+
+def test_an_entry_for_another_query_is_a_miss(fake_redis):
+    async def run():
+        local_cache.clear()
+        # As if "What is DNS?" collided with the key of "What is BGP?"
+        await fake_redis.set(cache_key("What is BGP?"), encode_entry(CacheEntry("Domain Name System", "What is DNS?")), ex=60)
+        return await query_exact_match("What is BGP?")
+
+    assert asyncio.run(run()) is None
+
+def test_raw_query_keys_are_migrated(monkeypatch, fake_redis):
+    from src.utils import query_cache as query_cache_module
+    binary_client = query_cache_module.redis_binary_client # the fake one
+    monkeypatch.setattr(migrate_cache_keys, "redis_binary_client", binary_client)
+
+    async def run():
+        await fake_redis.set("What is DNS?", encode_entry(CacheEntry("Domain Name System", "What is DNS?")), ex=600)
+        await fake_redis.set("What is BGP?", "Border Gateway Protocol") # a legacy plain string, without expiry
+        await fake_redis.set("eviction:bytes", "123")
+        await fake_redis.hset(ttl_policy.ADJUSTMENTS_KEY, "What is DNS?", "0.5")
+        stats = await migrate_cache_keys.migrate("default", batch_size=2)
+        local_cache.clear()
+        return (
+            stats,
+            sorted(await fake_redis.keys()),
+            await query_exact_match("What is DNS?"),
+            decode_entry(await binary_client.get(cache_key("What is BGP?"))),
+            await fake_redis.ttl(cache_key("What is DNS?")),
+            await ttl_policy.get_adjustments(["What is DNS?"]),
+        )
+
+    monkeypatch.setenv("TTL_ADAPTIVE", "TRUE")
+    stats, keys, dns, bgp, dns_ttl, adjustments = asyncio.run(run())
+    assert stats == {"migrated": 2, "skipped": 0, "adjustments": 1}
+    assert keys == sorted([cache_key("What is BGP?"), cache_key("What is DNS?"), "eviction:bytes", ttl_policy.ADJUSTMENTS_KEY])
+    assert dns.response == "Domain Name System"
+    assert bgp.response == "Border Gateway Protocol" and bgp.query == "What is BGP?"
+    assert 590 < dns_ttl <= 600
+    assert adjustments == [0.5]
+
+def test_every_store_is_keyed_on_the_namespaced_fingerprint(monkeypatch, fake_redis, stub_embedder):
+    from src.utils.fuzzy_cache import FuzzyCache
+    from src.utils.get_embeddings import embed_batch
+    from src.utils.vector_cache import VectorCache
+    embedding = embed_batch(["What is DNS?"])[0]
+
+    async def run():
+        fuzzy, vector = FuzzyCache(), VectorCache()
+        await fuzzy.add("What is DNS?", "Domain Name System", 60)
+        await vector.add("What is DNS?", "Domain Name System", embedding, 60)
+        keys = sorted(await fake_redis.keys("*_cache:*"))
+        await fuzzy.close()
+        await vector.close()
+
+        # Workers of another model start from empty stores, both when scanning redis and when following the changelogs
+        monkeypatch.setenv("LLM_MODEL", "gpt-4.1")
+        fuzzy, vector = FuzzyCache(), VectorCache()
+        upgraded = (await fuzzy.search("what is dns"), await vector.search(embedding, similarity_threshold=0.9))
+        await fuzzy.close()
+        await vector.close()
+        return keys, upgraded
+
+    keys, upgraded = asyncio.run(run())
+    assert [key.rsplit(":", 1)[0] for key in keys] == ["fuzzy_cache:default", "vector_cache:default"]
+    assert all(len(key.rsplit(":", 1)[1]) == 32 for key in keys)
+    assert upgraded == (None, None)
+
+def test_fuzzy_and_vector_keys_are_migrated(monkeypatch, fake_redis, stub_embedder):
+    import hashlib
+    import numpy as np
+    from src.utils.fuzzy_cache import FuzzyCache
+    from src.utils.get_embeddings import embed_batch
+    from src.utils.vector_cache import VectorCache
+    from src.utils import query_cache as query_cache_module
+    monkeypatch.setattr(migrate_cache_keys, "redis_binary_client", query_cache_module.redis_binary_client)
+    embedding = embed_batch(["What is DNS?"])[0]
+
+    async def run():
+        # As written before keys were namespaced
+        await fake_redis.set("fuzzy_cache:is dns", encode_entry(CacheEntry("Domain Name System", "What is DNS?")), ex=600)
+        legacy_id = hashlib.blake2b(b"What is DNS?", digest_size=16).hexdigest()
+        await query_cache_module.redis_binary_client.hset(f"vector_cache:{legacy_id}", mapping={
+            "query": b"What is DNS?",
+            "response": encode_entry(CacheEntry("Domain Name System", "What is DNS?")),
+            "embedding": np.asarray(embedding, dtype=np.float32).tobytes(),
+        })
+        stats = await migrate_cache_keys.migrate("default", batch_size=10)
+        fuzzy, vector = FuzzyCache(), VectorCache()
+        results = (await fuzzy.search("what is dns?"), await vector.search(embedding, similarity_threshold=0.9))
+        await fuzzy.close()
+        await vector.close()
+        return stats, results, await fake_redis.exists("fuzzy_cache:is dns", f"vector_cache:{legacy_id}")
+
+    stats, results, old_keys = asyncio.run(run())
+    assert stats == {"migrated": 2, "skipped": 0, "adjustments": 0}
+    assert results == ("Domain Name System", "Domain Name System")
+    assert old_keys == 0
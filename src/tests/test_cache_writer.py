@@ -0,0 +1,108 @@
+import asyncio
+from src.utils.cache_writer import CacheWriter, CacheWrite
+
+def make_write(i: int) -> CacheWrite:
+    return CacheWrite(query=f"query {i}", response_text=f"response {i}", ttl=60)
+
+def test_queued_writes_are_batched_and_flushed_on_close():
+    batches = []
+
+    async def write_batch(entries: list[CacheWrite]) -> None:
+        batches.append([entry.query for entry in entries])
+        await asyncio.sleep(0.01)
+
+    async def run() -> CacheWriter:
+        writer = CacheWriter(write_batch, max_queue_size=100, max_batch_size=10)
+        for i in range(25):
+            assert await writer.submit(make_write(i))
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert [query for batch in batches for query in batch] == [f"query {i}" for i in range(25)]
+    assert max(len(batch) for batch in batches) <= 10
+    assert len(batches) < 25
+    assert writer.stats()["written"] == 25 and writer.queue_depth == 0
+
+def test_drop_policies_when_the_queue_is_full():
+    async def run(drop_policy: str) -> tuple[CacheWriter, list[str]]:
+        written = []
+        release = asyncio.Event()
+
+        async def slow_write(entries: list[CacheWrite]) -> None:
+            await release.wait() # redis is stuck
+            written.extend(entry.query for entry in entries)
+
+        writer = CacheWriter(slow_write, max_queue_size=2, max_batch_size=1, drop_policy=drop_policy)
+        await writer.submit(make_write(0))
+        await asyncio.sleep(0) # the background task picks up write 0 and blocks on it
+        for i in range(1, 5):
+            await writer.submit(make_write(i))
+        release.set()
+        await writer.close()
+        return writer, written
+
+    writer, written = asyncio.run(run("drop_newest"))
+    assert written == ["query 0", "query 1", "query 2"] and writer.dropped == 2
+
+    writer, written = asyncio.run(run("drop_oldest"))
+    assert written == ["query 0", "query 3", "query 4"] and writer.dropped == 2
+
+def test_failed_writes_are_counted_and_do_not_stop_the_writer():
+    async def flaky_write(entries: list[CacheWrite]) -> None:
+        if entries[0].query == "query 0":
+            raise ConnectionError("redis is down")
+
+    async def run() -> CacheWriter:
+        writer = CacheWriter(flaky_write, max_batch_size=1)
+        await writer.submit(make_write(0))
+        await writer.flush()
+        await writer.submit(make_write(1))
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert (writer.failed, writer.written) == (1, 1)
+
+def test_queued_writes_are_kept_when_the_writer_moves_to_another_event_loop():
+    written = []
+
+    async def write_batch(entries: list[CacheWrite]) -> None:
+        if entries[0].query == "query 0":
+            await asyncio.Event().wait() # never completes, its event loop ends first
+        written.extend(entry.query for entry in entries)
+
+    writer = CacheWriter(write_batch, max_batch_size=1)
+
+    async def submit_while_a_write_is_stuck() -> None:
+        await writer.submit(make_write(0))
+        await asyncio.sleep(0)
+        for i in range(1, 3):
+            await writer.submit(make_write(i))
+
+    async def submit_and_close() -> None:
+        for i in range(3, 5):
+            await writer.submit(make_write(i))
+        await writer.close()
+
+    asyncio.run(submit_while_a_write_is_stuck())
+    assert writer.queue_depth == 2
+    asyncio.run(submit_and_close())
+    assert written == [f"query {i}" for i in range(1, 5)]
+
+def test_the_writer_can_be_used_again_after_close():
+    written = []
+
+    async def write_batch(entries: list[CacheWrite]) -> None:
+        written.extend(entry.query for entry in entries)
+
+    writer = CacheWriter(write_batch)
+
+    async def lifespan(i: int) -> bool:
+        submitted = await writer.submit(make_write(i))
+        await writer.close()
+        return submitted
+
+    # Like the module-level writer over two lifespans of the server
+    assert asyncio.run(lifespan(0)) and asyncio.run(lifespan(1))
+    assert written == ["query 0", "query 1"] and writer.dropped == 0
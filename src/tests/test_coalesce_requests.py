@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from src.utils.coalesce_requests import coalesce
+
+def test_concurrent_identical_queries_share_one_call(monkeypatch):
+    monkeypatch.setenv("COALESCE_MODE", "local")
+    calls = 0
+
+    async def fake_llm() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "Paris"
+
+    async def run() -> list[tuple[str, bool]]:
+        # Different case/punctuation/whitespace normalizes to the same key
+        queries = ["What is the capital of France?", "what is the capital of  france"] * 50
+        return await asyncio.gather(*(coalesce(query, fake_llm) for query in queries))
+
+    results = asyncio.run(run())
+    assert calls == 1
+    assert all(response == "Paris" for response, _ in results)
+    assert sum(is_leader for _, is_leader in results) == 1
+
+def test_different_queries_are_not_coalesced(monkeypatch):
+    monkeypatch.setenv("COALESCE_MODE", "local")
+
+    async def run() -> list[tuple[str, bool]]:
+        async def echo(text: str) -> str:
+            await asyncio.sleep(0.01)
+            return text
+        return await asyncio.gather(coalesce("a", lambda: echo("a")), coalesce("b", lambda: echo("b")))
+
+    assert asyncio.run(run()) == [("a", True), ("b", True)]
+
+def test_leader_failure_propagates_to_followers(monkeypatch):
+    monkeypatch.setenv("COALESCE_MODE", "local")
+
+    async def failing_llm() -> str:
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def run() -> list:
+        return await asyncio.gather(*(coalesce("q", failing_llm) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    # A later call is not stuck behind the failed one
+    async def ok() -> str:
+        return "ok"
+    assert asyncio.run(coalesce("q", ok)) == ("ok", True)
+
+def test_leader_failure_reaches_the_followers_of_other_workers(monkeypatch, fake_redis):
+    from src.utils import coalesce_requests
+    from src.utils.cache_key import fingerprint
+
+    async def failing_llm() -> str:
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream down")
+
+    async def run() -> list:
+        key = fingerprint("q")
+        # As if the second call came from another worker: both go through redis
+        leader = asyncio.create_task(coalesce_requests._coalesce_across_workers(key, failing_llm))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(coalesce_requests._coalesce_across_workers(key, failing_llm))
+        start = asyncio.get_running_loop().time()
+        results = await asyncio.gather(leader, follower, return_exceptions=True)
+        return results, asyncio.get_running_loop().time() - start
+
+    (leader, follower), elapsed = asyncio.run(run())
+    assert str(leader) == "upstream down"
+    # The follower fails with the leader instead of waiting for the lock to time out, or answering with an error message
+    assert isinstance(follower, RuntimeError) and elapsed < 1
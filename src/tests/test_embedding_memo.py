@@ -0,0 +1,54 @@
+import asyncio
+import numpy as np
+from src.utils.embedding_memo import EmbeddingMemo
+
+def test_lru_eviction_reuses_rows():
+    memo = EmbeddingMemo(capacity=2)
+    memo.put("a", np.full(4, 1, dtype=np.float32))
+    memo.put("b", np.full(4, 2, dtype=np.float32))
+    assert memo.get("a")[0] == 1 # "a" is now the most recently used
+
+    memo.put("c", np.full(4, 3, dtype=np.float32))
+    assert memo.get("b") is None
+    assert memo.get("a")[0] == 1 and memo.get("c")[0] == 3
+    assert memo.stats()["bytes"] == 2 * 4 * 4
+
+def test_returned_embeddings_are_not_overwritten_by_eviction():
+    memo = EmbeddingMemo(capacity=1)
+    memo.put("a", np.full(4, 1, dtype=np.float32))
+    embedding = memo.get("a")
+    memo.put("b", np.full(4, 2, dtype=np.float32))
+    assert embedding[0] == 1
+
+def test_near_identical_queries_are_embedded_once(stub_embedder, monkeypatch):
+    from src.utils import embedding_memo, get_embeddings
+    monkeypatch.setattr(embedding_memo, "embedding_memo", EmbeddingMemo(capacity=10))
+    monkeypatch.setattr(get_embeddings, "_batcher", None)
+
+    async def run():
+        first = await get_embeddings.get_embedding("What is the capital of France?")
+        second = await get_embeddings.get_embedding("what is the capital of   france")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert np.array_equal(first, second)
+    assert sum(stub_embedder.calls) == 1
+    stats = embedding_memo.embedding_memo.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+def test_redis_tier_is_shared_between_workers(stub_embedder, fake_redis, monkeypatch):
+    from src.utils import embedding_memo, get_embeddings
+    monkeypatch.setenv("EMBEDDING_MEMO_REDIS", "TRUE")
+    monkeypatch.setattr(get_embeddings, "_batcher", None)
+
+    async def embed_in_new_worker(text: str) -> np.ndarray:
+        monkeypatch.setattr(embedding_memo, "embedding_memo", EmbeddingMemo(capacity=10))
+        return await get_embeddings.get_embedding(text)
+
+    async def run():
+        return await embed_in_new_worker("How tall is Everest?"), await embed_in_new_worker("how tall is everest")
+
+    first, second = asyncio.run(run())
+    assert np.array_equal(first, second)
+    assert sum(stub_embedder.calls) == 1
+    assert embedding_memo.embedding_memo.redis_hits == 1
@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+from src.utils import cache_entry, eviction
+from src.utils.cache_response import write_cache_entries
+from src.utils.cache_writer import CacheWrite
+from src.utils.cache_key import cache_key
+
+@pytest.fixture(autouse=True)
+def uncompressed_entries(monkeypatch):
+    # So that entry sizes are predictable
+    monkeypatch.setattr(cache_entry, "codec", cache_entry.EntryCodec("none"))
+
+def write(query: str, response_text: str, output_tokens: int) -> CacheWrite:
+    return CacheWrite(query, response_text, ttl=600, model="gpt-4o", input_tokens=10, output_tokens=output_tokens)
+
+def test_lowest_value_entries_are_evicted_first(monkeypatch, fake_redis):
+    monkeypatch.setenv("EVICTION_MAX_BYTES", "1000")
+    monkeypatch.setenv("EVICTION_SWEEP_INTERVAL", "3600") # sweeps are run by hand
+
+    async def run():
+        await write_cache_entries([
+            write("expensive", "x" * 200, output_tokens=4000), # costly to recompute for its size
+            write("cheap and big", "y" * 400, output_tokens=20),
+            write("cheap but popular", "z" * 200, output_tokens=20),
+        ])
+        for _ in range(30):
+            eviction.record_hit(cache_key("cheap but popular"))
+        await write_cache_entries([write("another", "w" * 200, output_tokens=1000)]) # goes over budget
+        used_before = int(await fake_redis.get(eviction.BYTES_KEY))
+        await eviction.sweep(batch_size=10)
+        remaining = sorted([key async for key in fake_redis.scan_iter() if not key.startswith("eviction:")])
+        return used_before, remaining, int(await fake_redis.get(eviction.BYTES_KEY))
+
+    used_before, remaining, used_after = asyncio.run(run())
+    assert used_before > 1000
+    assert remaining == sorted(cache_key(query) for query in ("another", "cheap but popular", "expensive"))
+    assert used_after <= 1000
+
+def test_low_value_entries_are_not_admitted_when_full(monkeypatch, fake_redis):
+    monkeypatch.setenv("EVICTION_MAX_BYTES", "600")
+    monkeypatch.setenv("EVICTION_SWEEP_INTERVAL", "3600")
+
+    async def run():
+        await write_cache_entries([write("expensive", "x" * 300, output_tokens=4000)])
+        await write_cache_entries([write("cheap", "y" * 300, output_tokens=10), write("valuable", "z" * 100, output_tokens=8000)])
+        return [await fake_redis.exists(cache_key(query)) for query in ("expensive", "cheap", "valuable")]
+
+    assert asyncio.run(run()) == [1, 0, 1]
+
+def test_expired_entries_are_forgotten(monkeypatch, fake_redis):
+    monkeypatch.setenv("EVICTION_MAX_BYTES", "100000")
+    monkeypatch.setenv("EVICTION_SWEEP_INTERVAL", "3600")
+
+    async def run():
+        await write_cache_entries([write("kept", "a" * 100, output_tokens=100), write("expired", "b" * 100, output_tokens=100)])
+        await fake_redis.delete(cache_key("expired")) # as if its TTL ran out
+        cursor, forgotten = await eviction.forget_expired(0, batch_size=10)
+        return forgotten, await fake_redis.zrange(eviction.PRIORITIES_KEY, 0, -1), int(await fake_redis.get(eviction.BYTES_KEY))
+
+    forgotten, tracked, used = asyncio.run(run())
+    assert forgotten == 1 and tracked == [cache_key("kept")]
+    assert 100 < used < 200
+
+def test_l1_hits_are_counted_and_recorded_in_batches(monkeypatch, fake_redis):
+    monkeypatch.setenv("EVICTION_MAX_BYTES", "100000")
+    monkeypatch.setenv("EVICTION_SWEEP_INTERVAL", "3600")
+    from src.utils import query_cache as query_cache_module
+    from src.utils.local_cache import LocalCache
+    cache = LocalCache(max_entries=10, max_bytes=10000, max_ttl=60)
+    monkeypatch.setattr(query_cache_module, "local_cache", cache)
+    monkeypatch.setattr(query_cache_module, "ensure_invalidation_listener", lambda: None)
+
+    async def run():
+        await write_cache_entries([write("popular", "a" * 100, output_tokens=100), write("unpopular", "b" * 100, output_tokens=100)])
+        cache.set(cache_key("popular"), "a" * 100, ttl=60)
+        for _ in range(5):
+            assert query_cache_module.query_local_many(["popular", "unpopular"]) == ["a" * 100, None]
+        sent = await eviction.flush_hits(batch_size=10)
+        stats = await fake_redis.hmget(eviction.STATS_KEY, [cache_key("popular"), cache_key("unpopular")])
+        return sent, [int(stat.split()[2]) for stat in stats], await fake_redis.zrange(eviction.PRIORITIES_KEY, 0, -1)
+
+    sent, frequencies, by_priority = asyncio.run(run())
+    # The five L1 hits were sent in one call, and raise the entry's priority
+    assert sent == 1 and frequencies == [6, 1]
+    assert by_priority == [cache_key("unpopular"), cache_key("popular")]
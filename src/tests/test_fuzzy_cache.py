@@ -0,0 +1,95 @@
+import asyncio
+import random
+from src.utils.cache_response import cache_response, cache_writer
+from src.utils.clean_query import canonicalize_query
+from src.utils.fuzzy_cache import FuzzyCache, differing_words_match, entry_key
+from src.utils.query_cache import query_cache, CacheHit
+from src.utils.trigram_index import TrigramIndex, trigrams, jaccard
+
+def test_canonicalize_query():
+    assert canonicalize_query("¿Cómo se dice 'hello' en español?") == canonicalize_query("como se dice hello en espanol")
+    assert canonicalize_query("🌟 What's the meaning of life? 🌟") == canonicalize_query("what is the meaning of life") == "is meaning life"
+    assert canonicalize_query("Explain quantum computing to a 5-year-old") == "explain quantum computing to 5 year old"
+    # Words that change the answer are kept
+    assert canonicalize_query("What are the least populous countries?") != canonicalize_query("What are the most populous countries?")
+    assert canonicalize_query("Which countries are the most populous?", stem=True) == canonicalize_query("Which country is most populous?", stem=True)
+    # Pronouns, negations and tenses too
+    assert canonicalize_query("How old is he?") != canonicalize_query("How old is she?")
+    assert canonicalize_query("Who was the president of France in 1990?") != canonicalize_query("Who is the president of France in 1990?")
+    assert canonicalize_query("Why isn't the sky green?") == canonicalize_query("why is not the sky green") != canonicalize_query("Why is the sky green?")
+    assert canonicalize_query("Will it rain tomorrow?") != canonicalize_query("Did it rain tomorrow?")
+    # And the prepositions that give a direction or a relation
+    for query, other in [
+        ("Translate hello to French", "Translate hello from French"),
+        ("Flights from Paris to London", "Flights to Paris from London"),
+        ("convert Celsius to Fahrenheit", "convert Fahrenheit to Celsius"),
+        ("10 divided by 2", "10 divided into 2"),
+        ("What is bread made of?", "What is bread made with?"),
+    ]:
+        assert canonicalize_query(query) != canonicalize_query(other)
+        assert canonicalize_query(query, stem=True) != canonicalize_query(other, stem=True)
+
+def test_differing_words_must_be_misspellings():
+    assert differing_words_match("capitol japan", "capital japan")
+    assert differing_words_match("make homemade piza dough", "make homemade pizza dough")
+    assert not differing_words_match("make homemade bread dough", "make homemade pizza dough")
+    assert not differing_words_match("make pizza dough", "make homemade pizza dough")
+    assert not differing_words_match("square root 144", "square root 145")
+    # The same words in another order ask another question
+    assert not differing_words_match("flights paris london", "flights london paris")
+    assert not differing_words_match("brazil beat germany", "germany beat brazil")
+    assert not differing_words_match("brazil beat germny", "germany beat brazil")
+
+def test_trigram_search_matches_brute_force():
+    rng = random.Random(0)
+    words = ["pizza", "dough", "capital", "france", "quantum", "computing", "meaning", "life", "tesla", "model", "latest"]
+    texts = {" ".join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(300)}
+    index = TrigramIndex()
+    for text in texts:
+        index.add(text)
+    for query in ["pizza dough", "capitol france", "latest tesla modle", "meaning"]:
+        for threshold in (0.3, 0.6, 0.8):
+            expected = sorted(
+                ((text, jaccard(trigrams(query), trigrams(text))) for text in texts if jaccard(trigrams(query), trigrams(text)) >= threshold),
+                key=lambda match: match[1], reverse=True,
+            )
+            assert [similarity for _, similarity in index.search(query, threshold, k=5)] == [similarity for _, similarity in expected[:5]]
+
+def test_fuzzy_hits_and_misses(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "fuzzy")
+    from src.utils import cache_response as cache_response_module, query_cache as query_cache_module
+    cache = FuzzyCache()
+    monkeypatch.setattr(cache_response_module, "fuzzy_cache", cache)
+    monkeypatch.setattr(query_cache_module, "fuzzy_cache", cache)
+
+    async def run():
+        await cache_response("How do I make homemade pizza dough?", "Mix flour, water, yeast and salt.")
+        await cache_writer.flush()
+        results = (
+            await query_cache("how do i make homemade pizza dough"), # same canonical query
+            await query_cache("How do I make homemade piza dough?"), # near-duplicate
+            await query_cache("How do I make homemade bread dough?"),
+        )
+        await cache.close()
+        return results
+
+    cleaned, near_duplicate, different = asyncio.run(run())
+    assert cleaned == near_duplicate == CacheHit("Mix flour, water, yeast and salt.", "cache_l2")
+    assert different is None
+
+def test_index_is_rebuilt_from_redis_and_expired_entries_dropped(fake_redis):
+    async def run():
+        writer = FuzzyCache()
+        await writer.add_many([("What is the capital of Japan?", "Tokyo", 60), ("What is the capital of France?", "Paris", 60)])
+        await writer.close()
+
+        # A second worker starting up loads the entries from redis
+        reader = FuzzyCache()
+        await reader.ensure_loaded()
+        loaded = len(reader.index)
+        await fake_redis.delete(entry_key("is capital france")) # expired
+        results = await reader.search_many(["What's the capitol of Japan", "what is the capital of france"], similarity_threshold=0.6)
+        await reader.close()
+        return loaded, len(reader.index), results
+
+    assert asyncio.run(run()) == (2, 1, ["Tokyo", None])
@@ -0,0 +1,76 @@
+import asyncio
+from src.utils.cache_response import cache_response, cache_writer
+from src.utils.fuzzy_cache import FuzzyCache
+from src.utils.local_cache import local_cache
+from src.utils.query_cache import query_cache, query_cache_many, CacheHit, HYBRID_STAGES
+from src.utils.vector_cache import VectorCache
+
+def use_hybrid_caches(monkeypatch) -> tuple[FuzzyCache, VectorCache]:
+    monkeypatch.setenv("CACHING_STRATEGY", "hybrid")
+    monkeypatch.setenv("SIMILARITY_THRESHOLD", "0.8")
+    from src.utils import cache_response as cache_response_module, query_cache as query_cache_module
+    fuzzy, vector = FuzzyCache(), VectorCache()
+    for module in (cache_response_module, query_cache_module):
+        monkeypatch.setattr(module, "fuzzy_cache", fuzzy)
+        monkeypatch.setattr(module, "vector_cache", vector)
+    local_cache.clear()
+    return fuzzy, vector
+
+def test_cascade_stops_at_the_first_stage_that_hits(monkeypatch, fake_redis, stub_embedder):
+    fuzzy, vector = use_hybrid_caches(monkeypatch)
+
+    async def run():
+        await cache_response("How do I make homemade pizza dough?", "Mix flour, water, yeast and salt.")
+        await cache_writer.flush()
+        local_cache.clear()
+        results = []
+        for query in [
+            "How do I make homemade pizza dough?", # redis exact match (then copied into L1)
+            "How do I make homemade pizza dough?", # L1
+            "how do i make homemade pizza dough", # same canonical query
+            "How do I make homemade piza dough?", # near-duplicate
+            "How do I make homemade pizza dough at home?", # only semantically similar
+            "How do volcanoes form?",
+        ]:
+            timing = {}
+            results.append((await query_cache(query, timing), timing))
+        await fuzzy.close()
+        await vector.close()
+        return results
+
+    results = asyncio.run(run())
+    assert [hit.stage if hit is not None else None for hit, _ in results] == ["exact", "l1", "normalized", "lexical", "semantic", None]
+    assert results[1][0] == CacheHit("Mix flour, water, yeast and salt.", "cache_l1", "l1")
+    # Later stages only run when the earlier ones miss
+    assert set(results[1][1]) == {"cache_stage_l1"}
+    assert set(results[3][1]) == {"cache_stage_l1", "cache_stage_exact", "cache_stage_normalized", "cache_stage_lexical"}
+    assert set(results[5][1]) == {f"cache_stage_{stage}" for stage in HYBRID_STAGES}
+
+def test_parallel_cascade_prefers_earlier_stages_and_respects_the_deadline(monkeypatch, fake_redis, stub_embedder):
+    fuzzy, vector = use_hybrid_caches(monkeypatch)
+    monkeypatch.setenv("HYBRID_PARALLEL", "TRUE")
+    from src.utils import query_cache as query_cache_module
+
+    async def slow_semantic_stage(queries: list[str]) -> list[str | None]:
+        await asyncio.sleep(0.2)
+        return ["too late"] * len(queries)
+    monkeypatch.setitem(query_cache_module.HYBRID_STAGES, "semantic", slow_semantic_stage)
+
+    async def run():
+        await cache_response("What is the capital of France?", "Paris")
+        await cache_writer.flush()
+        local_cache.clear()
+        # Every stage runs at once, but the normalized hit wins over the (slower) semantic one
+        normalized = await query_cache_many(["what is the capital of france", "What is the capital of Japan?"])
+        monkeypatch.setenv("HYBRID_DEADLINE_MS", "50")
+        timing = {}
+        missed = await query_cache("What is the capital of Japan?", timing)
+        await fuzzy.close()
+        await vector.close()
+        return normalized, missed, timing
+
+    normalized, missed, timing = asyncio.run(run())
+    assert normalized[0] == CacheHit("Paris", "cache_l2", "normalized")
+    assert normalized[1] == CacheHit("too late", "cache_l2", "semantic")
+    assert missed is None
+    assert 0.04 < timing["cache_stage_semantic"] < 0.15
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from src.utils.local_cache import LocalCache
+from src.utils.query_cache import query_cache, CacheHit
+from src.utils.cache_key import cache_key
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = LocalCache(max_entries=2, max_bytes=100, max_ttl=60)
+    cache.set("a", "1", ttl=60)
+    cache.set("b", "2", ttl=60)
+    cache.get("a")
+    cache.set("c", "3", ttl=60)
+    assert cache.get("b") is None and cache.get("a") == "1"
+
+    cache.set("big", "x" * 97, ttl=60) # together with any other entry this exceeds 100 bytes
+    assert len(cache) == 1 and cache.bytes == 100
+    cache.set("huge", "x" * 200, ttl=60) # larger than the whole cache, so never admitted
+    assert cache.get("huge") is None and cache.get("big") is not None
+
+def test_entries_expire():
+    cache = LocalCache(max_entries=10, max_bytes=1000, max_ttl=0.05)
+    cache.set("a", "1", ttl=3600) # capped at max_ttl
+    assert cache.get("a") == "1"
+    time.sleep(0.06)
+    assert cache.get("a") is None and cache.bytes == 0
+
+def test_hits_are_served_from_l1_after_l2(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    from src.utils import cache_response as cache_response_module, local_cache as local_cache_module, query_cache as query_cache_module
+    cache = LocalCache(max_entries=10, max_bytes=1000, max_ttl=60)
+    for module in (cache_response_module, local_cache_module, query_cache_module):
+        monkeypatch.setattr(module, "local_cache", cache)
+    monkeypatch.setattr(local_cache_module, "ensure_invalidation_listener", lambda: None)
+    monkeypatch.setattr(query_cache_module, "ensure_invalidation_listener", lambda: None)
+
+    async def run():
+        await fake_redis.set(cache_key("What is 2+2?"), "4", ex=120)
+        first = await query_cache("What is 2+2?")
+        second = await query_cache("What is 2+2?")
+        return first, second
+
+    assert asyncio.run(run()) == (CacheHit("4", "cache_l2"), CacheHit("4", "cache_l1"))
+
+def test_writes_from_other_workers_invalidate_l1(monkeypatch, fake_redis):
+    from src.utils import local_cache as local_cache_module
+    cache = LocalCache(max_entries=10, max_bytes=1000, max_ttl=60)
+    monkeypatch.setattr(local_cache_module, "local_cache", cache)
+
+    async def run():
+        local_cache_module.ensure_invalidation_listener()
+        await asyncio.sleep(0.05) # let the listener subscribe
+        cache.set("q", "old answer", ttl=60)
+        # Our own writes don't invalidate our L1 copy, but writes announced by another worker do
+        await fake_redis.publish(local_cache_module.INVALIDATION_CHANNEL, local_cache_module.invalidation_message("q"))
+        await asyncio.sleep(0.05)
+        assert cache.get("q") == "old answer"
+        await fake_redis.publish(local_cache_module.INVALIDATION_CHANNEL, "another-worker:q")
+        await asyncio.sleep(0.05)
+        await local_cache_module.stop_invalidation_listener()
+
+    asyncio.run(run())
+    assert cache.get("q") is None
+    assert cache.invalidations == 1
+
+def test_values_read_before_an_invalidation_are_not_cached():
+    cache = LocalCache(max_entries=2, max_bytes=1000, max_ttl=60)
+    version = cache.version
+    cache.delete("q") # announced while the read was in flight
+    cache.set("q", "stale answer", ttl=60, since=version)
+    cache.set("r", "answer", ttl=60, since=version)
+    assert cache.get("q") is None and cache.get("r") == "answer"
+
+    # A write of our own is newer than the value being read too
+    version = cache.version
+    cache.set("r", "new answer", ttl=60)
+    cache.set("r", "answer", ttl=60, since=version)
+    assert cache.get("r") == "new answer"
+
+    # Once older changes are forgotten, or after a clear, reads from before them are never cached
+    version = cache.version
+    for key in ("a", "b", "c"):
+        cache.delete(key)
+    cache.set("q", "answer", ttl=60, since=version)
+    version = cache.version
+    cache.clear()
+    cache.set("r", "answer", ttl=60, since=version)
+    assert cache.get("q") is None and cache.get("r") is None
+
+def test_l2_reads_do_not_refill_l1_with_values_invalidated_meanwhile(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    from src.utils import query_cache as query_cache_module
+    cache = LocalCache(max_entries=10, max_bytes=1000, max_ttl=60)
+    monkeypatch.setattr(query_cache_module, "local_cache", cache)
+    monkeypatch.setattr(query_cache_module, "ensure_invalidation_listener", lambda: None)
+    key = cache_key("What is 2+2?")
+
+    binary_client = query_cache_module.redis_binary_client
+    pipeline = binary_client.pipeline
+    def invalidating_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        async def execute_then_invalidate():
+            replies = await execute()
+            cache.delete(key) # another worker rewrites the entry while the replies are on their way
+            return replies
+        pipe.execute = execute_then_invalidate
+        return pipe
+    monkeypatch.setattr(binary_client, "pipeline", invalidating_pipeline)
+
+    async def run():
+        await fake_redis.set(key, "4", ex=120)
+        return await query_cache_module.query_redis_many(["What is 2+2?"])
+
+    assert asyncio.run(run()) == ["4"]
+    assert cache.get(key) is None
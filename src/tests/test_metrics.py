@@ -0,0 +1,60 @@
+import re
+import pytest
+from fastapi.testclient import TestClient
+from src import server
+from src.utils import metrics
+from src.utils.cost_model import calculate_cost
+from src.utils.histogram import Histogram
+from src.utils.query_cache import CacheHit
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "stage_latency", {stage: Histogram() for stage in metrics.stage_latency})
+    monkeypatch.setattr(metrics, "requests", {})
+    monkeypatch.setattr(metrics, "dollars_saved", {})
+
+def test_requests_are_counted_by_source(monkeypatch, fresh_metrics):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    async def fake_query_cache(query: str, timing: dict | None = None) -> CacheHit | None:
+        return CacheHit("from the cache", "cache_l2") if query == "cached" else None
+    async def fake_query_llm(query: str, timing: dict, priority: int) -> str:
+        return f"answer to {query}"
+    monkeypatch.setattr(server, "query_cache", fake_query_cache)
+    monkeypatch.setattr(server, "query_llm", fake_query_llm)
+
+    client = TestClient(server.app)
+    for query in ["cached", "cached", "new"]:
+        client.post("/api/query", json={"query": query})
+
+    assert metrics.requests == {("exact_match_only", "cache_l2"): 2, ("exact_match_only", "llm"): 1}
+    assert metrics.dollars_saved["exact_match_only"] == pytest.approx(2 * calculate_cost("cached", "from the cache", "llm"))
+    assert metrics.stage_latency["cache_lookup"].count == 3
+
+def test_metrics_are_rendered_in_the_prometheus_text_format(fresh_metrics):
+    metrics.observe("llm_call", 0.3)
+    metrics.observe("llm_call", 100)
+    metrics.record_request("query", "response", "cache_l1")
+
+    response = TestClient(server.app).get("/metrics")
+    text = response.text
+
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE llm_cache_stage_seconds histogram" in text
+    assert 'llm_cache_stage_seconds_bucket{stage="llm_call",le="+Inf"} 2' in text
+    assert 'llm_cache_stage_seconds_count{stage="llm_call"} 2' in text
+    assert re.search(r'llm_cache_requests_total\{strategy="[^"]*",source="cache_l1"\} 1', text)
+    assert "# TYPE llm_cache_write_queue_depth gauge" in text
+    # Buckets are cumulative
+    buckets = [int(count) for count in re.findall(r'llm_cache_stage_seconds_bucket\{stage="llm_call",le="[^"]+"\} (\d+)', text)]
+    assert buckets == sorted(buckets) and buckets[-1] == 2
+
+def test_pool_figures_redis_py_does_not_expose_are_left_out(monkeypatch, fresh_metrics):
+    from src.utils import redis_client
+    class PoolWithoutInternals: # as if a redis-py upgrade renamed the private attributes
+        max_connections = 50
+    monkeypatch.setattr(redis_client, "connection_pools", [PoolWithoutInternals()])
+
+    assert redis_client.pool_utilisation() == {"in_use": None, "max": 50}
+    text = TestClient(server.app).get("/metrics").text
+    assert 'llm_cache_redis_connections{state="max"} 50' in text
+    assert 'state="in_use"' not in text
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from src.utils.micro_batcher import MicroBatcher
+
+def test_concurrent_calls_are_batched_and_resolved_in_order():
+    batch_sizes = []
+
+    def double(items: list[int]) -> list[int]:
+        batch_sizes.append(len(items))
+        time.sleep(0.01) # like a model call, gives the other callers time to queue up
+        return [item * 2 for item in items]
+
+    async def run() -> list[int]:
+        batcher = MicroBatcher(double, max_batch_size=16, max_wait_ms=50)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(40)))
+
+    assert asyncio.run(run()) == [i * 2 for i in range(40)]
+    assert max(batch_sizes) <= 16
+    assert len(batch_sizes) < 40
+
+def test_lone_call_is_not_delayed():
+    async def run() -> float:
+        batcher = MicroBatcher(lambda items: items, max_batch_size=16, max_wait_ms=1000)
+        start = time.perf_counter()
+        await batcher.submit("only")
+        return time.perf_counter() - start
+
+    assert asyncio.run(run()) < 0.5
+
+def test_batch_failure_is_raised_to_every_caller():
+    def fail(items: list[int]) -> list[int]:
+        raise ValueError("model crashed")
+
+    async def run():
+        batcher = MicroBatcher(fail, max_batch_size=4, max_wait_ms=1)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(run()))
+
+def test_items_of_callers_that_gave_up_are_not_processed():
+    processed = []
+
+    def record(items: list[int]) -> list[int]:
+        processed.extend(items)
+        time.sleep(0.05)
+        return items
+
+    async def run():
+        batcher = MicroBatcher(record, max_batch_size=16, max_wait_ms=1000)
+        first = asyncio.ensure_future(batcher.submit(0)) # dispatched straight away
+        await asyncio.sleep(0.01)
+        # These wait for the first batch to finish, and one of them times out meanwhile
+        impatient = asyncio.wait_for(batcher.submit(1), timeout=0.01)
+        results = await asyncio.gather(first, impatient, batcher.submit(2), return_exceptions=True)
+        return results
+
+    results = asyncio.run(run())
+    assert results[0] == 0 and isinstance(results[1], asyncio.TimeoutError) and results[2] == 2
+    assert processed == [0, 2]
+
+def test_embeddings_go_through_the_batcher(stub_embedder, monkeypatch):
+    from src.utils import get_embeddings
+    monkeypatch.setattr(get_embeddings, "_batcher", None)
+
+    async def run():
+        return await asyncio.gather(*(get_embeddings.get_embedding(f"query {i}") for i in range(20)))
+
+    embeddings = asyncio.run(run())
+    assert len(embeddings) == 20 and embeddings[0].shape == (stub_embedder.dim,)
+    assert len(stub_embedder.calls) < 20
+    assert get_embeddings.get_batcher().stats()["batch_size"]["count"] == len(stub_embedder.calls)
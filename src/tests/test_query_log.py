@@ -0,0 +1,75 @@
+import json
+from fastapi.testclient import TestClient
+from src import server
+from src.utils.query_cache import CacheHit
+from src.utils.query_log import QueryLogger, query_hash, read_query_log
+
+def read_records(path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_records_are_written_as_jsonl_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    path = tmp_path / "logs" / "queries.jsonl"
+    logger = QueryLogger(str(path), flush_interval=0.05)
+    logger.record_request(" What is 2+2? ", "cache_l2", 0.0012)
+    logger.record_llm_call("what is the capital of france", "gpt-4o", 0.8, input_tokens=12, output_tokens=40)
+    logger.record_request("what is the capital of france", "llm", 0.81)
+    logger.close()
+
+    request, llm_call, miss = read_records(path)
+    assert request["event"] == "request" and request["query"] == " What is 2+2? "
+    assert request["query_hash"] == query_hash("What is 2+2?") # hashed like the cache keys, on the canonical query
+    assert (request["strategy"], request["source"], request["latency"]) == ("exact_match_only", "cache_l2", 0.0012)
+    # LLM calls are joined to their requests by the query hash
+    assert llm_call["query_hash"] == miss["query_hash"] and "query" not in llm_call
+    assert (llm_call["input_tokens"], llm_call["output_tokens"]) == (12, 40)
+    assert read_query_log(str(path)) == [" What is 2+2? ", "what is the capital of france"]
+    assert logger.stats()["written"] == 3
+
+def test_the_log_is_rotated_by_size(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    logger = QueryLogger(str(path), max_bytes=300, backups=2, batch_size=1, flush_interval=0.01)
+    for i in range(20):
+        logger.record_request(f"query {i}", "llm", 1.0)
+    logger.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["queries.jsonl", "queries.jsonl.1", "queries.jsonl.2"]
+    assert all(p.stat().st_size <= 300 for p in tmp_path.iterdir())
+    # The newest records are in the current file, the older ones in the backups
+    assert read_query_log(str(path))[-1] == "query 19"
+    index = lambda query: int(query.split()[-1])
+    assert index(read_query_log(f"{path}.1")[-1]) + 1 == index(read_query_log(str(path))[0])
+
+def test_queries_are_sampled_by_hash(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    logger = QueryLogger(str(path), sample_rate=0.5, flush_interval=0.01)
+    queries = [f"query {i}" for i in range(200)]
+    for query in queries + queries:
+        logger.record_request(query, "llm", 1.0)
+    logger.close()
+
+    logged = read_query_log(str(path))
+    # Every sampled query is logged each time it's requested
+    assert 50 < len(set(logged)) < 150
+    assert logged == [query for query in queries + queries if query in set(logged)]
+
+def test_server_requests_are_logged(tmp_path, monkeypatch):
+    logger = QueryLogger(str(tmp_path / "queries.jsonl"), flush_interval=0.01)
+    monkeypatch.setattr(server, "query_log", logger)
+    async def fake_query_cache(query: str, timing: dict | None = None) -> CacheHit | None:
+        return CacheHit("4", "cache_l1", "exact") if query == "2+2" else None
+    async def fake_query_llm(query: str, timing: dict, priority: int) -> str:
+        return "Paris"
+    monkeypatch.setattr(server, "query_cache", fake_query_cache)
+    monkeypatch.setattr(server, "query_llm", fake_query_llm)
+
+    client = TestClient(server.app)
+    client.post("/api/query", json={"query": "2+2"})
+    client.post("/api/query", json={"query": "capital of france", "forceRefresh": True})
+    logger.close()
+
+    hit, refresh = read_records(logger.path)
+    assert (hit["source"], hit["stage"], hit["force_refresh"]) == ("cache_l1", "exact", False)
+    assert (refresh["source"], refresh["force_refresh"]) == ("llm", True)
+    assert hit["latency"] > 0
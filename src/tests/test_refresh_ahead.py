@@ -0,0 +1,93 @@
+import asyncio
+import time
+import pytest
+from src.utils import query_cache
+from src.utils.cache_entry import CacheEntry, encode_entry
+from src.utils.cache_key import cache_key
+from src.utils.cache_response import write_cache_entries
+from src.utils.cache_writer import CacheWrite
+from src.utils.local_cache import local_cache
+from src.utils.query_cache import query_exact_match_many
+from src.utils.refresh_ahead import Refresher
+
+def use_refresher(monkeypatch, refresh, **settings) -> Refresher:
+    settings = {"ahead_fraction": 0.0, "min_rate": 1.0, "max_concurrency": 4, "per_minute": 60, "lock_ttl": 60, **settings}
+    refresher = Refresher(refresh, **settings)
+    monkeypatch.setattr(query_cache, "refresher", refresher)
+    return refresher
+
+async def finish_refreshes(refresher: Refresher) -> None:
+    await asyncio.gather(*refresher._running.values())
+
+@pytest.fixture(autouse=True)
+def empty_local_cache():
+    local_cache.clear()
+    yield
+    local_cache.clear()
+
+def test_stale_entries_are_served_while_refreshed_once(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHE_STALE_TTL", "100")
+    query = "Who won the last world cup?"
+    refreshed = []
+    async def refresh(key: str) -> None:
+        refreshed.append(key)
+        await write_cache_entries([CacheWrite(key, "new answer", ttl=1000)])
+    refresher = use_refresher(monkeypatch, refresh)
+
+    async def run():
+        await write_cache_entries([CacheWrite(query, "old answer", ttl=1000)])
+        hard_ttl = await fake_redis.ttl(cache_key(query))
+        await fake_redis.expire(cache_key(query), 50) # past the soft TTL, within the stale window
+        local_cache.clear()
+        stale = await asyncio.gather(*(query_exact_match_many([query]) for _ in range(3)))
+        await finish_refreshes(refresher)
+        local_cache.clear()
+        return hard_ttl, stale, await query_exact_match_many([query]), await fake_redis.ttl(cache_key(query))
+
+    hard_ttl, stale, fresh, refreshed_ttl = asyncio.run(run())
+    assert hard_ttl == 1100 # soft TTL + CACHE_STALE_TTL
+    assert [hits[0].response for hits in stale] == ["old answer"] * 3
+    assert refreshed == [query] and refresher.refreshed_stale == 1
+    assert fresh[0].response == "new answer" and refreshed_ttl == 1100
+
+def test_stale_entries_are_served_until_the_hard_ttl_when_refreshes_fail(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHE_STALE_TTL", "100")
+    query = "What is the tallest building in the world?"
+    async def failing_refresh(key: str) -> None:
+        raise ConnectionError("upstream unavailable")
+    refresher = use_refresher(monkeypatch, failing_refresh)
+
+    async def run():
+        await write_cache_entries([CacheWrite(query, "old answer", ttl=1000)])
+        await fake_redis.expire(cache_key(query), 50)
+        local_cache.clear()
+        first = await query_exact_match_many([query])
+        await finish_refreshes(refresher)
+        second = await query_exact_match_many([query]) # the lock holds back another attempt
+        await finish_refreshes(refresher)
+        await fake_redis.delete(cache_key(query)) # the hard TTL has passed
+        return first, second, await query_exact_match_many([query])
+
+    first, second, expired = asyncio.run(run())
+    assert first[0].response == second[0].response == "old answer"
+    assert refresher.errors == 1 and refresher.stats()["refreshed_stale"] == 1
+    assert expired == [None]
+
+def test_only_hot_entries_are_refreshed_ahead(monkeypatch, fake_redis):
+    refreshed = []
+    async def refresh(key: str) -> None:
+        refreshed.append(key)
+    refresher = use_refresher(monkeypatch, refresh, ahead_fraction=0.1)
+
+    async def run():
+        for query in ("hot", "cold"):
+            # 950s into a 1000s TTL
+            entry = encode_entry(CacheEntry(f"answer to {query}", query, created_at=time.time() - 950))
+            await query_cache.redis_binary_client.set(cache_key(query), entry, ex=50)
+        results = [await query_exact_match_many(["hot"]) for _ in range(3)] + [await query_exact_match_many(["cold"])]
+        await finish_refreshes(refresher)
+        return results
+
+    results = asyncio.run(run())
+    assert all(hits[0] is not None and hits[0].source == "cache_l2" for hits in results) # not kept in L1 once due
+    assert refreshed == ["hot"] and refresher.refreshed_ahead == 1
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from src.evaluations.replay_trace import ReplayConfig, Trace, load_trace, prepare, replay, semantic_neighbours, sweep, sweep_configs
+from src.utils.cost_model import llm_cost
+from src.utils.query_log import QueryLogger
+
+def make_trace(queries: list[str], groups: list | None = None, interval: float = 1.0) -> Trace:
+    return Trace(queries=queries, timestamps=np.arange(len(queries)) * interval, groups=groups)
+
+def test_strategies_are_replayed_against_a_model_of_the_cache(stub_embedder):
+    trace = make_trace(
+        ["what is the capital of france", "What is the capital of France?", "what is the capital of france",
+         "capital city of france", "what is the capitol of france", "how tall is mount everest"],
+        groups=["paris", "paris", "paris", "paris", "paris", "everest"],
+    )
+    model = prepare(trace, ["exact_match_only", "fuzzy", "vector_embedding", "hybrid", "no_cache"], 0.5, 0.5)
+    results = {config.strategy: replay(model, config) for config in sweep_configs(
+        ["exact_match_only", "fuzzy", "vector_embedding", "hybrid", "no_cache"], [0.5], [0.5], [None], [0],
+    )}
+
+    assert results["exact_match_only"]["hit_rate"] == pytest.approx(1 / 6)
+    # Case and punctuation, then the misspelling
+    assert results["fuzzy"]["normalized_hits"] == 2 and results["fuzzy"]["lexical_hits"] == 1
+    assert results["hybrid"]["hit_rate"] >= results["fuzzy"]["hit_rate"]
+    assert results["no_cache"]["hit_rate"] == 0
+    assert results["no_cache"]["cost"] > results["hybrid"]["cost"]
+    assert results["hybrid"]["mean_latency_ms"] < results["no_cache"]["mean_latency_ms"]
+    assert all(result["false_hit_rate"] == 0 for result in results.values())
+
+def test_ttls_cache_sizes_and_false_hits():
+    trace = make_trace(["a b c", "d e f", "a b c", "d e f", "a b c"], groups=[1, 2, 1, 3, 1], interval=10)
+    model = prepare(trace, ["exact_match_only"], 1.0, 1.0)
+
+    assert replay(model, ReplayConfig("exact_match_only"))["hit_rate"] == pytest.approx(3 / 5)
+    # Entries expire before the query comes back
+    assert replay(model, ReplayConfig("exact_match_only", ttl=15))["hit_rate"] == 0
+    # With a single entry, "d e f" evicts "a b c"
+    assert replay(model, ReplayConfig("exact_match_only", cache_size=1))["hit_rate"] == 0
+    # The second "d e f" was answered with the answer of another group
+    assert replay(model, ReplayConfig("exact_match_only"))["false_hit_rate"] == pytest.approx(1 / 3)
+
+def test_semantic_neighbours_are_the_most_similar_other_rows():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((50, 16)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    neighbours = semantic_neighbours(embeddings, threshold=-1.0, k=3)
+
+    similarities = embeddings @ embeddings.T
+    np.fill_diagonal(similarities, -np.inf)
+    for row, row_neighbours in enumerate(neighbours):
+        assert [i for i, _ in row_neighbours] == np.argsort(-similarities[row])[:3].tolist()
+
+def test_query_logs_are_replayed_in_parallel(tmp_path):
+    logger = QueryLogger(str(tmp_path / "queries.jsonl"), flush_interval=0.01)
+    for query in ["one", "two", "one", "one"]:
+        logger.record_request(query, "llm", 1.0)
+    logger.record_llm_call("one", "gpt-4o", 3.0, input_tokens=10, output_tokens=1000)
+    logger.close()
+
+    trace = load_trace(str(tmp_path / "queries.jsonl"))
+    model = prepare(trace, ["exact_match_only"], 1.0, 1.0, llm_latency=1.0)
+    configs = sweep_configs(["exact_match_only", "no_cache"], [0.85], [0.8], [None, 3600], [0, 1])
+    results = sweep(model, configs, workers=2)
+
+    assert len(results) == 5
+    assert results.equals(sweep(model, configs, workers=1))
+    no_cache = results[results.strategy == "no_cache"].iloc[0]
+    # The misses of "one" cost what its LLM call did, and took as long
+    assert no_cache["cost"] == pytest.approx(3 * llm_cost(10, 1000) + llm_cost(len("two") / 4, 500))
+    assert no_cache["mean_latency_ms"] == pytest.approx((3 * 3000 + 1000) / 4)
@@ -0,0 +1,125 @@
+import asyncio
+import shutil
+import socket
+import subprocess
+import time
+import pytest
+from src.utils import cache_response, query_cache, redis_client, vector_cache
+from src.utils.cache_writer import CacheWrite
+from src.utils.local_cache import local_cache
+from src.utils.sharded_redis import HashRing, ShardedRedis
+
+def keys(count: int) -> list[str]:
+    return [f"What is fact number {i}?" for i in range(count)]
+
+def test_keys_are_spread_evenly_and_mostly_stay_put_when_a_node_is_added():
+    ring = HashRing([f"node{i}" for i in range(4)])
+    shards = [ring.shard_for(key) for key in keys(20_000)]
+    assert all(abs(shards.count(shard) - 5000) < 750 for shard in range(4))
+
+    grown = HashRing([f"node{i}" for i in range(5)])
+    moved = sum(ring.shard_for(key) != grown.shard_for(key) for key in keys(20_000))
+    assert moved / 20_000 < 0.3 # about 1/5 of the keys move to the new node, none between the old ones
+    assert ring.shard_for("{user:1}:profile") == ring.shard_for("{user:1}:history") # hash tags
+
+@pytest.fixture
+def sharded_redis(monkeypatch):
+    """A sharded backend over three in-memory fake redis servers, used by the cache modules."""
+    fakeredis = pytest.importorskip("fakeredis")
+    servers = [fakeredis.FakeServer() for _ in range(3)]
+    nodes = [f"node{i}" for i in range(3)]
+    client = ShardedRedis([fakeredis.FakeAsyncRedis(server=server, decode_responses=True) for server in servers], nodes)
+    binary_client = ShardedRedis([fakeredis.FakeAsyncRedis(server=server) for server in servers], nodes)
+    from src.utils import coalesce_requests, local_cache as local_cache_module, ttl_policy
+    for module in (cache_response, coalesce_requests, local_cache_module, query_cache, ttl_policy, vector_cache):
+        if hasattr(module, "redis_client"):
+            monkeypatch.setattr(module, "redis_client", client)
+        if hasattr(module, "redis_binary_client"):
+            monkeypatch.setattr(module, "redis_binary_client", binary_client)
+    local_cache.clear()
+    yield binary_client
+    local_cache.clear()
+
+def test_batch_lookups_are_pipelined_per_shard(monkeypatch, sharded_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    queries = keys(30)
+
+    async def run():
+        await cache_response.write_cache_entries([CacheWrite(query, f"answer {i}", ttl=60) for i, query in enumerate(queries)])
+        local_cache.clear()
+        per_shard = [len([key async for key in client.scan_iter()]) for client in sharded_redis.clients]
+        return per_shard, await query_cache.query_exact_match_many(queries + ["not cached"])
+
+    per_shard, hits = asyncio.run(run())
+    assert sum(per_shard) == 30 and all(count > 0 for count in per_shard)
+    assert [hit.response if hit else None for hit in hits] == [f"answer {i}" for i in range(30)] + [None]
+
+def test_vector_index_is_loaded_from_every_shard(sharded_redis, stub_embedder):
+    from src.utils.get_embeddings import embed_batch
+    questions = ["How tall is Mount Everest?", "Who painted the Mona Lisa?", "What is the boiling point of water?"]
+
+    async def run():
+        writer = vector_cache.VectorCache()
+        await writer.add_many([(question, f"answer to {question}", embedding, 60) for question, embedding in zip(questions, embed_batch(questions))])
+        await writer.close()
+        reader = vector_cache.VectorCache()
+        await reader.ensure_loaded()
+        results = await reader.search_many(embed_batch(questions), similarity_threshold=0.9)
+        await reader.close()
+        return results
+
+    assert asyncio.run(run()) == [f"answer to {question}" for question in questions]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def redis_servers():
+    """Throwaway redis-server processes, for testing the backends against real nodes."""
+    if shutil.which("redis-server") is None:
+        pytest.skip("redis-server isn't installed")
+    ports = [free_port() for _ in range(3)]
+    processes = [
+        subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"], stdout=subprocess.DEVNULL)
+        for port in ports
+    ]
+    deadline = time.monotonic() + 5
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+    yield ports
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+def test_sharded_backend_against_redis_servers(monkeypatch, redis_servers):
+    monkeypatch.setenv("CACHE_BACKEND", "sharded")
+    monkeypatch.setenv("REDIS_NODES", ",".join(f"127.0.0.1:{port}" for port in redis_servers))
+
+    async def run():
+        client, pools = redis_client.create_client()
+        async with client.pipeline() as pipe:
+            for key in keys(100):
+                pipe.set(key, key.upper())
+            await pipe.execute()
+        async with client.pipeline() as pipe:
+            for key in keys(100):
+                pipe.get(key)
+            values = await pipe.execute()
+        sizes = [await node.dbsize() for node in client.clients]
+        await client.aclose()
+        for pool in pools:
+            await pool.disconnect()
+        return values, sizes
+
+    values, sizes = asyncio.run(run())
+    assert values == [key.upper() for key in keys(100)]
+    assert sum(sizes) == 100 and all(size > 0 for size in sizes)
@@ -0,0 +1,99 @@
+import json
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+from src import server
+from src.utils import query_llm
+from src.utils.query_cache import CacheHit
+
+class FakeStream:
+    def __init__(self, deltas: list[str], fail_after: int | None = None):
+        self.deltas = deltas
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i, delta in enumerate(self.deltas):
+            if i == self.fail_after:
+                raise ConnectionError("stream interrupted")
+            yield SimpleNamespace(type="response.output_text.delta", delta=delta)
+        yield SimpleNamespace(type="response.completed", response="<response>")
+
+def use_fake_llm(monkeypatch, stream: FakeStream) -> list[tuple[str, str]]:
+    async def create(**kwargs):
+        assert kwargs["stream"] is True
+        return stream
+    monkeypatch.setattr(query_llm, "client", SimpleNamespace(responses=SimpleNamespace(create=create)))
+
+    cached = []
+    async def fake_cache_response(query: str, response_text: str, **metadata) -> bool:
+        cached.append((query, response_text))
+        return True
+    monkeypatch.setattr(query_llm, "cache_response", fake_cache_response)
+    return cached
+
+def read_events(response) -> list[tuple[str, dict]]:
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return events
+
+def test_llm_stream_is_forwarded_and_cached_on_completion(monkeypatch):
+    async def miss(query: str, timing: dict | None = None):
+        return None
+    monkeypatch.setattr(server, "query_cache", miss)
+    cached = use_fake_llm(monkeypatch, FakeStream(["Par", "is"]))
+
+    response = TestClient(server.app).post("/api/query/stream", json={"query": "Capital of France?"})
+    events = read_events(response)
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert [data["delta"] for event, data in events if event == "message"] == ["Par", "is"]
+    event, metadata = events[-1]
+    assert event == "done" and metadata["source"] == "llm"
+    assert metadata["timing"]["time_to_first_byte"] <= metadata["timing"]["total"]
+    assert cached == [("Capital of France?", "Paris")]
+
+def test_interrupted_stream_is_not_cached(monkeypatch):
+    async def miss(query: str, timing: dict | None = None):
+        return None
+    monkeypatch.setattr(server, "query_cache", miss)
+    cached = use_fake_llm(monkeypatch, FakeStream(["Par", "is"], fail_after=1))
+
+    events = read_events(TestClient(server.app).post("/api/query/stream", json={"query": "Capital of France?"}))
+
+    assert [event for event, _ in events] == ["message", "error", "done"]
+    assert events[-1][1]["source"] == "error"
+    assert cached == []
+
+def test_cache_hits_are_streamed_in_chunks(monkeypatch):
+    async def hit(query: str, timing: dict | None = None):
+        return CacheHit("x" * 150, "cache_l2")
+    monkeypatch.setattr(server, "query_cache", hit)
+    monkeypatch.setenv("STREAM_CHUNK_SIZE", "64")
+
+    events = read_events(TestClient(server.app).post("/api/query/stream", json={"query": "anything"}))
+
+    assert [len(data["delta"]) for event, data in events if event == "message"] == [64, 64, 22]
+    assert events[-1][1]["source"] == "cache_l2"
+
+def test_the_scheduler_slot_is_held_until_the_stream_is_consumed_or_closed(monkeypatch):
+    import asyncio
+    from src.utils.upstream_scheduler import UpstreamScheduler
+    scheduler = UpstreamScheduler(requests_per_minute=10_000, tokens_per_minute=1_000_000, max_concurrency=1)
+    monkeypatch.setattr(query_llm, "upstream_scheduler", scheduler)
+    use_fake_llm(monkeypatch, FakeStream(["Par", "is"]))
+
+    async def run():
+        in_flight = []
+        async for _ in query_llm.stream_llm("Capital of France?"):
+            in_flight.append(scheduler.in_flight)
+        in_flight.append(scheduler.in_flight)
+
+        abandoned = query_llm.stream_llm("Capital of France?")
+        await abandoned.__anext__()
+        in_flight.append(scheduler.in_flight)
+        await abandoned.aclose()
+        in_flight.append(scheduler.in_flight)
+        return in_flight
+
+    assert asyncio.run(run()) == [1, 1, 0, 1, 0]
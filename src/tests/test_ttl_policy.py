@@ -0,0 +1,125 @@
+import asyncio
+import json
+from src.utils import ttl_policy
+from src.utils.cache_response import write_cache_entries
+from src.utils.cache_writer import CacheWrite
+from src.utils.cache_key import cache_key
+from src.utils.local_cache import local_cache
+from src.utils.query_cache import query_exact_match
+from src.utils.ttl_policy import KeywordTTLPolicy, DEFAULT_CATEGORIES, DEFAULT_TTL, load_categories
+
+def test_queries_are_classified_by_time_sensitivity():
+    policy = KeywordTTLPolicy(DEFAULT_CATEGORIES)
+    categories = {
+        "What's the current time in London?": "clock",
+        "What's the weather like in New York right now?": "realtime",
+        "What's the current price of Bitcoin?": "realtime",
+        "What's the latest news about the Mars rover?": "daily",
+        "Any upcoming concerts this week?": "weekly",
+        "What's the latest iPhone model?": "recent",
+        "What is the chemical formula for water?": None,
+        "Explain the theory of relativity": None,
+    }
+    for query, expected in categories.items():
+        category = policy.classify(query)
+        assert (category.name if category else None) == expected, query
+    assert policy.ttl("What's the current time in Tokyo?") == 0
+    assert policy.ttl("How do I make a perfect omelette?") == DEFAULT_TTL
+
+def test_evergreen_and_historical_questions_about_volatile_topics():
+    policy = KeywordTTLPolicy(DEFAULT_CATEGORIES)
+    evergreen = [
+        "How does the stock market work?",
+        "How are stock prices determined?",
+        "How long do cats live?",
+        "Who was the president of the United States in 1990?",
+        "What was the population of Rome in 100 AD?",
+        "What was the final score of the 1966 World Cup final?",
+        "How do exchange rates work?",
+        "How much is 2+2?",
+    ]
+    for query in evergreen:
+        assert policy.classify(query) is None, query
+    # The same topics, asked about their present value
+    assert policy.classify("How is the stock market doing today?").name == "realtime"
+    assert policy.classify("What's the score of the Lakers game?").name == "realtime"
+    assert policy.classify("Who is the president of France?").name == "recent"
+    assert policy.classify("What's the population of Tokyo?").name == "recent"
+
+def test_only_clock_questions_are_never_cached():
+    policy = KeywordTTLPolicy(DEFAULT_CATEGORIES)
+    for query in ["What time is it in Tokyo?", "What's the date today?", "What is the time?", "Tell me the current date"]:
+        assert policy.classify(query).name == "clock", query
+    evergreen = [
+        "What is the time complexity of quicksort?",
+        "What is the date of the Battle of Hastings?",
+        "What is the time difference between London and Tokyo?",
+        "How do I get the current date in Python?",
+    ]
+    for query in evergreen:
+        assert policy.classify(query) is None, query
+
+def test_prices_current_and_offices_need_a_present_value_cue():
+    policy = KeywordTTLPolicy(DEFAULT_CATEGORIES)
+    evergreen = [
+        "What is the price of freedom?",
+        "How much does it cost to build a house?",
+        "What is current in a circuit?",
+        "How does current flow through a wire?",
+        "Who is the king of pop?",
+        "Which city is now known as Istanbul?",
+    ]
+    for query in evergreen:
+        assert policy.classify(query) is None, query
+    assert policy.classify("What's the latest price of eggs?").name == "daily"
+    assert policy.classify("How much does an iPhone cost these days?").name == "daily"
+    assert policy.classify("Who is the current king of Spain?").name == "recent"
+    assert policy.classify("Who is the CEO of Twitter now?").name == "recent"
+
+def test_categories_can_be_overridden(tmp_path):
+    config = tmp_path / "ttl.json"
+    config.write_text(json.dumps({
+        "default_ttl": 1000,
+        "categories": [{"name": "daily", "ttl": 50}, {"name": "sports", "ttl": 30, "patterns": [r"\bmatch\b"]}],
+    }))
+    policy = KeywordTTLPolicy(*load_categories(str(config)))
+    assert policy.ttl("Latest news today") == 50
+    assert policy.ttl("Who won the match?") == 30
+    assert policy.ttl("Explain how a camera works") == 1000
+
+def test_changed_answers_shorten_the_ttl(monkeypatch, fake_redis):
+    monkeypatch.setenv("TTL_ADAPTIVE", "TRUE")
+
+    async def run():
+        await write_cache_entries([CacheWrite("Who is the CEO of Acme?", "Alice", ttl=1000)])
+        await write_cache_entries([CacheWrite("Who is the CEO of Acme?", "Alice", ttl=1000)]) # same answer: unchanged
+        unchanged_ttl = await fake_redis.ttl(cache_key("Who is the CEO of Acme?"))
+        await write_cache_entries([CacheWrite("Who is the CEO of Acme?", "Bob", ttl=1000)])
+        changed_ttl = await fake_redis.ttl(cache_key("Who is the CEO of Acme?"))
+        await write_cache_entries([CacheWrite("Who is the CEO of Acme?", "Bob", ttl=1000)]) # later writes stay shortened
+        later_ttl = await fake_redis.ttl(cache_key("Who is the CEO of Acme?"))
+        return unchanged_ttl, changed_ttl, later_ttl
+
+    unchanged_ttl, changed_ttl, later_ttl = asyncio.run(run())
+    assert unchanged_ttl == 1000
+    assert changed_ttl == 500 and later_ttl == 500
+
+def test_hits_extend_the_ttl(monkeypatch, fake_redis):
+    monkeypatch.setenv("TTL_ADAPTIVE", "TRUE")
+    monkeypatch.setattr(ttl_policy, "ttl_policy", ttl_policy.FixedTTLPolicy(1000))
+    query = "Explain how a light bulb works"
+
+    async def run():
+        await fake_redis.set(cache_key(query), "Electricity heats a filament", ex=100)
+        ttls = []
+        for _ in range(8):
+            local_cache.clear() # so that the lookup reaches redis
+            assert await query_exact_match(query) is not None
+            await asyncio.gather(*ttl_policy._extension_tasks)
+            ttls.append(await fake_redis.ttl(cache_key(query)))
+        return ttls
+
+    # Each hit adds a quarter of the base TTL, up to twice the base TTL
+    ttls = asyncio.run(run())
+    expected = [350, 600, 850, 1100, 1350, 1600, 1850, 2000]
+    assert all(abs(ttl - expected_ttl) <= 1 for ttl, expected_ttl in zip(ttls, expected)), ttls
@@ -0,0 +1,115 @@
+import asyncio
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from src.utils.upstream_scheduler import UpstreamScheduler, TokenBucket, INTERACTIVE, BACKGROUND
+from src.utils import query_llm
+from tests.fake_openai import server as fake_openai
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.time_until_available(60) == 0
+    bucket.consume(60)
+    assert 0.9 < bucket.time_until_available(1) <= 1.0
+    bucket.rate_factor = 0.5
+    assert 1.9 < bucket.time_until_available(1) <= 2.0
+
+def test_concurrency_cap_and_priority_order():
+    order = []
+
+    async def call(scheduler: UpstreamScheduler, name: str, priority: int):
+        async with scheduler.slot(priority):
+            order.append(name)
+            assert scheduler.in_flight <= 1
+            await asyncio.sleep(0.01)
+
+    async def run():
+        scheduler = UpstreamScheduler(requests_per_minute=10_000, tokens_per_minute=10_000, max_concurrency=1)
+        first = asyncio.create_task(call(scheduler, "first", BACKGROUND))
+        await asyncio.sleep(0) # "first" takes the only slot
+        await asyncio.gather(
+            first,
+            call(scheduler, "background", BACKGROUND),
+            call(scheduler, "interactive", INTERACTIVE),
+        )
+
+    asyncio.run(run())
+    assert order == ["first", "interactive", "background"]
+
+def test_request_rate_limit_delays_calls():
+    async def run() -> float:
+        scheduler = UpstreamScheduler(requests_per_minute=600, tokens_per_minute=1_000_000, max_concurrency=100)
+        scheduler.requests.tokens = 0 # start with an empty bucket: 10 requests/second
+        start = asyncio.get_running_loop().time()
+        waits = []
+        async def call():
+            async with scheduler.slot() as queue_wait:
+                waits.append(queue_wait)
+        await asyncio.gather(*(call() for _ in range(3)))
+        return asyncio.get_running_loop().time() - start
+
+    assert 0.25 < asyncio.run(run()) < 1.0
+
+def test_throttled_calls_are_retried_after_retry_after(monkeypatch):
+    # The fake API allows 2 requests per 0.5s window, and answers 429 with a Retry-After until the window resets
+    limiter = fake_openai.FixedWindowLimiter(requests_per_window=2, window_seconds=0.5)
+    monkeypatch.setattr(fake_openai, "limiter", limiter)
+    monkeypatch.setattr(query_llm, "client", AsyncOpenAI(
+        api_key="fake",
+        base_url="http://fake-openai/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_openai.app)),
+    ))
+    scheduler = UpstreamScheduler(requests_per_minute=10_000, tokens_per_minute=1_000_000, max_concurrency=10)
+    monkeypatch.setattr(query_llm, "upstream_scheduler", scheduler)
+    async def no_caching(query: str, response_text: str, **metadata) -> bool:
+        return False
+    monkeypatch.setattr(query_llm, "cache_response", no_caching)
+
+    async def run():
+        timings = [{} for _ in range(3)]
+        responses = await asyncio.gather(*(query_llm.query_llm(f"question {i}", timing) for i, timing in enumerate(timings)))
+        return responses, timings
+
+    responses, timings = asyncio.run(run())
+    assert responses == [f"This is a fake answer to: question {i}" for i in range(3)]
+    assert limiter.throttled >= 1 and scheduler.throttled == limiter.throttled
+    assert scheduler.requests.rate_factor < 1.0
+    assert max(timing["upstream_queue_wait"] for timing in timings) > 0.05 # the retry waited for the Retry-After pause
+
+def test_failed_llm_calls_are_raised(monkeypatch):
+    from types import SimpleNamespace
+    async def create(**kwargs):
+        raise ValueError("invalid request")
+    monkeypatch.setattr(query_llm, "client", SimpleNamespace(responses=SimpleNamespace(create=create)))
+
+    # Rather than returning an error message as if it was the answer
+    with pytest.raises(ValueError):
+        asyncio.run(query_llm.query_llm("question"))
+
+def test_the_slot_is_given_back_while_waiting_for_retry_after(monkeypatch):
+    import openai
+    from src.utils.upstream_scheduler import call_with_retries
+    scheduler = UpstreamScheduler(requests_per_minute=10_000, tokens_per_minute=1_000_000, max_concurrency=1)
+    request = httpx.Request("POST", "http://fake-openai/v1/responses")
+    unavailable = openai.InternalServerError(
+        "unavailable", response=httpx.Response(503, headers={"retry-after": "0.2"}, request=request), body=None,
+    )
+    attempts = []
+    async def flaky() -> str:
+        attempts.append("flaky")
+        if len(attempts) == 1:
+            raise unavailable
+        return "ok"
+    async def other() -> str:
+        attempts.append("other")
+        return "ok"
+
+    async def run():
+        first = asyncio.create_task(call_with_retries(scheduler, flaky))
+        await asyncio.sleep(0.05) # "flaky" is waiting for its Retry-After
+        await asyncio.wait_for(call_with_retries(scheduler, other), timeout=0.1)
+        await first
+
+    asyncio.run(run())
+    assert attempts == ["flaky", "other", "flaky"]
@@ -0,0 +1,107 @@
+import asyncio
+import numpy as np
+from src.utils.cache_response import cache_response, cache_writer
+from src.utils.query_cache import query_cache, CacheHit
+from src.utils.vector_cache import VectorCache
+
+def test_semantic_hits_and_misses(monkeypatch, fake_redis, stub_embedder):
+    monkeypatch.setenv("CACHING_STRATEGY", "vector_embedding")
+    monkeypatch.setenv("SIMILARITY_THRESHOLD", "0.8")
+    from src.utils import cache_response as cache_response_module, query_cache as query_cache_module
+    cache = VectorCache()
+    monkeypatch.setattr(cache_response_module, "vector_cache", cache)
+    monkeypatch.setattr(query_cache_module, "vector_cache", cache)
+
+    async def run():
+        await cache_response("What is the capital of France?", "Paris")
+        await cache_writer.flush()
+        results = (
+            await query_cache("what is the capital of france"),
+            await query_cache("How do volcanoes form?"),
+        )
+        await cache.close()
+        return results
+
+    similar, unrelated = asyncio.run(run())
+    assert similar == CacheHit("Paris", "cache_l2")
+    assert unrelated is None
+
+def test_index_is_rebuilt_from_redis(fake_redis, stub_embedder):
+    from src.utils.get_embeddings import embed_batch
+
+    async def run():
+        writer = VectorCache()
+        await writer.add("How tall is Mount Everest?", "8,849 m", embed_batch(["How tall is Mount Everest?"])[0], ttl=60)
+        await writer.close()
+
+        # A second worker starting up loads the entry from redis
+        reader = VectorCache()
+        await reader.ensure_loaded()
+        result = await reader.search(embed_batch(["how tall is mount everest"])[0], similarity_threshold=0.9)
+        await reader.close()
+        return len(reader.index), result
+
+    assert asyncio.run(run()) == (1, "8,849 m")
+
+def test_search_many(fake_redis, stub_embedder):
+    from src.utils.get_embeddings import embed_batch
+
+    async def run():
+        cache = VectorCache()
+        await cache.add_many([
+            ("How tall is Mount Everest?", "8,849 m", embed_batch(["How tall is Mount Everest?"])[0], 60),
+            ("What is the capital of France?", "Paris", embed_batch(["What is the capital of France?"])[0], 60),
+        ])
+        results = await cache.search_many(
+            embed_batch(["what is the capital of france", "How do volcanoes form?", "how tall is mount everest"]),
+            similarity_threshold=0.8,
+        )
+        await cache.close()
+        return results
+
+    assert asyncio.run(run()) == ["Paris", None, "8,849 m"]
+
+def test_index_is_opened_from_a_snapshot_and_caught_up(tmp_path, monkeypatch, fake_redis, stub_embedder):
+    from src.utils.get_embeddings import embed_batch
+    monkeypatch.setenv("VECTOR_INDEX_SNAPSHOT", str(tmp_path))
+    monkeypatch.setenv("VECTOR_INDEX_NLIST", "2")
+    queries = [f"What is the population of city number {i}?" for i in range(40)]
+
+    def memory_mapped(cache: VectorCache) -> bool:
+        return any(isinstance(inverted_list.vectors, np.memmap) for inverted_list in cache.index._lists)
+
+    async def run():
+        writer = VectorCache()
+        await writer.add_many([
+            (query, f"About {i} thousand people.", embedding, 60) for i, (query, embedding) in enumerate(zip(queries, embed_batch(queries)))
+        ])
+        await writer.save_snapshot(str(tmp_path))
+        # Written after the snapshot, so only in the changelog
+        await writer.add("How tall is Mount Everest?", "8,849 m", embed_batch(["How tall is Mount Everest?"])[0], ttl=60)
+        await writer.close()
+
+        reader = VectorCache()
+        await reader.ensure_loaded()
+        results = await reader.search_many(embed_batch([queries[7], "how tall is mount everest"]), similarity_threshold=0.9)
+        opened = (len(reader.index), reader.index.is_trained, memory_mapped(reader))
+        await reader.close()
+
+        # Trimming the entries the snapshot already includes doesn't matter
+        await fake_redis.xtrim("vector_changelog", maxlen=1, approximate=False)
+        trimmed = VectorCache()
+        await trimmed.ensure_loaded()
+        reopened = memory_mapped(trimmed)
+        await trimmed.close()
+
+        # Once the changelog doesn't reach back to the snapshot anymore, the index is rebuilt from redis instead
+        await fake_redis.xtrim("vector_changelog", maxlen=0, approximate=False)
+        rebuilt = VectorCache()
+        await rebuilt.ensure_loaded()
+        await rebuilt.close()
+        return results, opened, reopened, (len(rebuilt.index), memory_mapped(rebuilt))
+
+    results, opened, reopened, rebuilt = asyncio.run(run())
+    assert results == ["About 7 thousand people.", "8,849 m"]
+    assert opened == (41, True, True)
+    assert reopened
+    assert rebuilt == (41, False)
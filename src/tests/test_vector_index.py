@@ -0,0 +1,81 @@
+import numpy as np
+from src.utils.vector_index import VectorIndex, train_centroids
+
+def random_unit_vectors(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def test_untrained_index_is_exact():
+    vectors = random_unit_vectors(200, 16)
+    index = VectorIndex(dim=16)
+    for i, vector in enumerate(vectors):
+        index.add(str(i), vector)
+
+    results = index.search(vectors[42], k=3)
+    assert results[0][0] == "42"
+    assert np.isclose(results[0][1], 1.0)
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+def test_remove_and_replace():
+    vectors = random_unit_vectors(10, 8)
+    index = VectorIndex(dim=8)
+    for i, vector in enumerate(vectors):
+        index.add(str(i), vector)
+
+    assert index.remove("3")
+    assert not index.remove("3")
+    assert "3" not in index and len(index) == 9
+    assert all(entry_id != "3" for entry_id, _ in index.search(vectors[3], k=10))
+
+    # Re-adding an id replaces its vector; the entry moved into the removed slot must still be found
+    index.add("0", vectors[5])
+    assert len(index) == 9
+    assert index.search(vectors[9], k=1)[0][0] == "9"
+
+def test_trained_index_finds_near_duplicates():
+    dim = 32
+    vectors = random_unit_vectors(4000, dim)
+    index = VectorIndex(dim=dim, nlist=32, nprobe=4, train_factor=16)
+    for i, vector in enumerate(vectors[:512]):
+        index.add(str(i), vector)
+    assert index.should_train()
+    index.set_centroids(train_centroids(index.sample(index.train_size), index.nlist))
+    for i, vector in enumerate(vectors[512:], start=512):
+        index.add(str(i), vector)
+    assert index.is_trained and len(index) == 4000
+
+    # A slightly perturbed copy of a stored vector should find the original
+    noise = random_unit_vectors(100, dim, seed=1) * 0.05
+    queries = vectors[:100] + noise
+    hits = sum(index.search(query, k=1)[0][0] == str(i) for i, query in enumerate(queries))
+    assert hits >= 95
+
+def assert_same_results(actual: list[tuple[str, float]], expected: list[tuple[str, float]]) -> None:
+    assert [entry_id for entry_id, _ in actual] == [entry_id for entry_id, _ in expected]
+    assert np.allclose([score for _, score in actual], [score for _, score in expected], atol=1e-5)
+
+def test_search_many_matches_search():
+    dim = 16
+    vectors = random_unit_vectors(1000, dim)
+    queries = random_unit_vectors(20, dim, seed=2)
+    index = VectorIndex(dim=dim, nlist=16, nprobe=3, train_factor=16)
+    for i, vector in enumerate(vectors):
+        index.add(str(i), vector)
+    for query, results in zip(queries, index.search_many(queries, k=3)):
+        assert_same_results(results, index.search(query, k=3))
+
+    # Once trained, each query must only see the lists it probes
+    index.set_centroids(train_centroids(index.sample(index.train_size), index.nlist))
+    for query, results in zip(queries, index.search_many(queries, k=3)):
+        assert_same_results(results, index.search(query, k=3))
+
+def test_empty_lists_of_a_snapshot_can_grow():
+    vectors = random_unit_vectors(3, 8)
+    centroids = np.stack([vectors[0], -vectors[0]])
+    # Everything is in the first list, the second one is loaded empty
+    index = VectorIndex.from_arrays(centroids, vectors[:1], ["0"], [1, 0])
+    index.add("1", -vectors[0])
+    index.add("2", vectors[2])
+
+    assert len(index) == 3
+    assert index.search(-vectors[0], k=1)[0][0] == "1"
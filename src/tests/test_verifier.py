@@ -0,0 +1,64 @@
+import asyncio
+import time
+import pytest
+from src.utils import verifier
+from src.utils.get_embeddings import embed_batch
+from src.utils.vector_cache import VectorCache
+
+class StubCrossEncoder:
+    """Scores the (query, cached query) pairs it was told are duplicates 0.9, and everything else 0.1."""
+    def __init__(self, duplicates: set[tuple[str, str]], latency: float = 0.0):
+        self.duplicates = duplicates
+        self.latency = latency
+        self.calls: list[int] = [] # batch size of every predict call
+
+    def predict(self, pairs: list[tuple[str, str]]) -> list[float]:
+        self.calls.append(len(pairs))
+        time.sleep(self.latency)
+        return [0.9 if pair in self.duplicates else 0.1 for pair in pairs]
+
+@pytest.fixture
+def use_verifier(monkeypatch):
+    monkeypatch.setenv("VERIFIER", "TRUE")
+    monkeypatch.setenv("VERIFIER_MIN_SIMILARITY", "0.3")
+    monkeypatch.setattr(verifier, "_batcher", None)
+
+    def use(cross_encoder: StubCrossEncoder) -> StubCrossEncoder:
+        monkeypatch.setattr(verifier, "_cross_encoder", cross_encoder)
+        return cross_encoder
+    return use
+
+def test_verifier_decides_semantic_hits(fake_redis, stub_embedder, use_verifier):
+    cross_encoder = use_verifier(StubCrossEncoder({("What is the capital city of France?", "What is the capital of France?")}))
+
+    async def run():
+        cache = VectorCache()
+        queries = ["What is the capital of France?", "What is the meaning of life?"]
+        await cache.add_many([
+            (query, response, embedding, 60) for query, response, embedding in zip(queries, ["Paris", "42"], embed_batch(queries))
+        ])
+        lookups = ["What is the capital city of France?", "What is the meaning of death?"]
+        results = await cache.search_many(embed_batch(lookups), queries=lookups)
+        await cache.close()
+        return results
+
+    # The paraphrase is accepted and the near-identical but different question is rejected, whatever their cosine similarity
+    assert asyncio.run(run()) == ["Paris", None]
+    assert cross_encoder.calls == [4] # both candidates of both lookups were scored in one batch
+
+def test_verification_over_budget_is_a_miss(fake_redis, stub_embedder, use_verifier, monkeypatch):
+    use_verifier(StubCrossEncoder({("what is the capital of france", "What is the capital of France?")}, latency=0.2))
+    monkeypatch.setenv("VERIFIER_TIMEOUT_MS", "20")
+
+    async def run():
+        cache = VectorCache()
+        await cache.add("What is the capital of France?", "Paris", embed_batch(["What is the capital of France?"])[0], ttl=60)
+        start = time.perf_counter()
+        result = await cache.search(embed_batch(["what is the capital of france"])[0], query="what is the capital of france")
+        elapsed = time.perf_counter() - start
+        await cache.close()
+        return result, elapsed
+
+    result, elapsed = asyncio.run(run())
+    assert result is None and elapsed < 0.15
+    assert verifier.stats()["timeouts"] >= 1
@@ -0,0 +1,58 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from fastapi.testclient import TestClient
+from src import server
+from src.utils import warm_up as warm_up_module
+from src.utils.vector_cache import VectorCache
+
+def test_importing_the_server_doesnt_load_strategy_components():
+    loaded = subprocess.run(
+        [sys.executable, "-c", "import sys, src.server; print(sorted({'openai', 'sentence_transformers'} & set(sys.modules)))"],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    assert loaded == "[]"
+
+def test_ready_once_the_strategy_is_warmed_up(monkeypatch, fake_redis, stub_embedder):
+    monkeypatch.setenv("CACHING_STRATEGY", "vector_embedding")
+    monkeypatch.setattr(warm_up_module, "vector_cache", VectorCache())
+    release = threading.Event()
+    async def slow_llm_client():
+        await asyncio.to_thread(release.wait)
+    monkeypatch.setattr(warm_up_module, "load_llm_client", slow_llm_client)
+
+    with TestClient(server.app) as client:
+        warming = client.get("/ready")
+        release.set()
+        deadline = time.monotonic() + 5
+        while (ready := client.get("/ready")).status_code != 200 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    assert warming.status_code == 503 and "llm_client" in warming.json()["pending"]
+    assert ready.status_code == 200
+    assert set(ready.json()["durations"]) == {"llm_client", "redis", "vector_index", "embedding_model"}
+    assert stub_embedder.calls == [1] # the model was loaded and run once, before any request needed it
+
+def test_components_that_fail_to_load_are_retried(monkeypatch, fake_redis):
+    monkeypatch.setenv("CACHING_STRATEGY", "exact_match_only")
+    monkeypatch.setenv("WARM_UP_RETRY_DELAY", "0.01")
+    warm_up = warm_up_module.WarmUp()
+    failures, statuses = [ConnectionError("connection refused")] * 2, []
+    async def flaky_llm_client():
+        statuses.append(warm_up.status())
+        if failures:
+            raise failures.pop()
+    monkeypatch.setattr(warm_up_module, "load_llm_client", flaky_llm_client)
+
+    async def run():
+        warm_up.start()
+        await warm_up.wait()
+        return warm_up.status()
+
+    ready = asyncio.run(run())
+    # Unready, with the error reported, while it's retried
+    assert not statuses[-1]["ready"] and statuses[-1]["errors"] == {"llm_client": "connection refused"}
+    assert "llm_client" in statuses[-1]["pending"]
+    assert ready["ready"] and ready["errors"] == {} and ready["attempts"]["llm_client"] == 3
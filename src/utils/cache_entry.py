@@ -0,0 +1,233 @@
+"""
+The binary format of cached responses in redis.
+
+LLM answers are verbose and redis memory is the scaling limit, so cache values are compact binary entries rather than raw
+response strings. Version 1 of the format is:
+* a 0xff byte (which never starts a UTF-8 string, so entries can't be mistaken for legacy plain strings), the version and
+  the compression
+* the id of the compression dictionary, if one was used (4 bytes)
+* as varints: the creation time (in seconds), the input and output token counts, the embedding dimension, and the lengths
+  of the model name and the query
+* the optional float32 query embedding
+* the model name, the query and the response (UTF-8), compressed together
+Entries are typically a few hundred bytes, so the framing is kept to a minimum: no fixed-width fields, and raw deflate
+or magic-less zstd frames without checksums.
+
+Values written before this format existed are plain UTF-8 response strings; `decode_entry` reads them transparently.
+
+Short texts compress poorly on their own (most answers come out of zstd bigger than the legacy plain strings), so
+compression uses a shared dictionary trained on past responses (see `train_dictionary` and
+`src/evaluations/measure_cache_entry_size.py`). One trained on `past_queries.csv` is bundled (`cache_dictionary.bin`) and
+used by default; without a dictionary, compression is off unless CACHE_COMPRESSION asks for it. Entries record which
+dictionary they were compressed with, and an entry compressed with a dictionary that isn't loaded is treated as a cache miss.
+Entries that compression wouldn't shrink are stored uncompressed.
+
+Configuration (all optional):
+* CACHE_COMPRESSION: "zstd" (needs the zstandard package), "zlib" or "none". Defaults to zstd if it is installed (zlib
+  otherwise) when there is a dictionary, and to none without one
+* CACHE_COMPRESSION_LEVEL: defaults to 3 for zstd and 6 for zlib
+* CACHE_COMPRESSION_DICTIONARY: path of a dictionary file, defaults to the bundled one; "none" to compress without a dictionary
+"""
+import hashlib
+import os
+import struct
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = 0xff
+VERSION = 1
+DICTIONARY_ID = struct.Struct("<I")
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+HAS_DICTIONARY = 0x80 # flag on the compression byte
+COMPRESSIONS = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+MIN_COMPRESSED_SIZE = 32 # below this, compressing costs more bytes than it saves
+ZLIB_WBITS = -15 # raw deflate: no zlib header or checksum
+BUNDLED_DICTIONARY = os.path.join(os.path.dirname(__file__), "cache_dictionary.bin")
+
+@dataclass
+class CacheEntry:
+    response: str
+    query: str | None = None
+    created_at: float | None = None
+    model: str | None = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    embedding: np.ndarray | None = None
+
+class CompressionDictionary:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.id = int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), "little") or 1 # 0 means no dictionary
+        self._zstd = zstandard.ZstdCompressionDict(data) if zstandard is not None else None
+
+class EntryCodec:
+    def __init__(self, compression: str, level: int | None = None, dictionary: CompressionDictionary | None = None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression: {compression}. Expected one of {list(COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd cache compression needs the zstandard package")
+        self.compression = COMPRESSIONS[compression]
+        self.level = level if level is not None else (3 if self.compression == COMPRESSION_ZSTD else 6)
+        self.dictionary = dictionary
+        # zstd contexts are reusable (and much cheaper to reuse than to create), but not thread-safe: the codec is only used on the event loop
+        if zstandard is not None:
+            zstd_dictionary = dictionary._zstd if dictionary is not None else None
+            if self.compression == COMPRESSION_ZSTD:
+                self._zstd_compressor = zstandard.ZstdCompressor(dict_data=zstd_dictionary, compression_params=zstandard.ZstdCompressionParameters.from_level(
+                    self.level, format=zstandard.FORMAT_ZSTD1_MAGICLESS, write_content_size=1, write_checksum=0, write_dict_id=0,
+                ))
+            self._zstd_decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dictionary, format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+
+    def encode(self, entry: CacheEntry) -> bytes:
+        model = (entry.model or "").encode()
+        query = (entry.query or "").encode()
+        payload = model + query + entry.response.encode()
+        compression = self.compression if len(payload) >= MIN_COMPRESSED_SIZE else COMPRESSION_NONE
+        use_dictionary = self.dictionary is not None and compression != COMPRESSION_NONE
+        if compression == COMPRESSION_ZLIB:
+            compressor = zlib.compressobj(self.level, wbits=ZLIB_WBITS, **({"zdict": self.dictionary.data} if use_dictionary else {}))
+            compressed = compressor.compress(payload) + compressor.flush()
+        elif compression == COMPRESSION_ZSTD:
+            compressed = self._zstd_compressor.compress(payload)
+        # Short texts can come out of the compressor bigger than they went in (plus the dictionary id): those are stored as is
+        if compression != COMPRESSION_NONE:
+            if len(compressed) + (DICTIONARY_ID.size if use_dictionary else 0) < len(payload):
+                payload = compressed
+            else:
+                compression, use_dictionary = COMPRESSION_NONE, False
+
+        embedding = np.asarray(entry.embedding, dtype=np.float32).tobytes() if entry.embedding is not None else b""
+        header = bytearray((MAGIC, VERSION, compression | (HAS_DICTIONARY if use_dictionary else 0)))
+        if use_dictionary:
+            header += DICTIONARY_ID.pack(self.dictionary.id)
+        created_at = entry.created_at if entry.created_at is not None else time.time()
+        for value in (int(created_at), entry.input_tokens, entry.output_tokens, len(embedding) // 4, len(model), len(query)):
+            _write_varint(header, value)
+        return b"".join((header, embedding, payload))
+
+    def decode(self, raw: bytes | str) -> CacheEntry | None:
+        """Decodes a cache value, which may be a legacy plain string. Returns None if it can't be decoded."""
+        if isinstance(raw, str):
+            return CacheEntry(response=raw)
+        if not raw or raw[0] != MAGIC:
+            return CacheEntry(response=raw.decode())
+
+        version, flags = raw[1], raw[2]
+        if version != VERSION:
+            print(f"Error decoding a cache entry: unsupported version {version}")
+            return None
+        compression = flags & ~HAS_DICTIONARY
+        offset = 3
+        if flags & HAS_DICTIONARY:
+            (dictionary_id,) = DICTIONARY_ID.unpack_from(raw, offset)
+            offset += DICTIONARY_ID.size
+            if self.dictionary is None or self.dictionary.id != dictionary_id:
+                print(f"Error decoding a cache entry: it was compressed with dictionary {dictionary_id}, which isn't loaded")
+                return None
+        values = []
+        for _ in range(6):
+            value, offset = _read_varint(raw, offset)
+            values.append(value)
+        created_at, input_tokens, output_tokens, dim, model_length, query_length = values
+        embedding = np.frombuffer(raw, dtype=np.float32, count=dim, offset=offset).copy() if dim else None
+        offset += dim * 4
+
+        payload = raw[offset:]
+        if compression == COMPRESSION_ZLIB:
+            decompressor = zlib.decompressobj(wbits=ZLIB_WBITS, **({"zdict": self.dictionary.data} if flags & HAS_DICTIONARY else {}))
+            payload = decompressor.decompress(payload) + decompressor.flush()
+        elif compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                print("Error decoding a cache entry: it is zstd compressed, but the zstandard package isn't installed")
+                return None
+            payload = self._zstd_decompressor.decompress(payload)
+        return CacheEntry(
+            response=payload[model_length + query_length:].decode(),
+            query=payload[model_length:model_length + query_length].decode(),
+            created_at=float(created_at),
+            model=payload[:model_length].decode() or None,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            embedding=embedding,
+        )
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def _read_varint(raw: bytes, offset: int) -> tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = raw[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def train_dictionary(samples: list[bytes], size: int = 16 * 1024, compression: str = "zstd") -> bytes:
+    """
+    Builds a compression dictionary from sample payloads (model + query + response, as they are compressed).
+    zstd has a proper dictionary trainer, but it needs a fair number of samples; otherwise (and for zlib) the dictionary is
+    made of the substrings that occur in the most samples, weighted by length, with the most useful ones last since that's
+    where both zlib and zstd reach them most cheaply.
+    """
+    if compression == "zstd" and zstandard is not None:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass # too few samples
+
+    counts = Counter()
+    for sample in samples:
+        words = sample.split(b" ")
+        # Every run of 1 to 4 words, counted once per sample
+        counts.update({b" ".join(words[start:start + length]) for length in range(1, 5) for start in range(len(words) - length + 1)})
+    candidates = sorted(
+        (substring for substring, count in counts.items() if count > 1 and len(substring) > 3),
+        key=lambda substring: counts[substring] * len(substring),
+    )
+    dictionary, total = [], 0
+    for substring in reversed(candidates):
+        if total + len(substring) + 1 > size:
+            break
+        if any(substring in chosen for chosen in dictionary):
+            continue
+        dictionary.append(substring)
+        total += len(substring) + 1
+    return b" ".join(reversed(dictionary))
+
+def create_codec() -> EntryCodec:
+    dictionary_path = os.getenv("CACHE_COMPRESSION_DICTIONARY", BUNDLED_DICTIONARY)
+    dictionary = None
+    if dictionary_path and dictionary_path != "none":
+        with open(dictionary_path, "rb") as f:
+            dictionary = CompressionDictionary(f.read())
+    default_compression = ("zstd" if zstandard is not None else "zlib") if dictionary is not None else "none"
+    level = os.getenv("CACHE_COMPRESSION_LEVEL")
+    return EntryCodec(
+        os.getenv("CACHE_COMPRESSION", default_compression),
+        level=int(level) if level else None,
+        dictionary=dictionary,
+    )
+
+codec = create_codec()
+
+def encode_entry(entry: CacheEntry) -> bytes:
+    return codec.encode(entry)
+
+def decode_entry(raw: bytes | str) -> CacheEntry | None:
+    return codec.decode(raw)
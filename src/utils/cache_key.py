@@ -0,0 +1,58 @@
+"""
+The redis keys of the exact match cache, and the fingerprint the keys of the other stores are derived from.
+
+Keys are fixed-size digests rather than the query itself, so that multi-kilobyte prompts don't make multi-kilobyte redis
+keys: `cache:<namespace>:<digest>`, where the digest is a 128-bit BLAKE2b of the canonical query (NFC normalized, without
+surrounding whitespace) and of everything else the answer depends on: the model, the instructions and the generation
+parameters that `query_llm` uses. Changing any of them starts from an empty cache, instead of serving the answers of the
+previous model or prompt.
+
+The query itself is kept in the cache entry (see `cache_entry.py`), and lookups check it (`matches`), so that a digest
+collision is a miss rather than someone else's answer.
+
+Every key is prefixed with CACHE_NAMESPACE, so that a model upgrade (or any change of what the answers depend on) can be
+rolled out without flushing redis: workers on the new namespace don't see the old entries, which expire on their own.
+The L1 cache and the TTL adjustments (see `ttl_policy.py`) are keyed on the same keys, and the fuzzy and vector stores and
+request coalescing on the same `fingerprint` of their own canonical query: `fuzzy_cache:<namespace>:<digest>`,
+`vector_cache:<namespace>:<digest>` and `coalesce:*:<namespace>:<digest>`. Entries cached under raw query keys, before this
+scheme, are migrated by `src/scripts/migrate_cache_keys.py`.
+
+Configuration (all optional):
+* CACHE_NAMESPACE: defaults to "default"
+* LLM_MODEL: the model `query_llm` calls, defaults to "gpt-4o"
+"""
+import hashlib
+import json
+import os
+import unicodedata
+from src.utils.cache_entry import CacheEntry
+
+KEY_PREFIX = "cache:"
+LLM_INSTRUCTIONS = "You are a helpful assistant."
+LLM_PARAMETERS: dict = {} # generation parameters passed to the model on top of the defaults (eg: temperature)
+
+def llm_model() -> str:
+    return os.getenv("LLM_MODEL", "gpt-4o")
+
+def namespace() -> str:
+    return os.getenv("CACHE_NAMESPACE", "default")
+
+def canonical_query(query: str) -> str:
+    return unicodedata.normalize("NFC", query).strip()
+
+def fingerprint(text: str, cache_namespace: str | None = None) -> str:
+    """
+    `<namespace>:<digest>` of a (canonical) query and of what its answer depends on, in `cache_namespace` (defaults to
+    CACHE_NAMESPACE). Every store derives its keys from it, each from its own canonical form of the query.
+    """
+    answer_inputs = "\0".join((text, llm_model(), LLM_INSTRUCTIONS, json.dumps(LLM_PARAMETERS, sort_keys=True)))
+    digest = hashlib.blake2b(answer_inputs.encode(), digest_size=16).hexdigest()
+    return f"{cache_namespace or namespace()}:{digest}"
+
+def cache_key(query: str, cache_namespace: str | None = None) -> str:
+    """The redis key of the query's cache entry, in `cache_namespace` (defaults to CACHE_NAMESPACE)."""
+    return f"{KEY_PREFIX}{fingerprint(canonical_query(query), cache_namespace)}"
+
+def matches(entry: CacheEntry, query: str) -> bool:
+    """Whether a cache entry found at the query's key is for that query (entries that don't record their query are trusted)."""
+    return entry.query is None or canonical_query(entry.query) == canonical_query(query)
@@ -1,45 +1,128 @@
-from src.utils.redis_client import redis_client
+from src.utils.redis_client import redis_binary_client
+import asyncio
 import os
-# import uuid
-# from src.utils.get_embeddings import get_embedding
+from src.utils.get_embeddings import get_embedding
+from src.utils.vector_cache import vector_cache
+from src.utils.fuzzy_cache import fuzzy_cache
+from src.utils.query_cache import hybrid_stages
+from src.utils.local_cache import local_cache, invalidation_message, INVALIDATION_CHANNEL
+from src.utils.cache_writer import CacheWriter, CacheWrite
+from src.utils import ttl_policy, eviction, metrics
+from src.utils.refresh_ahead import refresher
+from src.utils.cache_entry import CacheEntry, encode_entry, decode_entry
+from src.utils.cache_key import cache_key
 
-def cache_response(query: str, response_text: str) -> bool:
+async def cache_response(query: str, response_text: str, model: str | None = None, input_tokens: int = 0, output_tokens: int = 0) -> bool:
+    """
+    Queues the response to be cached; the write itself happens in the background (see `cache_writer.py`).
+    The model and token counts are stored alongside the response (see `cache_entry.py`).
+    Returns False if the response won't be cached.
+    """
     if os.getenv("DISABLE_AUTO_CACHE") == "TRUE":
         return False
     
-    redis_client.set(query, response_text, ex=calculate_TTL(query))
-    return True
+    ttl = calculate_TTL(query)
+    if ttl <= 0: # too time-sensitive to be reused
+        return False
+    return await cache_writer.submit(CacheWrite(query, response_text, ttl, model, input_tokens, output_tokens))
+
+async def write_cache_entries(entries: list[CacheWrite]) -> None:
+    """Writes a batch of queued cache entries to the store(s) of the caching strategy, in one redis round-trip per store."""
+    encoded = [encode_entry(to_cache_entry(entry)) for entry in entries]
+    costs = [eviction.entry_cost(entry.query, entry.response_text, entry.input_tokens, entry.output_tokens) for entry in entries]
+    if eviction.is_enabled():
+        eviction.ensure_sweeper()
+        admitted = await eviction.admit([(len(cache_key(entry.query)) + len(value), cost) for entry, value, cost in zip(entries, encoded, costs)])
+        entries, encoded, costs = (
+            [item for item, admit in zip(items, admitted) if admit] for items in (entries, encoded, costs)
+        )
+        if not entries:
+            return
+    
+    strategy = os.getenv("CACHING_STRATEGY")
+    if strategy == "vector_embedding":
+        await write_vector_entries(entries)
+        return
+    if strategy == "fuzzy":
+        await write_fuzzy_entries(entries)
+        return
+    if strategy == "hybrid":
+        # Every store that a stage of the cascade looks up
+        stages = hybrid_stages()
+        writes = [write_exact_entries(entries, encoded, costs)]
+        if "normalized" in stages or "lexical" in stages:
+            writes.append(write_fuzzy_entries(entries))
+        if "semantic" in stages:
+            writes.append(write_vector_entries(entries))
+        await asyncio.gather(*writes)
+        return
+    await write_exact_entries(entries, encoded, costs)
+
+async def write_vector_entries(entries: list[CacheWrite]) -> None:
+    # The embeddings are requested concurrently so that they're computed as one batch
+    query_embeddings = await asyncio.gather(*(get_embedding(entry.query) for entry in entries))
+    await vector_cache.add_many([
+        (entry.query, to_cache_entry(entry), query_embedding, entry.ttl)
+        for entry, query_embedding in zip(entries, query_embeddings)
+    ])
+
+async def write_fuzzy_entries(entries: list[CacheWrite]) -> None:
+    # Keyed on the canonical query, and added to the local near-duplicate index as it's written
+    await fuzzy_cache.add_many([(entry.query, to_cache_entry(entry), entry.ttl) for entry in entries])
+
+async def write_exact_entries(entries: list[CacheWrite], encoded: list[bytes], costs: list[float]) -> None:
+    keys = [cache_key(entry.query) for entry in entries]
+    factors = await ttl_policy.get_adjustments([entry.query for entry in entries])
+    ttls = [max(1, int(entry.ttl * factor)) for entry, factor in zip(entries, factors)]
+    # Kept in redis until the hard TTL, to be served while they're refreshed (see `refresh_ahead.py`)
+    stale_ttl = ttl_policy.stale_ttl()
+    async with redis_binary_client.pipeline(transaction=False) as pipe:
+        for key, value, cost, ttl in zip(keys, encoded, costs, ttls):
+            # Also get the previous answer, to tell whether a refresh changed it
+            pipe.set(key, value, ex=ttl + stale_ttl, get=True)
+            # Other workers may hold an older copy of this entry in their L1
+            pipe.publish(INVALIDATION_CHANNEL, invalidation_message(key))
+            if eviction.is_enabled():
+                eviction.track(pipe, key, len(key) + len(value), cost)
+        previous_responses = (await pipe.execute())[::3 if eviction.is_enabled() else 2]
+    
+    if ttl_policy.is_adaptive():
+        # Answers that changed are likely to change again: cache them for less time from now on
+        changed = [
+            i for i, (entry, previous) in enumerate(zip(entries, previous_responses))
+            if previous is not None and (previous_entry := decode_entry(previous)) is not None and previous_entry.response != entry.response_text
+        ]
+        if changed:
+            async with redis_binary_client.pipeline(transaction=False) as pipe:
+                for i in changed:
+                    factor = ttl_policy.shortened_factor(factors[i])
+                    ttls[i] = max(1, int(entries[i].ttl * factor))
+                    pipe.hset(ttl_policy.ADJUSTMENTS_KEY, keys[i], factor)
+                    pipe.expire(keys[i], ttls[i] + stale_ttl)
+                await pipe.execute()
+    for key, entry, ttl in zip(keys, entries, ttls):
+        local_cache.set(key, entry.response_text, ttl=refresher.local_ttl(ttl, 0.0))
+
+def to_cache_entry(write: CacheWrite) -> CacheEntry:
+    return CacheEntry(
+        response=write.response_text,
+        query=write.query,
+        model=write.model,
+        input_tokens=write.input_tokens,
+        output_tokens=write.output_tokens,
+    )
 
 def calculate_TTL(query: str) -> int:
     """
-    Calculates how long a query should be cached for.
-    Returns number of seconds.
+    Calculates how long a query should be cached for, depending on how time-sensitive it is (see `ttl_policy.py`).
+    Returns number of seconds; 0 means the response shouldn't be cached.
     """
-    MAX_TTL = 60*60*24*30 # 1 month
-    # TODO: implement this. This is tricky. One approach is to look for specific sets of keywords (eg: "today", "this week", "current" etc) and use that to calculate a more specific TTL.
-    return MAX_TTL
-
-## I was trying to implement a vector embedding cache, but it's not working as expected. Some issue with syncing with redis.
-# def cache_response_with_vector_embedding(query: str, response_text: str) -> bool:
-#     if os.getenv("DISABLE_AUTO_CACHE") == "TRUE":
-#         return False
-#     # Get embedding for the query
-#     query_embedding = get_embedding(query)
-    
-#     # Create a unique ID for this cache entry
-#     cache_id = str(uuid.uuid4())
-    
-#     # Create a JSON object with query, response, and embedding
-#     cache_data = {
-#         "id": cache_id,
-#         "query": query,
-#         "response": response_text,
-#         "query_embedding": query_embedding
-#     }
-    
-#     # Store in Redis with vector_cache prefix and unique ID
-#     key = f"vector_cache:{cache_id}"
-#     redis_client.json().set(key, "$", cache_data)
-#     redis_client.expire(key, calculate_TTL(query))
-    
-#     return True
\ No newline at end of file
+    return ttl_policy.ttl_policy.ttl(query)
+
+cache_writer = CacheWriter(
+    write_cache_entries,
+    max_queue_size=int(os.getenv("CACHE_WRITE_QUEUE_SIZE", "1000")),
+    max_batch_size=int(os.getenv("CACHE_WRITE_BATCH_SIZE", "100")),
+    drop_policy=os.getenv("CACHE_WRITE_DROP_POLICY", "drop_newest"),
+)
+metrics.stage_latency["cache_write"] = cache_writer.write_latency
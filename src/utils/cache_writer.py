@@ -0,0 +1,136 @@
+"""
+A write-behind pipeline for cache population, so that an LLM miss returns its answer without waiting for the cache write
+(or for embedding the query, with the vector_embedding strategy).
+
+Writes are put on a bounded asyncio queue and a background task drains it, writing everything that has queued up as one
+batch (eg: one pipelined round-trip to redis). When redis is slow, the queue fills up and the drop policy decides what gives:
+* "drop_newest" (default): the new write is discarded; a cache write is always safe to lose
+* "drop_oldest": the oldest queued write is discarded to make room
+* "block": the caller waits for room, which pushes back on the request path
+
+`close()` flushes whatever is still queued, so a clean shutdown doesn't lose writes. The writer can be used again afterwards.
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from src.utils.histogram import Histogram
+
+DROP_POLICIES = ("drop_newest", "drop_oldest", "block")
+
+@dataclass
+class CacheWrite:
+    query: str
+    response_text: str
+    ttl: int
+    model: str | None = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+class CacheWriter:
+    def __init__(
+        self,
+        write_batch: Callable[[list[CacheWrite]], Awaitable[None]],
+        max_queue_size: int = 1000,
+        max_batch_size: int = 100,
+        drop_policy: str = "drop_newest",
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown cache write drop policy: {drop_policy}. Expected one of {DROP_POLICIES}")
+        self.write_batch = write_batch
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.drop_policy = drop_policy
+        self.write_latency = Histogram() # seconds per batch write
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: asyncio.Queue[CacheWrite] | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, write: CacheWrite) -> bool:
+        """Queues a write. Returns False if it was dropped."""
+        if self._closing:
+            self.dropped += 1
+            return False
+        self._ensure_started()
+
+        if self._queue.full():
+            match self.drop_policy:
+                case "drop_newest":
+                    self.dropped += 1
+                    return False
+                case "drop_oldest":
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.dropped += 1
+        await self._queue.put(write) # only waits with the "block" policy
+        self.enqueued += 1
+        return True
+
+    async def flush(self) -> None:
+        """Waits until every queued write has been written (or has failed)."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """
+        Stops accepting writes, flushes the queue (waiting at most `timeout` seconds) and stops the background task. Writes
+        submitted after it returns start a new task (eg: on the next lifespan of the server).
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out flushing the cache write queue, {self.queue_depth} writes were lost.")
+        finally:
+            self._closing = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "write_latency": self.write_latency.snapshot(),
+        }
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            pending = self._queue
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            # Carry over the writes the previous task (stopped, or on another event loop) didn't get to
+            while pending is not None and not pending.empty():
+                self._queue.put_nowait(pending.get_nowait())
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            # Take everything else that has queued up meanwhile, so that one round-trip writes all of it
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            start = time.perf_counter()
+            try:
+                await self.write_batch(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"Error writing {len(batch)} entries to the cache: {e}")
+            finally:
+                self.write_latency.observe(time.perf_counter() - start)
+                for _ in batch:
+                    self._queue.task_done()
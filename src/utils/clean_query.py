@@ -0,0 +1,72 @@
+import re
+import unicodedata
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+def clean_query(query: str) -> str:
+    """
+    Normalizes a query so that queries which only differ in case, punctuation or whitespace map to the same string.
+    Non-ASCII letters are kept (eg: "¿Cómo estás?" -> "cómo estás") so that queries in other languages don't collapse into each other.
+    """
+    # Convert to lowercase
+    cleaned_query = query.casefold()
+    
+    # Remove special characters, keeping only letters, digits and spaces
+    cleaned_query = _PUNCTUATION.sub('', cleaned_query)
+    
+    # Remove extra whitespace
+    cleaned_query = ' '.join(cleaned_query.split())
+    
+    return cleaned_query
+
+# Words that carry little meaning in a question. Negations, quantifiers and comparatives ("not", "most", "least", ...) are
+# deliberately kept, since they change the answer, and so are pronouns ("how old is he" vs "how old is she"), auxiliary
+# verbs, which carry the tense ("who was the president" vs "who is the president"), and the prepositions that give a
+# direction or a relation ("flights from paris to london" vs "flights to paris from london", "divided by" vs "divided into").
+STOP_WORDS = frozenset("""
+a an the of in on at for about as this that these those what which who whom how please tell there here some any just so then
+""".split())
+
+# Contractions are expanded, so that "what's" and "what is" keep the same auxiliary
+CONTRACTIONS = {
+    "whats": "what is", "whos": "who is", "hows": "how is", "wheres": "where is", "whens": "when is", "thats": "that is",
+    "theres": "there is", "hes": "he is", "shes": "she is", "im": "i am", "youre": "you are", "theyre": "they are",
+    "isnt": "is not", "arent": "are not", "wasnt": "was not", "werent": "were not", "dont": "do not",
+    "doesnt": "does not", "didnt": "did not", "cant": "can not", "cannot": "can not", "couldnt": "could not",
+    "wont": "will not", "wouldnt": "would not", "shouldnt": "should not", "havent": "have not", "hasnt": "has not",
+}
+
+# Auxiliaries are kept for their tense, but not for their person: "which countries are" and "which country is" are the same
+AUXILIARIES = {"are": "is", "am": "is", "were": "was", "does": "do", "has": "have"}
+
+_SEPARATORS = re.compile(r"[^\w\s]|_")
+
+def canonicalize_query(query: str, stem: bool = False) -> str:
+    """
+    A more aggressive normalization than `clean_query`, used as the key of the fuzzy caching strategy: also strips accents and
+    stop-words, splits words on punctuation (eg: "5-year-old" -> "5 year old") and optionally stems them.
+    eg: "¿Cómo se dice 'hello' en español?" -> "como se dice hello en espanol", "What's the meaning of life?" -> "is meaning life"
+    """
+    query = unicodedata.normalize("NFKD", query.casefold())
+    query = "".join(char for char in query if not unicodedata.combining(char))
+    # Apostrophes join words ("what's" -> "whats"), other punctuation separates them
+    query = query.replace("'", "").replace("’", "")
+    words = " ".join(CONTRACTIONS.get(word, word) for word in _SEPARATORS.sub(" ", query).split()).split()
+    content_words = [word for word in words if word not in STOP_WORDS] or words # a query made only of stop-words keeps them
+    content_words = [AUXILIARIES.get(word, word) for word in content_words]
+    if stem:
+        content_words = [stem_word(word) for word in content_words]
+    return " ".join(content_words)
+
+_SUFFIXES = (("ies", "y"), ("ing", ""), ("ed", ""), ("ly", ""), ("s", ""))
+
+def stem_word(word: str) -> str:
+    """A light suffix-stripping stemmer (eg: "countries" -> "country", "cooking" -> "cook"). Short words are left alone."""
+    if len(word) <= 4 or word.isdigit():
+        return word
+    for suffix, replacement in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            if suffix == "s" and word.endswith(("ss", "us", "is")): # "glass", "virus", "analysis"
+                return word
+            return word[:-len(suffix)] + replacement
+    return word
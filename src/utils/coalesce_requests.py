@@ -0,0 +1,128 @@
+"""
+Single-flight coalescing of identical LLM requests.
+
+When many copies of the same query miss the cache at the same time, only the first one (the leader) calls the LLM.
+Every concurrent copy (a follower) waits for the leader's result instead of making its own upstream call.
+
+Queries are keyed on the fingerprint of their normalized text (see `clean_query` and `cache_key.fingerprint`), so "What is X?"
+and "what is x" share one upstream call, but not across namespaces or models.
+
+The COALESCE_MODE environment variable controls the behaviour:
+* "local" (default): coalesce within this worker process only.
+* "redis": additionally coalesce across workers. The leader takes a redis lock, and the leaders of other workers subscribe
+  to a pub/sub channel and reuse the result that the lock holder publishes.
+* "off": every request calls the LLM itself.
+"""
+import asyncio
+import os
+import uuid
+from typing import Awaitable, Callable
+from src.utils.clean_query import clean_query
+from src.utils.cache_key import fingerprint
+from src.utils.redis_client import redis_client
+
+# Deletes the lock only if it is still held by us, so a leader that overran its lock timeout can't release someone else's lock
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Published instead of a result when the leader's call failed, so that the followers fail too rather than waiting it out
+FAILED_RESULT = "\0failed"
+
+_worker_id = uuid.uuid4().hex
+_in_flight: dict[str, asyncio.Task] = {}
+
+async def coalesce(query: str, func: Callable[[], Awaitable[str]]) -> tuple[str, bool]:
+    """
+    Runs `func` once for all concurrent callers with the same normalized query.
+    Returns the result and whether this caller was the leader (True) or reused another caller's result (False).
+    """
+    mode = os.getenv("COALESCE_MODE", "local")
+    if mode == "off":
+        return await func(), True
+
+    key = fingerprint(clean_query(query))
+    task = _in_flight.get(key)
+    is_leader = task is None
+    if is_leader:
+        if mode == "redis":
+            task = asyncio.ensure_future(_coalesce_across_workers(key, func))
+        else:
+            task = asyncio.ensure_future(_run_as_leader(func))
+        _in_flight[key] = task
+        task.add_done_callback(lambda finished_task: _forget(key, finished_task))
+
+    # The upstream call runs in its own task and is shielded, so that a cancelled caller (eg: a client disconnecting)
+    # doesn't cancel the call that every other caller is waiting on.
+    result, leader_in_any_worker = await asyncio.shield(task)
+    return result, is_leader and leader_in_any_worker
+
+async def _run_as_leader(func: Callable[[], Awaitable[str]]) -> tuple[str, bool]:
+    return await func(), True
+
+def _forget(key: str, finished_task: asyncio.Task) -> None:
+    if _in_flight.get(key) is finished_task:
+        del _in_flight[key]
+    if not finished_task.cancelled():
+        finished_task.exception() # mark the exception as retrieved, the callers re-raise it through the shield
+
+async def _coalesce_across_workers(key: str, func: Callable[[], Awaitable[str]]) -> tuple[str, bool]:
+    """
+    Coalesces across worker processes using a redis lock plus a pub/sub notification.
+    The lock holder calls the LLM and publishes the result. Everyone else waits for that result, and falls back to calling
+    the LLM itself if the lock holder doesn't publish before the lock times out (eg: because its worker crashed). If the
+    lock holder's call fails, it publishes FAILED_RESULT and everyone waiting raises.
+    """
+    lock_timeout_ms = int(os.getenv("COALESCE_LOCK_TIMEOUT_MS", "60000"))
+    lock_key = f"coalesce:lock:{key}"
+    result_key = f"coalesce:result:{key}"
+    channel = f"coalesce:done:{key}"
+
+    if await redis_client.set(lock_key, _worker_id, nx=True, px=lock_timeout_ms):
+        try:
+            try:
+                result = await func()
+            except Exception:
+                await _publish(result_key, channel, FAILED_RESULT, lock_timeout_ms)
+                raise
+            await _publish(result_key, channel, result, lock_timeout_ms)
+            return result, True
+        finally:
+            await redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, _worker_id)
+
+    result = await _wait_for_result(result_key, channel, lock_timeout_ms / 1000)
+    if result is None:
+        print("Coalescing leader did not publish a result in time, querying the LLM directly.")
+        return await func(), True
+    if result == FAILED_RESULT:
+        raise RuntimeError("The LLM call this request was coalesced with failed")
+    return result, False
+
+async def _publish(result_key: str, channel: str, result: str, ttl_ms: int) -> None:
+    async with redis_client.pipeline(transaction=False) as pipe:
+        # The result key covers followers that check in after the message has already been published
+        pipe.set(result_key, result, px=ttl_ms)
+        pipe.publish(channel, result)
+        await pipe.execute()
+
+async def _wait_for_result(result_key: str, channel: str, timeout: float) -> str | None:
+    pubsub = redis_client.pubsub()
+    try:
+        # Subscribe before checking the result key, so that a result published in between can't be missed
+        await pubsub.subscribe(channel)
+        result = await redis_client.get(result_key)
+        if result is not None:
+            return result
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        while (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None and message["type"] == "message":
+                return message["data"]
+        return None
+    finally:
+        await pubsub.unsubscribe(channel)
+        await pubsub.aclose()
@@ -0,0 +1,28 @@
+"""
+Estimates what LLM calls cost, to measure what the cache saves and to decide which cache entries are worth keeping.
+
+This is just a rough estimate. For some reason, OpenAI api doesn't simply return the cost per request, so doing the actual
+computation is complicated; but this rough estimate is good enough for our purposes.
+Prices are those of GPT-4o, assuming no cached input tokens.
+"""
+INPUT_PRICE_PER_MILLION_TOKENS = 2.5
+OUTPUT_PRICE_PER_MILLION_TOKENS = 10.0
+
+def estimate_tokens(text: str) -> float:
+    """Assuming that 1 token ~= 4 characters."""
+    return len(text) / 4
+
+def llm_cost(input_tokens: float, output_tokens: float) -> float:
+    """Cost of one LLM call, in dollars."""
+    return (input_tokens * INPUT_PRICE_PER_MILLION_TOKENS + output_tokens * OUTPUT_PRICE_PER_MILLION_TOKENS) / 1_000_000
+
+def calculate_cost(queryText: str, responseText: str, source: str) -> float:
+    """Calculate the cost of a request based on its source and query length."""
+    match source:
+        case "cache_l1" | "cache_l2" | "coalesced":
+            return 0.0 # Cache hits are free, and coalesced requests reuse another request's LLM call
+        case "llm":
+            return llm_cost(estimate_tokens(queryText), estimate_tokens(responseText))
+        case _:
+            print(f"Warning: unsupported response source: {source}")
+            return 0.0
@@ -0,0 +1,93 @@
+"""
+Memoizes query embeddings, keyed on the normalized query text (see `clean_query`), so that repeated and near-identical
+queries (differing only in case, punctuation or whitespace) are embedded once.
+
+The first tier is an in-process LRU. Embeddings are stored as rows of one preallocated float32 matrix rather than as Python
+lists of floats, so each entry costs 4 bytes per dimension plus its key.
+
+The optional second tier stores the raw float32 bytes in redis, so that embeddings survive restarts and are shared between
+workers. Keys include the embedding model name, so switching models never returns stale embeddings.
+
+Configuration (all optional):
+* EMBEDDING_MEMO_SIZE: number of embeddings kept in process, defaults to 10000 (0 disables the memo)
+* EMBEDDING_MEMO_REDIS: set to "TRUE" to enable the redis tier
+* EMBEDDING_MEMO_REDIS_TTL: seconds an embedding is kept in redis, defaults to 30 days
+"""
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+from src.utils.clean_query import clean_query
+from src.utils.redis_client import redis_binary_client
+
+class EmbeddingMemo:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._matrix: np.ndarray | None = None # allocated on first insert, once the dimension is known
+        self._slots: OrderedDict[str, int] = OrderedDict() # normalized text -> row in the matrix, least recently used first
+        self._free_slots: list[int] = []
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def get(self, key: str) -> np.ndarray | None:
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        self._slots.move_to_end(key)
+        # Copy, since the row is reused once this entry is evicted
+        return self._matrix[slot].copy()
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+        if self.capacity <= 0:
+            return
+        if self._matrix is None:
+            self._matrix = np.empty((self.capacity, len(embedding)), dtype=np.float32)
+            self._free_slots = list(range(self.capacity - 1, -1, -1))
+
+        slot = self._slots.get(key)
+        if slot is None:
+            if not self._free_slots:
+                _, evicted_slot = self._slots.popitem(last=False)
+                self._free_slots.append(evicted_slot)
+            slot = self._free_slots.pop()
+            self._slots[key] = slot
+        else:
+            self._slots.move_to_end(key)
+        self._matrix[slot] = embedding
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "size": len(self),
+            "capacity": self.capacity,
+            "bytes": self._matrix.nbytes if self._matrix is not None else 0,
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+        }
+
+def memo_key(text: str) -> str:
+    return clean_query(text)
+
+def redis_memo_key(key: str, model_name: str) -> str:
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return f"embedding:{model_name}:{digest}"
+
+async def get_from_redis(key: str, model_name: str) -> np.ndarray | None:
+    if os.getenv("EMBEDDING_MEMO_REDIS") != "TRUE":
+        return None
+    raw = await redis_binary_client.get(redis_memo_key(key, model_name))
+    return np.frombuffer(raw, dtype=np.float32).copy() if raw is not None else None
+
+async def put_in_redis(key: str, model_name: str, embedding: np.ndarray) -> None:
+    if os.getenv("EMBEDDING_MEMO_REDIS") != "TRUE":
+        return
+    ttl = int(os.getenv("EMBEDDING_MEMO_REDIS_TTL", str(60*60*24*30)))
+    await redis_binary_client.set(redis_memo_key(key, model_name), np.asarray(embedding, dtype=np.float32).tobytes(), ex=ttl)
+
+embedding_memo = EmbeddingMemo(capacity=int(os.getenv("EMBEDDING_MEMO_SIZE", "10000")))
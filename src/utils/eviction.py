@@ -0,0 +1,233 @@
+"""
+Keeps the cache within a byte budget, evicting the entries that are worth the least rather than relying on TTLs and
+redis's maxmemory policy (which treat a 20-token answer and a 4k-token answer the same).
+
+Entries are valued with GDSF (Greedy-Dual-Size-Frequency): priority = L + frequency * cost / size, where cost is what the
+LLM call that produced the entry cost (see `cost_model.py`), size is its size in redis, frequency counts its hits, and
+L (the "inflation") is the priority of the last evicted entry. Raising L on every eviction ages entries that stopped being
+hit, so recency counts too.
+
+The bookkeeping lives in redis, so that every worker shares it:
+* `eviction:priorities`: a sorted set of cache keys by priority
+* `eviction:stats`: a hash of cache key -> "size cost frequency"
+* `eviction:bytes`: the total size of the tracked entries
+* `eviction:inflation`: L
+
+Writes update them with small Lua scripts. Hits, including those served from a worker's L1 (which never reach redis), are
+counted in memory and added in batches at the start of every sweep. When the budget is exceeded, a background sweep evicts
+the lowest priority entries in batches (one ZPOPMIN-based script call per batch, so redis is never blocked for long), and
+also walks the sorted set incrementally to forget entries that have expired on their own. New entries are only admitted when the
+cache is full if they are worth more than the least valuable entry.
+
+Configuration (all optional):
+* EVICTION_MAX_BYTES: the byte budget; eviction is disabled (and nothing is tracked) if unset or 0. The scripts delete
+  entries wherever they are, so eviction is also disabled on the cluster and sharded backends (see `redis_client.py`)
+* EVICTION_SWEEP_INTERVAL: seconds between sweeps, defaults to 1
+* EVICTION_SWEEP_BATCH: entries evicted (or checked for expiry, or whose hits are recorded) per step of a sweep, defaults to 100
+"""
+import asyncio
+import os
+from collections import Counter
+from src.utils.redis_client import redis_client
+from src.utils.cost_model import llm_cost, estimate_tokens
+from src.utils.local_cache import local_cache, invalidation_message, INVALIDATION_CHANNEL
+
+PRIORITIES_KEY = "eviction:priorities"
+STATS_KEY = "eviction:stats"
+BYTES_KEY = "eviction:bytes"
+INFLATION_KEY = "eviction:inflation"
+KEYS = [PRIORITIES_KEY, STATS_KEY, BYTES_KEY, INFLATION_KEY]
+
+# Records a write of ARGV[1] (size ARGV[2], cost ARGV[3]). A rewrite keeps the entry's hit count.
+_TRACK_SCRIPT = """
+local frequency = 1
+local previous = redis.call("hget", KEYS[2], ARGV[1])
+if previous then
+    local size, cost, hits = string.match(previous, "(%S+) (%S+) (%S+)")
+    redis.call("decrby", KEYS[3], size)
+    frequency = tonumber(hits)
+end
+local inflation = tonumber(redis.call("get", KEYS[4]) or "0")
+redis.call("hset", KEYS[2], ARGV[1], ARGV[2] .. " " .. ARGV[3] .. " " .. frequency)
+redis.call("incrby", KEYS[3], ARGV[2])
+redis.call("zadd", KEYS[1], inflation + frequency * tonumber(ARGV[3]) / tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+# Records ARGV[2] hits on ARGV[1], ARGV[4] hits on ARGV[3] and so on. Returns how many of the keys are tracked.
+_HIT_SCRIPT = """
+local inflation = tonumber(redis.call("get", KEYS[4]) or "0")
+local recorded = 0
+for i = 1, #ARGV, 2 do
+    local stats = redis.call("hget", KEYS[2], ARGV[i])
+    if stats then
+        local size, cost, hits = string.match(stats, "(%S+) (%S+) (%S+)")
+        local frequency = tonumber(hits) + tonumber(ARGV[i + 1])
+        redis.call("hset", KEYS[2], ARGV[i], size .. " " .. cost .. " " .. frequency)
+        redis.call("zadd", KEYS[1], "XX", inflation + frequency * tonumber(cost) / tonumber(size), ARGV[i])
+        recorded = recorded + 1
+    end
+end
+return recorded
+"""
+
+# Evicts the lowest priority entries while the total size is over ARGV[1], at most ARGV[2] of them. Returns the evicted keys.
+_EVICT_SCRIPT = """
+local evicted = {}
+local used = tonumber(redis.call("get", KEYS[3]) or "0")
+while used > tonumber(ARGV[1]) and #evicted < tonumber(ARGV[2]) do
+    local lowest = redis.call("zpopmin", KEYS[1])
+    if #lowest == 0 then
+        break
+    end
+    local stats = redis.call("hget", KEYS[2], lowest[1])
+    if stats then
+        used = redis.call("decrby", KEYS[3], string.match(stats, "(%S+)"))
+        redis.call("hdel", KEYS[2], lowest[1])
+    end
+    redis.call("del", lowest[1])
+    redis.call("set", KEYS[4], lowest[2])
+    table.insert(evicted, lowest[1])
+end
+return evicted
+"""
+
+# Forgets the entries among ARGV that no longer exist (they expired on their own)
+_FORGET_EXPIRED_SCRIPT = """
+local forgotten = 0
+for _, key in ipairs(ARGV) do
+    if redis.call("exists", key) == 0 then
+        local stats = redis.call("hget", KEYS[2], key)
+        if stats then
+            redis.call("decrby", KEYS[3], string.match(stats, "(%S+)"))
+            redis.call("hdel", KEYS[2], key)
+        end
+        redis.call("zrem", KEYS[1], key)
+        forgotten = forgotten + 1
+    end
+end
+return forgotten
+"""
+
+def max_bytes() -> int:
+    return int(os.getenv("EVICTION_MAX_BYTES", "0"))
+
+def is_enabled() -> bool:
+    return max_bytes() > 0 and os.getenv("CACHE_BACKEND", "single") == "single"
+
+def entry_cost(query: str, response_text: str, input_tokens: int = 0, output_tokens: int = 0) -> float:
+    """What it would cost to get this response from the LLM again, from its token counts or (if unknown) estimated from its text."""
+    if not input_tokens and not output_tokens:
+        input_tokens, output_tokens = estimate_tokens(query), estimate_tokens(response_text)
+    return llm_cost(input_tokens, output_tokens)
+
+def priority(inflation: float, frequency: int, cost: float, size: int) -> float:
+    """The GDSF priority of an entry: the lowest priority entries are evicted first."""
+    return inflation + frequency * cost / max(size, 1)
+
+async def admit(candidates: list[tuple[int, float]]) -> list[bool]:
+    """
+    Decides which of the (size, cost) candidate entries are worth caching: all of them while there's room in the budget,
+    then only those worth more than the least valuable entry already cached (which they would end up evicting).
+    """
+    if not is_enabled() or not candidates:
+        return [True] * len(candidates)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(BYTES_KEY)
+        pipe.zrange(PRIORITIES_KEY, 0, 0, withscores=True)
+        pipe.get(INFLATION_KEY)
+        used, lowest, inflation = await pipe.execute()
+    used = int(used or 0)
+    lowest_priority = lowest[0][1] if lowest else 0.0
+    inflation = float(inflation or 0)
+
+    admitted = []
+    for size, cost in candidates:
+        admit_entry = used + size <= max_bytes() or priority(inflation, 1, cost, size) > lowest_priority
+        if admit_entry:
+            used += size
+        admitted.append(admit_entry)
+    return admitted
+
+def track(pipe, key: str, size: int, cost: float) -> None:
+    """Adds the bookkeeping of a cache write to `pipe`, so that it happens in the same round-trip as the write itself."""
+    pipe.eval(_TRACK_SCRIPT, len(KEYS), *KEYS, key, size, repr(cost))
+
+_pending_hits: Counter[str] = Counter()
+
+def record_hit(key: str) -> None:
+    """Counts a hit on a cache entry (from L1 or redis). The counts are sent to redis by the next sweep."""
+    if not is_enabled():
+        return
+    _pending_hits[key] += 1
+    ensure_sweeper()
+
+async def flush_hits(batch_size: int) -> int:
+    """Adds the hits counted since the last flush to the priorities, `batch_size` keys per script call. Returns how many keys were sent."""
+    global _pending_hits
+    hits, _pending_hits = _pending_hits, Counter()
+    items = list(hits.items())
+    for start in range(0, len(items), batch_size):
+        await redis_client.eval(_HIT_SCRIPT, len(KEYS), *KEYS, *(value for item in items[start:start + batch_size] for value in item))
+    return len(items)
+
+async def evict(batch_size: int) -> list[str]:
+    """Evicts up to `batch_size` of the lowest priority entries, if the cache is over budget. Returns the evicted keys."""
+    evicted = await redis_client.eval(_EVICT_SCRIPT, len(KEYS), *KEYS, max_bytes(), batch_size)
+    if evicted:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in evicted:
+                local_cache.delete(key)
+                # Other workers may hold a copy of the entry in their L1
+                pipe.publish(INVALIDATION_CHANNEL, invalidation_message(key))
+            await pipe.execute()
+    return evicted
+
+async def forget_expired(cursor: int, batch_size: int) -> tuple[int, int]:
+    """
+    Checks the next `batch_size` tracked entries and forgets those that have expired on their own, so that the byte count
+    stays accurate. Returns the cursor to continue from (0 once the whole sorted set has been walked) and how many were forgotten.
+    """
+    cursor, members = await redis_client.zscan(PRIORITIES_KEY, cursor, count=batch_size)
+    if not members:
+        return cursor, 0
+    forgotten = await redis_client.eval(_FORGET_EXPIRED_SCRIPT, len(KEYS), *KEYS, *(key for key, _ in members))
+    return cursor, forgotten
+
+async def sweep(batch_size: int, cursor: int = 0) -> int:
+    """
+    One sweep: records the hits counted meanwhile, checks a batch of entries for expiry, then evicts batches until the cache
+    is within budget. Returns the next cursor.
+    """
+    await flush_hits(batch_size)
+    cursor, _ = await forget_expired(cursor, batch_size)
+    while len(await evict(batch_size)) == batch_size:
+        await asyncio.sleep(0) # let requests through between batches
+    return cursor
+
+_sweeper_task: asyncio.Task | None = None
+
+def ensure_sweeper() -> None:
+    """Starts the background sweeps in this worker, if eviction is enabled and they aren't already running."""
+    global _sweeper_task
+    if not is_enabled():
+        return
+    if _sweeper_task is None or _sweeper_task.done():
+        _sweeper_task = asyncio.create_task(_sweep_periodically())
+
+async def stop_sweeper() -> None:
+    global _sweeper_task
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+        _sweeper_task = None
+
+async def _sweep_periodically() -> None:
+    cursor = 0
+    while True:
+        try:
+            cursor = await sweep(int(os.getenv("EVICTION_SWEEP_BATCH", "100")), cursor)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error while sweeping the cache for eviction: {e}")
+        await asyncio.sleep(float(os.getenv("EVICTION_SWEEP_INTERVAL", "1")))
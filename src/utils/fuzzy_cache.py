@@ -0,0 +1,239 @@
+"""
+The cache used by the "fuzzy" caching strategy, which catches near-duplicate queries without an embedding model.
+
+Queries are canonicalized first (see `canonicalize_query`: case, accents, punctuation, whitespace and stop-words are stripped,
+and words are optionally stemmed), and the entry is keyed on the namespaced fingerprint of the canonical query (see
+`cache_key.py`): `fuzzy_cache:<namespace>:<digest>`, holding an encoded `CacheEntry` (see `cache_entry.py`) that expires
+after `calculate_TTL` seconds. Queries with the same canonical form are therefore exact hits, eg: "What's the meaning of
+life? 🌟" and "what is the meaning of life".
+
+Otherwise, each worker keeps a `TrigramIndex` of the canonical queries in the cache, and the most similar one is a hit if:
+* the Jaccard similarity of their trigrams is at least the threshold, and
+* they have the same words in the same order, except for misspellings (eg: "capitol" and "capital"). Swapping a word for
+  another ("homemade pizza dough" vs "homemade bread dough"), adding one or reordering them ("brazil beat germany" vs
+  "germany beat brazil") changes the question, however similar the strings are, and numbers must match exactly.
+
+Like the vector cache, the index is built by scanning the entries of the namespace when it's first used (or at startup),
+canonicalizing the query each of them holds, and is then kept up to date incrementally: writes from this worker are added
+directly, and writes from other workers are picked up from the `fuzzy_changelog` redis stream. Entries written for another
+model or instructions (whose key isn't the one their canonical query would have here) are left out. Entries that have
+expired in redis are dropped from the index lazily.
+
+Configuration (all optional):
+* FUZZY_THRESHOLD: minimum Jaccard similarity for a near-duplicate hit, defaults to 0.8
+* FUZZY_STEMMING: set to "TRUE" to stem the words of canonical queries (eg: "cooking" -> "cook")
+"""
+import asyncio
+import os
+from src.utils.redis_client import redis_binary_client
+from src.utils.clean_query import canonicalize_query
+from src.utils.trigram_index import TrigramIndex
+from src.utils.cache_entry import CacheEntry, encode_entry, decode_entry
+from src.utils.cache_key import fingerprint, namespace
+from src.utils import eviction
+
+KEY_PREFIX = "fuzzy_cache:"
+CHANGELOG_STREAM = "fuzzy_changelog"
+CHANGELOG_MAX_LENGTH = 100_000
+SCAN_BATCH_SIZE = 1000
+CANDIDATES_PER_SEARCH = 3
+
+def is_misspelling(word: str, other: str) -> bool:
+    """Whether two different words are close enough to be the same word misspelled: 1 edit apart (2 for longer words)."""
+    if any(char.isdigit() for char in word + other):
+        return False
+    max_distance = 1 if max(len(word), len(other)) <= 5 else 2
+    return edit_distance(word, other, max_distance) <= max_distance
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """The number of insertions, deletions, substitutions and adjacent transpositions between a and b, or limit + 1 if it's more."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+def differing_words_match(canonical: str, other: str) -> bool:
+    """
+    Whether two canonical queries are the same words in the same order, up to misspellings: each word is paired with the word
+    at the same position of the other query. Reordering words changes the question ("flights paris london" vs "flights london
+    paris"), as does adding or removing one.
+    """
+    words, other_words = canonical.split(), other.split()
+    if len(words) != len(other_words):
+        return False
+    return all(word == other_word or is_misspelling(word, other_word) for word, other_word in zip(words, other_words))
+
+def entry_key(canonical: str, cache_namespace: str | None = None) -> str:
+    return f"{KEY_PREFIX}{fingerprint(canonical, cache_namespace)}"
+
+def queue_write(pipe, canonical: str, entry: CacheEntry, ttl: int) -> None:
+    """Adds the commands that write an entry (and append it to the changelog) to a redis pipeline."""
+    key = entry_key(canonical)
+    value = encode_entry(entry)
+    pipe.set(key, value, ex=ttl)
+    if eviction.is_enabled():
+        cost = eviction.entry_cost(entry.query or "", entry.response, entry.input_tokens, entry.output_tokens)
+        eviction.track(pipe, key, len(key.encode()) + len(value), cost)
+    pipe.xadd(CHANGELOG_STREAM, {"key": canonical, "entry_key": key}, maxlen=CHANGELOG_MAX_LENGTH, approximate=True)
+
+class FuzzyCache:
+    def __init__(self):
+        self.index = TrigramIndex()
+        self._last_changelog_id = "0-0"
+        self._load_lock = asyncio.Lock()
+        self._loaded = False
+        self._sync_task: asyncio.Task | None = None
+        self._following_changelog = False
+
+    def canonicalize(self, query: str) -> str:
+        return canonicalize_query(query, stem=os.getenv("FUZZY_STEMMING") == "TRUE")
+
+    async def ensure_loaded(self) -> None:
+        """Builds the local index from redis on first use and starts following the changelog."""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            # Remember where the changelog ends *before* scanning, so writes that happen during the scan are replayed afterwards
+            latest = await redis_binary_client.xrevrange(CHANGELOG_STREAM, count=1)
+            self._last_changelog_id = latest[0][0] if latest else "0-0"
+            batch = []
+            async for key in redis_binary_client.scan_iter(match=f"{KEY_PREFIX}{namespace()}:*", count=SCAN_BATCH_SIZE):
+                batch.append(key)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    await self._load_keys(batch)
+                    batch = []
+            await self._load_keys(batch)
+
+            self._loaded = True
+            self._following_changelog = True
+            self._sync_task = asyncio.create_task(self._follow_changelog())
+
+    async def _load_keys(self, keys: list[bytes]) -> None:
+        """Adds the canonical queries of the entries at `keys` to the index."""
+        if not keys:
+            return
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+            raw_entries = await pipe.execute()
+        for key, raw_entry in zip(keys, raw_entries):
+            entry = decode_entry(raw_entry) if raw_entry is not None else None
+            if entry is None or entry.query is None:
+                continue
+            canonical = self.canonicalize(entry.query)
+            if entry_key(canonical) == key.decode():
+                self.index.add(canonical)
+
+    def candidates(self, canonical: str, similarity_threshold: float, exact: bool = True, near_duplicates: bool = True) -> list[str]:
+        """The canonical queries whose entry would answer `canonical`: itself, then its near-duplicates, most similar first."""
+        matches = [canonical] if exact else []
+        if near_duplicates:
+            matches += [
+                candidate for candidate, _ in self.index.search(canonical, similarity_threshold, k=CANDIDATES_PER_SEARCH + 1)
+                if candidate != canonical and differing_words_match(canonical, candidate)
+            ][:CANDIDATES_PER_SEARCH]
+        return matches
+
+    async def search(self, query: str, similarity_threshold: float | None = None, exact: bool = True, near_duplicates: bool = True) -> str | None:
+        """
+        Returns the cached response of the query, or of its closest near-duplicate. `exact` and `near_duplicates` restrict
+        the search to one or the other (the hybrid strategy runs them as separate stages).
+        """
+        return (await self.search_many([query], similarity_threshold, exact, near_duplicates))[0]
+
+    async def search_many(
+        self, queries: list[str], similarity_threshold: float | None = None, exact: bool = True, near_duplicates: bool = True,
+    ) -> list[str | None]:
+        """Same as `search` for several queries, with one redis round-trip for all of their candidates."""
+        await self.ensure_loaded()
+        if similarity_threshold is None:
+            similarity_threshold = float(os.getenv("FUZZY_THRESHOLD", "0.8"))
+        if not queries:
+            return []
+
+        candidates = [self.candidates(self.canonicalize(query), similarity_threshold, exact, near_duplicates) for query in queries]
+        keys = list({candidate: None for matches in candidates for candidate in matches})
+        if not keys:
+            return [None] * len(queries)
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(entry_key(key))
+            raw_entries = dict(zip(keys, await pipe.execute()))
+
+        entries = {key: decode_entry(raw_entry) for key, raw_entry in raw_entries.items() if raw_entry is not None}
+        results = []
+        for matches in candidates:
+            hit = next((candidate for candidate in matches if entries.get(candidate) is not None), None)
+            if hit is not None:
+                eviction.record_hit(entry_key(hit))
+            results.append(entries[hit].response if hit is not None else None)
+        for key, raw_entry in raw_entries.items():
+            if raw_entry is None:
+                self.index.remove(key) # expired in redis (or never cached, for the exact candidate)
+        return results
+
+    async def add(self, query: str, response_text: str | CacheEntry, ttl: int) -> None:
+        await self.add_many([(query, response_text, ttl)])
+
+    async def add_many(self, entries: list[tuple[str, str | CacheEntry, int]]) -> None:
+        """
+        Writes (query, response, ttl) entries to redis in one pipeline and adds their canonical queries to the local index.
+        The response can be a CacheEntry, to store its metadata too.
+        """
+        await self.ensure_loaded()
+        canonicals = [self.canonicalize(query) for query, _, _ in entries]
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for canonical, (query, response_text, ttl) in zip(canonicals, entries):
+                entry = response_text if isinstance(response_text, CacheEntry) else CacheEntry(response_text, query)
+                queue_write(pipe, canonical, entry, ttl)
+            await pipe.execute()
+
+        for canonical in canonicals:
+            self.index.add(canonical)
+
+    def clear(self) -> None:
+        """Forgets the local index (eg: after the redis db has been flushed). It is rebuilt from redis on next use."""
+        self._stop_following_changelog()
+        self.index = TrigramIndex()
+        self._loaded = False
+        self._sync_task = None
+
+    async def close(self) -> None:
+        self._stop_following_changelog()
+
+    def _stop_following_changelog(self) -> None:
+        # The flag is checked as well as cancelling, since a blocking XREAD can absorb the cancellation
+        self._following_changelog = False
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+
+    async def _follow_changelog(self) -> None:
+        """Adds entries written by other workers to the local index as they appear in the changelog stream."""
+        while self._following_changelog:
+            try:
+                streams = await redis_binary_client.xread({CHANGELOG_STREAM: self._last_changelog_id}, count=SCAN_BATCH_SIZE, block=1000)
+                for _, messages in streams:
+                    for message_id, fields in messages:
+                        self._last_changelog_id = message_id
+                        canonical = fields[b"key"].decode()
+                        # Written for this namespace, model and instructions
+                        if fields.get(b"entry_key", b"").decode() == entry_key(canonical):
+                            self.index.add(canonical)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error while following the fuzzy cache changelog: {e}")
+                await asyncio.sleep(1)
+
+fuzzy_cache = FuzzyCache()
@@ -1,12 +1,88 @@
-# TODO: I was trying to implement a vector embedding cache, but it's not working as expected. Some issue with syncing with redis.
-# So, this is not in use at the moment.
+"""
+Computes query embeddings for the semantic (vector embedding) cache.
 
-# from sentence_transformers import SentenceTransformer
-# import numpy as np
+The sentence-transformers model is only loaded the first time an embedding is needed, so importing this module is cheap
+and strategies that don't use embeddings never pay for loading the model.
+Set EMBEDDING_MODEL to use a different sentence-transformers model.
 
-# # Initialize the model
-# embedder = SentenceTransformer("msmarco-distilbert-base-v4")
+Embeddings are returned as unit-normalized float32 NumPy arrays, so the inner product of two embeddings is their cosine similarity.
 
-# def get_embedding(text: str) -> list[float]:
-#     """Get embedding for a text using Hugging Face's sentence-transformers."""
-#     return embedder.encode(text).astype(np.float32).tolist()
\ No newline at end of file
+Single embeddings requested concurrently (eg: by `query_cache` and `cache_response` for different requests) are micro-batched
+into one `encode` call, which is much faster per text than encoding them one at a time. The batching can be tuned with:
+* EMBEDDING_BATCH_SIZE: maximum texts per encode call, defaults to 32
+* EMBEDDING_BATCH_WAIT_MS: how long the first text of a batch waits for more to arrive, defaults to 2
+* EMBEDDING_WORKERS: number of threads running encode calls, defaults to 1
+
+Embeddings are also memoized on the normalized query text, see `embedding_memo.py`.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from src.utils.micro_batcher import MicroBatcher
+from src.utils import embedding_memo, metrics
+
+DEFAULT_EMBEDDING_MODEL = "msmarco-distilbert-base-v4"
+
+_embedder = None
+_batcher: MicroBatcher[str, np.ndarray] | None = None
+
+def get_embedder():
+    """Returns the embedding model, loading it on first use."""
+    global _embedder
+    if _embedder is None:
+        from sentence_transformers import SentenceTransformer
+        _embedder = SentenceTransformer(os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL))
+    return _embedder
+
+def set_embedder(embedder) -> None:
+    """
+    Replaces the embedding model. Anything with a sentence-transformers style `encode(list[str]) -> array` method works,
+    which lets tests use a deterministic stub instead of downloading a model.
+    """
+    global _embedder
+    _embedder = embedder
+
+def embed_batch(texts: list[str]) -> np.ndarray:
+    """Embeds several texts in one call. Returns a (len(texts), dim) float32 array of unit-normalized rows."""
+    embeddings = np.asarray(get_embedder().encode(texts), dtype=np.float32).reshape(len(texts), -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+def get_batcher() -> MicroBatcher[str, np.ndarray]:
+    global _batcher
+    if _batcher is None:
+        _batcher = MicroBatcher(
+            embed_batch,
+            max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+            max_wait_ms=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "2")),
+            executor=ThreadPoolExecutor(max_workers=int(os.getenv("EMBEDDING_WORKERS", "1")), thread_name_prefix="embedder"),
+        )
+    return _batcher
+
+async def get_embedding(text: str) -> np.ndarray:
+    """Get embedding for a text using Hugging Face's sentence-transformers. The model runs in a thread so it doesn't block the event loop."""
+    with metrics.timed("embedding"):
+        memo = embedding_memo.embedding_memo
+        key = embedding_memo.memo_key(text)
+        embedding = memo.get(key)
+        if embedding is not None:
+            memo.hits += 1
+            return embedding
+
+        model_name = os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+        embedding = await embedding_memo.get_from_redis(key, model_name)
+        if embedding is not None:
+            memo.redis_hits += 1
+            memo.put(key, embedding)
+            return embedding
+
+        memo.misses += 1
+        embedding = await get_batcher().submit(text)
+        memo.put(key, embedding)
+        await embedding_memo.put_in_redis(key, model_name, embedding)
+        return embedding
+
+async def get_embeddings(texts: list[str]) -> np.ndarray:
+    """Embeds several texts concurrently, so that the ones missing from the memo are embedded in as few batches as possible."""
+    return np.stack(await asyncio.gather(*(get_embedding(text) for text in texts)))
@@ -0,0 +1,94 @@
+"""
+On-disk snapshots of the semantic cache's vector index, so that workers don't have to rebuild it from redis at startup.
+
+A snapshot is a directory of NumPy arrays (the vectors grouped by inverted list, their ids, the size of each list and the
+centroids) plus a `meta.json` holding the snapshot format version, the embedding model, the scope of the entry ids (see `scope` in
+`vector_cache.py`), the id of the last `vector_changelog` entry it
+includes and how many entries had been added to the changelog up to that one. Workers open the vectors with `np.load(mmap_mode="c")`: nothing is read until it's
+searched, the pages are shared between every worker process on the host through the page cache, and a worker that modifies
+a list (eg: removing an expired entry) gets a private copy of the pages it touches only.
+
+Snapshots are written to `<directory>/snapshot-<timestamp>` and then published by atomically replacing `<directory>/CURRENT`,
+so a worker never opens a half-written snapshot. The previous snapshot is kept, since workers may still be opening it; older
+ones are deleted (workers that already mapped them keep their pages).
+"""
+import json
+import os
+import shutil
+import time
+import numpy as np
+from src.utils.vector_index import VectorIndex
+
+SNAPSHOT_VERSION = 2
+CURRENT_FILE = "CURRENT"
+SNAPSHOTS_KEPT = 2
+
+def save_snapshot(
+    directory: str, arrays: tuple[np.ndarray | None, np.ndarray, list[str], list[int]], changelog_id: str, embedding_model: str,
+    changelog_entries: int | None = None, scope: str | None = None,
+) -> str:
+    """
+    Writes an index (as returned by `VectorIndex.to_arrays`) to a new snapshot and makes it the current one.
+    `changelog_id` is the last changelog entry included in the index, and `changelog_entries` the number of entries added to
+    the changelog up to it (if known), and `scope` identifies what the entry ids were derived for. Returns the snapshot's path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"snapshot-{time.time_ns()}"
+    path = os.path.join(directory, name)
+    os.makedirs(f"{path}.tmp")
+
+    centroids, vectors, ids, list_sizes = arrays
+    np.save(os.path.join(f"{path}.tmp", "vectors.npy"), np.ascontiguousarray(vectors, dtype=np.float32))
+    np.save(os.path.join(f"{path}.tmp", "ids.npy"), np.array(ids, dtype=str))
+    np.save(os.path.join(f"{path}.tmp", "list_sizes.npy"), np.array(list_sizes, dtype=np.int64))
+    if centroids is not None:
+        np.save(os.path.join(f"{path}.tmp", "centroids.npy"), centroids)
+    with open(os.path.join(f"{path}.tmp", "meta.json"), "w") as f:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "embedding_model": embedding_model,
+            "scope": scope,
+            "changelog_id": changelog_id,
+            "changelog_entries": changelog_entries,
+            "dim": vectors.shape[1],
+            "count": len(ids),
+            "created_at": time.time(),
+        }, f)
+    os.rename(f"{path}.tmp", path)
+
+    with open(os.path.join(directory, f"{CURRENT_FILE}.tmp"), "w") as f:
+        f.write(name)
+    os.replace(os.path.join(directory, f"{CURRENT_FILE}.tmp"), os.path.join(directory, CURRENT_FILE))
+
+    snapshots = sorted(entry for entry in os.listdir(directory) if entry.startswith("snapshot-") and not entry.endswith(".tmp"))
+    for old in snapshots[:-SNAPSHOTS_KEPT]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return path
+
+def load_snapshot(
+    directory: str, embedding_model: str, nlist: int = 1024, nprobe: int = 8, scope: str | None = None,
+) -> tuple[VectorIndex, dict] | None:
+    """
+    Opens the current snapshot, memory-mapping its vectors. Returns the index and the snapshot's metadata, or None if there
+    is no usable snapshot (none yet, another format version, another embedding model or another scope).
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta.get("version") != SNAPSHOT_VERSION or meta.get("embedding_model") != embedding_model:
+        print(f"Ignoring the vector index snapshot at {path}: it was written by format {meta.get('version')} for {meta.get('embedding_model')}")
+        return None
+    if meta.get("scope") != scope:
+        print(f"Ignoring the vector index snapshot at {path}: it was written for another namespace, model or instructions")
+        return None
+
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="c")
+    ids = np.load(os.path.join(path, "ids.npy")).tolist()
+    list_sizes = np.load(os.path.join(path, "list_sizes.npy")).tolist()
+    centroids_path = os.path.join(path, "centroids.npy")
+    centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+    return VectorIndex.from_arrays(centroids, vectors, ids, list_sizes, nlist=nlist, nprobe=nprobe), meta
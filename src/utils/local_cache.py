@@ -0,0 +1,166 @@
+"""
+An in-process L1 cache in front of redis (the L2), so that the hottest queries are answered without a network round-trip.
+
+The L1 is an LRU bounded both by number of entries and by (approximate) bytes. Every entry also expires: at the earlier of
+its remaining redis TTL (which comes from `calculate_TTL`) and LOCAL_CACHE_MAX_TTL, which bounds how stale an entry can get.
+
+To stay coherent across workers, every write to the cache is announced on the `cache_invalidation` pub/sub channel, and
+each worker drops its L1 copy of keys written by other workers. A value read from redis is only copied into L1 if its key
+wasn't written or invalidated while the read was in flight (see `version`), so a slow read can't bring back a stale value.
+
+Configuration (all optional):
+* LOCAL_CACHE_MAX_ENTRIES: defaults to 1000 (0 disables the L1)
+* LOCAL_CACHE_MAX_BYTES: defaults to 64MB
+* LOCAL_CACHE_MAX_TTL: seconds, defaults to 300
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from src.utils.redis_client import redis_client
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+class LocalCache:
+    def __init__(self, max_entries: int, max_bytes: int, max_ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self._entries: OrderedDict[str, tuple[str, float, int]] = OrderedDict() # key -> (value, expiry time, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.version = 0 # bumped by every write and invalidation
+        self._changes: OrderedDict[str, int] = OrderedDict() # key -> version of its last write or invalidation, oldest first
+        self._forgotten = 0 # the changes up to this version are no longer in `_changes`
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: str, ttl: float, since: int | None = None) -> None:
+        """
+        Caches `value` for `ttl` seconds (capped at max_ttl). A value read from redis is passed the `version` from before the
+        read as `since`, and is then dropped if the key was written or invalidated meanwhile.
+        """
+        if since is None:
+            self._changed(key)
+        elif self.changed_since(key, since):
+            return
+        size = len(key) + len(value)
+        ttl = min(ttl, self.max_ttl)
+        if self.max_entries <= 0 or ttl <= 0 or size > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (value, time.monotonic() + ttl, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        self._changed(key)
+        if self._remove(key):
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+        self.version += 1
+        self._changes.clear()
+        self._forgotten = self.version
+
+    def changed_since(self, key: str, version: int) -> bool:
+        """Whether `key` may have been written or invalidated after `version`."""
+        return self._changes.get(key, 0) > version or self._forgotten > version
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _changed(self, key: str) -> None:
+        self.version += 1
+        self._changes.pop(key, None)
+        self._changes[key] = self.version
+        # Only the recent changes matter, to the reads in flight; older ones are summed up by `_forgotten`
+        if len(self._changes) > max(self.max_entries, 1):
+            _, self._forgotten = self._changes.popitem(last=False)
+
+    def _remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[2]
+        return True
+
+_worker_id = uuid.uuid4().hex
+_listener_task: asyncio.Task | None = None
+
+def invalidation_message(key: str) -> str:
+    """The message to publish on INVALIDATION_CHANNEL when `key` is (re)written, so that other workers drop their L1 copy."""
+    return f"{_worker_id}:{key}"
+
+def ensure_invalidation_listener() -> None:
+    """Starts listening for invalidations from other workers, if this worker isn't already."""
+    global _listener_task
+    if local_cache.max_entries <= 0:
+        return
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.create_task(_listen_for_invalidations())
+
+async def stop_invalidation_listener() -> None:
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        _listener_task = None
+
+async def _listen_for_invalidations() -> None:
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Anything written while we weren't subscribed may be stale locally
+            local_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                sender, key = message["data"].split(":", 1)
+                if sender != _worker_id:
+                    local_cache.delete(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error while listening for cache invalidations: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+local_cache = LocalCache(
+    max_entries=int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    max_ttl=float(os.getenv("LOCAL_CACHE_MAX_TTL", "300")),
+)
@@ -0,0 +1,102 @@
+"""
+Prometheus metrics of this worker process, served by `GET /metrics` in the Prometheus text exposition format.
+
+Everything is aggregated in-process: recording a latency is a `Histogram.observe` (a bisect and two additions) and counting
+a request is a dict update, with no I/O or locking on the request path. The text is only rendered when /metrics is scraped,
+and gauges (queue depths, pool utilisation, ...) are read from the components at that point. Like `/api/stats`, the
+metrics are those of the worker that serves the scrape, so every worker has to be scraped.
+
+Metrics:
+* llm_cache_stage_seconds{stage}: latency histograms of the stages of a request, on the monotonic clock (`time.perf_counter`):
+  cache_lookup, embedding, ann_search, llm_call, and cache_write (per batch of queued writes)
+* llm_cache_requests_total{strategy, source}: requests by caching strategy and by what answered them, ie: the `source` of
+  their metadata (cache_l1, cache_l2, llm, coalesced or error). Hits are the cache_* sources and misses are llm.
+* llm_cache_dollars_saved_total{strategy}: what the requests answered by the cache (or coalesced) would have cost, as
+  estimated by `cost_model.py`
+* the gauges passed to `render`
+"""
+import os
+import time
+from src.utils.histogram import Histogram
+from src.utils.cost_model import calculate_cost
+
+# Components that already keep a latency histogram register it here (eg: the cache writer, for "cache_write")
+stage_latency: dict[str, Histogram] = {stage: Histogram() for stage in ("cache_lookup", "embedding", "ann_search", "llm_call")}
+requests: dict[tuple[str, str], int] = {}
+dollars_saved: dict[str, float] = {}
+
+SAVING_SOURCES = ("cache_l1", "cache_l2", "coalesced")
+
+def observe(stage: str, seconds: float) -> None:
+    stage_latency[stage].observe(seconds)
+
+class timed:
+    """Records how long the `with` block took as a latency of `stage`."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "timed":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        stage_latency[self.stage].observe(time.perf_counter() - self.start)
+
+def record_request(query: str, response: str, source: str) -> None:
+    """Counts a request by what answered it, and what it saved if it didn't need an LLM call of its own."""
+    strategy = os.environ.get("CACHING_STRATEGY", "")
+    key = (strategy, source)
+    requests[key] = requests.get(key, 0) + 1
+    if source in SAVING_SOURCES:
+        dollars_saved[strategy] = dollars_saved.get(strategy, 0.0) + calculate_cost(query, response, "llm")
+
+def render(gauges: list[tuple[str, str, dict[str, str], float]] = ()) -> str:
+    """
+    Renders every metric in the Prometheus text format. `gauges` are (name, help, labels, value) samples read at scrape
+    time; samples with the same name must be consecutive.
+    """
+    lines = [
+        "# HELP llm_cache_stage_seconds Latency of each stage of a request.",
+        "# TYPE llm_cache_stage_seconds histogram",
+    ]
+    for stage, histogram in stage_latency.items():
+        lines += histogram_lines("llm_cache_stage_seconds", {"stage": stage}, histogram)
+
+    lines += [
+        "# HELP llm_cache_requests_total Requests by caching strategy and by what answered them.",
+        "# TYPE llm_cache_requests_total counter",
+    ]
+    lines += [sample("llm_cache_requests_total", {"strategy": strategy, "source": source}, count) for (strategy, source), count in requests.items()]
+    lines += [
+        "# HELP llm_cache_dollars_saved_total Estimated cost of the LLM calls avoided by the cache and by coalescing.",
+        "# TYPE llm_cache_dollars_saved_total counter",
+    ]
+    lines += [sample("llm_cache_dollars_saved_total", {"strategy": strategy}, saved) for strategy, saved in dollars_saved.items()]
+
+    previous = None
+    for name, help_text, labels, value in gauges:
+        if name != previous:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            previous = name
+        lines.append(sample(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+def histogram_lines(name: str, labels: dict[str, str], histogram: Histogram) -> list[str]:
+    """The cumulative buckets, sum and count of a histogram."""
+    lines, cumulative = [], 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(sample(f"{name}_bucket", {**labels, "le": repr(float(bound))}, cumulative))
+    lines.append(sample(f"{name}_bucket", {**labels, "le": "+Inf"}, histogram.count))
+    lines.append(sample(f"{name}_sum", labels, histogram.sum))
+    lines.append(sample(f"{name}_count", labels, histogram.count))
+    return lines
+
+def sample(name: str, labels: dict[str, str], value: float) -> str:
+    label_text = ",".join(f'{key}="{escape(str(label))}"' for key, label in labels.items())
+    return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+def escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
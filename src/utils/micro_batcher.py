@@ -0,0 +1,103 @@
+"""
+Collects concurrent calls into batches so that a model (eg: the sentence-transformers embedder) is run once per batch
+instead of once per request.
+
+When the model is idle, a call is dispatched straight away so a lone request never waits. While a batch is running, new
+calls accumulate, and they are dispatched when that batch finishes, when `max_batch_size` items are waiting, or `max_wait_ms`
+after the first of them arrived, whichever comes first. The batch function runs in a thread pool so the event loop is never
+blocked by the model, and each caller's future is resolved with its own item's result.
+"""
+import asyncio
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Generic, Sequence, TypeVar
+from src.utils.histogram import Histogram
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class MicroBatcher(Generic[Item, Result]):
+    def __init__(
+        self,
+        batch_fn: Callable[[list[Item]], Sequence[Result]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        executor: Executor | None = None,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait = Histogram() # seconds between a call and the dispatch of the batch that contains it
+        self._pending: list[tuple[Item, asyncio.Future, float]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._running_batches: set[asyncio.Task] = set()
+
+    async def submit(self, item: Item) -> Result:
+        return (await self.submit_many([item]))[0]
+
+    async def submit_many(self, items: list[Item]) -> list[Result]:
+        """Submits several items at once, so that they are dispatched together rather than the first one on its own."""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+        enqueued_at = time.perf_counter()
+        self._pending.extend((item, future, enqueued_at) for item, future in zip(items, futures))
+        if not self._running_batches or len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        try:
+            return list(await asyncio.gather(*futures))
+        except BaseException:
+            for future in futures:
+                future.cancel() # so that their items are skipped if they haven't been dispatched yet
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait": self.queue_wait.snapshot(),
+        }
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+        if self._pending:
+            # More items arrived than fit in one batch; they start their own wait
+            self._flush_handle = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        # Skip the items whose caller gave up while they were waiting (eg: after a timeout)
+        batch = [entry for entry in batch if not entry[1].done()]
+        if not batch:
+            return
+
+        dispatched_at = time.perf_counter()
+        self.batch_sizes.observe(len(batch))
+        for _, _, enqueued_at in batch:
+            self.queue_wait.observe(dispatched_at - enqueued_at)
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self._running_batches.add(task)
+        task.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, task: asyncio.Task) -> None:
+        self._running_batches.discard(task)
+        if self._pending and not self._running_batches:
+            self._flush()
+
+    async def _run_batch(self, batch: list[tuple[Item, asyncio.Future, float]]) -> None:
+        items = [item for item, _, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, items)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done(): # the caller may have been cancelled meanwhile
+                future.set_result(result)
@@ -1,13 +1,26 @@
+import asyncio
 import os
-import re
-import numpy as np
-from src.utils.redis_client import redis_client
-# from src.utils.get_embeddings import get_embedding
-from redis.commands.search.query import Query
+import time
+from typing import Awaitable, Callable, NamedTuple
+from src.utils.redis_client import redis_binary_client
+from src.utils.get_embeddings import get_embedding, get_embeddings
+from src.utils.vector_cache import vector_cache
+from src.utils.fuzzy_cache import fuzzy_cache
+from src.utils.local_cache import local_cache, ensure_invalidation_listener
+from src.utils import ttl_policy, eviction
+from src.utils.refresh_ahead import refresher
+from src.utils.cache_entry import decode_entry
+from src.utils.cache_key import cache_key, matches
 
-async def query_cache(query: str) -> str | None:
+class CacheHit(NamedTuple):
+  response: str
+  source: str # "cache_l1" (in-process cache) or "cache_l2" (redis)
+  stage: str | None = None # the stage of the hybrid strategy that answered
+
+async def query_cache(query: str, timing: dict[str, float] | None = None) -> CacheHit | None:
   """
   Depending on the CACHING_STRATEGY set in the .env file, checks if there is a reusable query in the cache.
+  The hybrid strategy adds the time spent in each of its stages to `timing`.
   """
   strategy = os.environ.get("CACHING_STRATEGY")
   
@@ -16,96 +29,249 @@ async def query_cache(query: str) -> str | None:
       return None
     
     case "exact_match_only":
-      cached_item = redis_client.get(query)
-      return cached_item
+      return await query_exact_match(query)
+    
+    case "vector_embedding":
+      # Get embedding for the query and look for a similar enough cached query
+      query_embedding = await get_embedding(query)
+      cached_item = await vector_cache.search(query_embedding, query=query)
+      return CacheHit(cached_item, "cache_l2") if cached_item is not None else None
+    
+    case "fuzzy":
+      # Same canonical query, or a near-duplicate of one (see `fuzzy_cache.py`)
+      cached_item = await fuzzy_cache.search(query)
+      return CacheHit(cached_item, "cache_l2") if cached_item is not None else None
+    
+    case "hybrid":
+      return (await query_hybrid_many([query], timing))[0]
     
     # Add more cases
     # * Small local LLM cache
-    # * Vector embedding cache
-    # * Hybrid cache
     
     case _:
       print(f"The caching strategy was not set, or is unknown: {strategy}. Using default")
-      return redis_client.get(query)
+      return await query_exact_match(query)
 
+async def query_exact_match(query: str) -> CacheHit | None:
+  """Checks the in-process L1 cache, then redis (L2). L2 hits are copied into L1 for the rest of their redis TTL."""
+  return (await query_exact_match_many([query]))[0]
 
-# I was trying to implement vector embedding cache, but it's not working as expected. Some issue with syncing with redis.
-# async def query_cache_advanced(query: str) -> str | None:
-#   """
-#   Depending on the CACHING_STRATEGY set in the .env file, checks if there is a reusable query in the cache.
-#   """
-#   strategy = os.environ.get("CACHING_STRATEGY")
+async def query_cache_many(queries: list[str], timing: dict[str, float] | None = None) -> list[CacheHit | None]:
+  """
+  Same as `query_cache` for several queries at once: one redis round-trip for all of them with the exact match strategy,
+  one batched embedding and similarity search with the vector embedding strategy, and one round-trip for all the candidates
+  with the fuzzy strategy.
+  """
+  strategy = os.environ.get("CACHING_STRATEGY")
+  if not queries:
+    return []
   
-#   match strategy:
-#     case "no_cache":
-#       return None
+  match strategy:
+    case "no_cache":
+      return [None] * len(queries)
     
-#     case "exact_match_only":
-#       cached_item = redis_client.json().get(query, "$.response")
-#       return cached_item
+    case "exact_match_only":
+      return await query_exact_match_many(queries)
     
-#     case "cleaned_match":
-#       cleaned_query = clean_query(query)
-#       # TODO: simple retrieval wont work, need to use fuzzy search and redis
-#       cached_item = redis_client.json().get(cleaned_query, "$.response")
-#       return cached_item
+    case "vector_embedding":
+      cached_items = await vector_cache.search_many(await get_embeddings(queries), queries=queries)
+      return [CacheHit(cached_item, "cache_l2") if cached_item is not None else None for cached_item in cached_items]
     
-#     case "vector_embedding":
-#         # Get embedding for the query and perform vector search
-#         query_embedding = get_embedding(query)
-#         return perform_vector_search(query_embedding)
+    case "fuzzy":
+      cached_items = await fuzzy_cache.search_many(queries)
+      return [CacheHit(cached_item, "cache_l2") if cached_item is not None else None for cached_item in cached_items]
     
-#     # Add more cases
-#     # * Small local LLM cache
-#     # * Vector embedding cache
-#     # * Hybrid cache
+    case "hybrid":
+      return await query_hybrid_many(queries, timing)
     
-#     case _:
-#       print(f"The caching strategy was not set, or is unknown: {strategy}. Using default")
-#       return redis_client.json().get(query, "$.response")
+    case _:
+      print(f"The caching strategy was not set, or is unknown: {strategy}. Using default")
+      return await query_exact_match_many(queries)
 
-# def clean_query(query: str) -> str:
-#     # Convert to lowercase
-#     cleaned_query = query.lower()
-    
-#     # Remove special characters, keeping only alphanumeric and spaces
-#     cleaned_query = re.sub(r'[^a-z0-9\s]', '', cleaned_query)
-    
-#     # Remove extra whitespace
-#     cleaned_query = ' '.join(cleaned_query.split())
-    
-#     return cleaned_query
+async def query_exact_match_many(queries: list[str]) -> list[CacheHit | None]:
+  """Same as `query_exact_match` for several queries, looking up all the L1 misses in a single redis round-trip."""
+  results = [CacheHit(cached_item, "cache_l1") if cached_item is not None else None for cached_item in query_local_many(queries)]
+  l1_misses = [i for i, result in enumerate(results) if result is None]
+  if not l1_misses:
+    return results
+  
+  for i, cached_item in zip(l1_misses, await query_redis_many([queries[i] for i in l1_misses])):
+    if cached_item is not None:
+      results[i] = CacheHit(cached_item, "cache_l2")
+  return results
 
-# def perform_vector_search(query_embedding: list[float], similarity_threshold: float = 0.85) -> str | None:
-#     """
-#     Performs vector similarity search in Redis and returns the best matching response if found.
-    
-#     Args:
-#         query_embedding: The embedding vector of the query
-#         similarity_threshold: Minimum cosine similarity required for a match (default: 0.85)
-    
-#     Returns:
-#         The cached response if a sufficiently similar query is found, None otherwise
-#     """
-#     # Convert embedding to bytes for Redis
-#     query_embedding_bytes = np.array(query_embedding, dtype=np.float32).tobytes()
-    
-#     # Create vector search query
-#     query = (
-#         Query(f"(*)=>[KNN 3 @query_embedding $vector AS vector_score]")
-#         .sort_by("vector_score")
-#         .return_fields("response", "vector_score")
-#         .dialect(2)
-#     )
-    
-#     # Execute vector search
-#     results = redis_client.ft("idx:vector_cache").search(
-#         query,
-#         query_params={"vector": query_embedding_bytes}
-#     )
-    
-#     # If we have results and the best match is close enough
-#     if results.docs and (1 - float(results.docs[0].vector_score)) >= similarity_threshold:
-#         return results.docs[0].response
-    
-#     return None
+def query_local_many(queries: list[str]) -> list[str | None]:
+  """Looks the queries up in the in-process L1 cache."""
+  ensure_invalidation_listener()
+  keys = [cache_key(query) for query in queries]
+  cached_items = [local_cache.get(key) for key in keys]
+  for query, key, cached_item in zip(queries, keys, cached_items):
+    if cached_item is not None:
+      # L1 hits never reach redis, but count towards the entry's value all the same
+      eviction.record_hit(key)
+      if refresher.ahead_fraction > 0:
+        refresher.record_hit(query)
+  return cached_items
+
+async def query_redis_many(queries: list[str]) -> list[str | None]:
+  """
+  Looks the queries up in redis, in a single round-trip. Hits are copied into L1 for the rest of their soft TTL.
+  Entries past their soft TTL are still returned, and refreshed in the background (see `refresh_ahead.py`).
+  """
+  keys = [cache_key(query) for query in queries]
+  version = local_cache.version # keys written or invalidated during the read aren't copied into L1
+  # Fetch the remaining TTLs in the same round-trip, so the L1 copy never outlives the redis entry
+  async with redis_binary_client.pipeline(transaction=False) as pipe:
+    for key in keys:
+      pipe.get(key)
+      pipe.pttl(key)
+    replies = await pipe.execute()
+  results: list[str | None] = []
+  stale_ttl = ttl_policy.stale_ttl()
+  refreshing = refresher.is_enabled()
+  for query, key, raw_entry, ttl_ms in zip(queries, keys, replies[::2], replies[1::2]):
+    entry = decode_entry(raw_entry) if raw_entry is not None else None
+    if entry is None or not matches(entry, query): # a digest collision is a miss
+      results.append(None)
+      continue
+    if ttl_ms > 0:
+      remaining_ttl = ttl_ms / 1000 - stale_ttl # what's left of the soft TTL
+      age = time.time() - entry.created_at if entry.created_at is not None else None
+      if refreshing:
+        refresher.on_hit(query, remaining_ttl, age)
+      local_cache.set(key, entry.response, ttl=refresher.local_ttl(remaining_ttl, age), since=version)
+      ttl_policy.extend_on_hit(query, remaining_ttl)
+    else:
+      local_cache.set(key, entry.response, ttl=local_cache.max_ttl, since=version)
+    eviction.record_hit(key)
+    results.append(entry.response)
+  return results
+
+async def _query_local_stage(queries: list[str]) -> list[str | None]:
+  return query_local_many(queries)
+
+async def _query_semantic_stage(queries: list[str]) -> list[str | None]:
+  return await vector_cache.search_many(await get_embeddings(queries), queries=queries)
+
+# The stages of the hybrid strategy, from the cheapest to the most expensive
+HYBRID_STAGES: dict[str, Callable[[list[str]], Awaitable[list[str | None]]]] = {
+  "l1": _query_local_stage, # in-process exact match
+  "exact": query_redis_many, # redis exact match
+  "normalized": lambda queries: fuzzy_cache.search_many(queries, near_duplicates=False), # same canonical query
+  "lexical": lambda queries: fuzzy_cache.search_many(queries, exact=False), # trigram near-duplicate
+  "semantic": _query_semantic_stage, # embedding similarity
+}
+
+def hybrid_stages() -> list[str]:
+  """The stages of the hybrid cascade, in order: HYBRID_STAGES (comma-separated), defaults to all of them."""
+  names = [name.strip() for name in os.getenv("HYBRID_STAGES", ",".join(HYBRID_STAGES)).split(",") if name.strip()]
+  unknown = [name for name in names if name not in HYBRID_STAGES]
+  if unknown:
+    print(f"Unknown hybrid cache stages: {unknown}. Ignoring them")
+  return [name for name in names if name in HYBRID_STAGES]
+
+def strategy_stores(strategy: str | None) -> set[str]:
+  """The stores ("exact", "fuzzy" and "vector") that a caching strategy looks up."""
+  match strategy:
+    case "no_cache":
+      return set()
+    case "vector_embedding":
+      return {"vector"}
+    case "fuzzy":
+      return {"fuzzy"}
+    case "hybrid":
+      stages = hybrid_stages()
+      stores = {"exact"}
+      if "normalized" in stages or "lexical" in stages:
+        stores.add("fuzzy")
+      if "semantic" in stages:
+        stores.add("vector")
+      return stores
+    case _:
+      return {"exact"}
+
+async def query_hybrid_many(queries: list[str], timing: dict[str, float] | None = None) -> list[CacheHit | None]:
+  """
+  The hybrid strategy: a cascade of lookups from the cheapest to the most expensive (see HYBRID_STAGES), which stops at the
+  first stage that hits. Each stage only looks up the queries that the earlier ones missed.
+  
+  With HYBRID_PARALLEL=TRUE, the stages after L1 are all started at once, and the first hit in cascade order wins as soon as
+  every earlier stage has missed: lower latency on misses, at the cost of lookups (and embeddings) that may go unused.
+  HYBRID_DEADLINE_MS (optional) bounds the whole cascade: stages that haven't answered by then count as misses.
+  
+  The time spent in each stage is added to timing['cache_stage_<stage>'], and hits report the stage that answered.
+  """
+  stages = hybrid_stages()
+  results: list[CacheHit | None] = [None] * len(queries)
+  deadline_ms = os.getenv("HYBRID_DEADLINE_MS")
+  deadline = time.monotonic() + float(deadline_ms) / 1000 if deadline_ms else None
+  
+  def record_hits(stage: str, positions: list[int], cached_items: list[str | None], stage_time: float) -> list[int]:
+    """Records the hits of a stage. Returns the positions it missed."""
+    if timing is not None:
+      timing[f'cache_stage_{stage}'] = timing.get(f'cache_stage_{stage}', 0.0) + stage_time
+    misses = []
+    for i, cached_item in zip(positions, cached_items):
+      if cached_item is not None:
+        results[i] = CacheHit(cached_item, "cache_l1" if stage == "l1" else "cache_l2", stage)
+      else:
+        misses.append(i)
+    return misses
+  
+  remaining = list(range(len(queries)))
+  if stages and stages[0] == "l1":
+    # Checking the L1 is a dictionary lookup: not worth a task, nor a deadline
+    stage_start = time.time()
+    remaining = record_hits("l1", remaining, query_local_many(queries), time.time() - stage_start)
+    stages = stages[1:]
+  if not remaining or not stages:
+    return results
+  
+  async def run_stage(stage: str, positions: list[int]) -> tuple[list[str | None], float]:
+    stage_start = time.time()
+    try:
+      cached_items = await HYBRID_STAGES[stage]([queries[i] for i in positions])
+    except Exception as e:
+      # A failing stage (eg: redis or the embedding model being unavailable) counts as a miss, so later stages still run
+      print(f"Error in the {stage} stage of the hybrid cache: {e}")
+      cached_items = [None] * len(positions)
+    return cached_items, time.time() - stage_start
+  
+  async def before_deadline(awaitable: Awaitable):
+    if deadline is None:
+      return await awaitable
+    return await asyncio.wait_for(awaitable, timeout=max(0.0, deadline - time.monotonic()))
+  
+  if os.getenv("HYBRID_PARALLEL") == "TRUE":
+    positions = remaining
+    launched = time.time()
+    tasks = {stage: asyncio.ensure_future(run_stage(stage, positions)) for stage in stages}
+    try:
+      for stage in stages:
+        try:
+          # Shielded: a stage that misses the deadline is cancelled below, along with the later ones
+          cached_items, stage_time = await before_deadline(asyncio.shield(tasks[stage]))
+        except asyncio.TimeoutError:
+          record_hits(stage, [], [], time.time() - launched)
+          break
+        # Only the queries that every earlier stage missed are answered by this one
+        stage_items = dict(zip(positions, cached_items))
+        remaining = record_hits(stage, remaining, [stage_items[i] for i in remaining], stage_time)
+        if not remaining:
+          break
+    finally:
+      for task in tasks.values():
+        task.cancel()
+    return results
+  
+  for stage in stages:
+    stage_start = time.time()
+    try:
+      cached_items, stage_time = await before_deadline(run_stage(stage, remaining))
+    except asyncio.TimeoutError:
+      record_hits(stage, [], [], time.time() - stage_start)
+      break
+    remaining = record_hits(stage, remaining, cached_items, stage_time)
+    if not remaining:
+      break
+  return results
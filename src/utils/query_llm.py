@@ -1,35 +1,115 @@
 import os
-import logging
+import time
 from datetime import datetime
-from openai import AsyncOpenAI
+from typing import AsyncIterator
 from src.utils.cache_response import cache_response
+from src.utils.cache_key import llm_model, LLM_INSTRUCTIONS, LLM_PARAMETERS
+from src.utils.upstream_scheduler import upstream_scheduler, call_with_retries, holding_slot_with_retries, INTERACTIVE
+from src.utils import metrics
+from src.utils.query_log import query_log
 
-client = AsyncOpenAI()
+# Created by get_client, since importing openai takes about a second; tests replace it with a fake
+client = None
 
-os.makedirs('logs', exist_ok=True)
-logging.basicConfig(
-    filename='logs/llm_queries.txt',
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+def get_client():
+  """Returns the OpenAI client, creating it (and importing openai) on first use, or during warm-up (see `warm_up.py`)."""
+  global client
+  if client is None:
+    from openai import AsyncOpenAI
+    # Retries are done by call_with_retries, so that every attempt goes through the rate limiter
+    client = AsyncOpenAI(max_retries=0)
+  return client
 
-# TODO: probably need to add an intermediate data structure here to handle rate limits
-async def query_llm(query: str) -> str:
+def estimate_tokens(query: str) -> float:
+  """Rough token estimate used for rate limiting before the real usage is known: ~4 characters per token, plus a typical answer."""
+  return len(query) / 4 + float(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", "500"))
+
+def usage_metadata(response) -> dict:
+  """The model and token counts of a response, which are cached alongside it."""
+  usage = getattr(response, "usage", None)
+  return {
+    "model": getattr(response, "model", None),
+    "input_tokens": usage.input_tokens if usage is not None else 0,
+    "output_tokens": usage.output_tokens if usage is not None else 0,
+  }
+
+async def query_llm(query: str, timing: dict[str, float] | None = None, priority: int = INTERACTIVE) -> str:
+  """
+  Queries the LLM through the upstream scheduler (see `upstream_scheduler.py`), which enforces the rate limits and retries
+  throttled calls. The time spent waiting for the scheduler is added to timing['upstream_queue_wait'].
+  Errors are raised, so that callers (and the requests coalesced with them) report an error rather than an answer.
+  """
   try:
-    response = await client.responses.create(
-        model="gpt-4o",
-        instructions="You are a helpful assistant.",
-        input=query,
-    )    
+    estimated_tokens = estimate_tokens(query)
+    start = time.perf_counter()
+    with metrics.timed("llm_call"):
+      response = await call_with_retries(
+        upstream_scheduler,
+        lambda: get_client().responses.create(
+          model=llm_model(),
+          instructions=LLM_INSTRUCTIONS,
+          input=query,
+          **LLM_PARAMETERS,
+        ),
+        priority=priority,
+        estimated_tokens=estimated_tokens,
+        timing=timing,
+      )
+    if response.usage is not None:
+      upstream_scheduler.record_usage(estimated_tokens, response.usage.total_tokens)
 
-    logging.info(f"Query: {query}")
-    logging.info(f"Response: {response}")
-    logging.info("="*50)  # Separator between entries
-    
-    cache_response(query, response.output_text)
+    usage = usage_metadata(response)
+    # Only queues the log record and the write; both happen in the background
+    query_log.record_llm_call(query, latency=time.perf_counter() - start, **usage)
+    await cache_response(query, response.output_text, **usage)
     
     return response.output_text
   except Exception as e:
     print(f"Error in query_llm: {e}")
-    return "Unfortunately, LLM querying is not available right now due to an internal error. Please try again later." # handle error gracefully
\ No newline at end of file
+    raise
+
+async def stream_llm(query: str, timing: dict[str, float] | None = None, priority: int = INTERACTIVE) -> AsyncIterator[str]:
+  """
+  Streams the LLM response as it is generated, yielding text deltas.
+  The full response is only cached once the stream has completed, so a stream that fails or is abandoned part-way is never cached.
+  Errors are raised to the caller, which is already streaming and has to report them in-band.
+  Starting the stream goes through the upstream scheduler, like `query_llm`, and the scheduler slot is held until the stream
+  has been consumed or closed, so that LLM_MAX_CONCURRENCY also bounds the streams in progress.
+  """
+  estimated_tokens = estimate_tokens(query)
+  start = time.perf_counter()
+  async with holding_slot_with_retries(
+    upstream_scheduler,
+    lambda: get_client().responses.create(
+      model=llm_model(),
+      instructions=LLM_INSTRUCTIONS,
+      input=query,
+      stream=True,
+      **LLM_PARAMETERS,
+    ),
+    priority=priority,
+    estimated_tokens=estimated_tokens,
+    timing=timing,
+  ) as stream:
+    chunks = []
+    try:
+      async for event in stream:
+        match event.type:
+          case "response.output_text.delta":
+            chunks.append(event.delta)
+            yield event.delta
+          case "response.completed":
+            metrics.observe("llm_call", time.perf_counter() - start)
+            if getattr(event.response, "usage", None) is not None:
+              upstream_scheduler.record_usage(estimated_tokens, event.response.usage.total_tokens)
+            response_text = "".join(chunks)
+            usage = usage_metadata(event.response)
+            query_log.record_llm_call(query, latency=time.perf_counter() - start, **usage)
+            await cache_response(query, response_text, **usage)
+          case "response.failed" | "error":
+            raise RuntimeError(f"LLM stream failed: {event}")
+    finally:
+      # An abandoned stream (eg: the client disconnected) stops the generation upstream too
+      close = getattr(stream, "close", None)
+      if close is not None:
+        await close()
@@ -0,0 +1,205 @@
+"""
+A structured log of the queries served, written as JSON lines off the request path.
+
+Recording an event only appends a tuple to a bounded in-memory queue; every QUERY_LOG_FLUSH_INTERVAL seconds, a background
+thread drains it, hashes the queries, serialises the records and writes and flushes them in batches of up to
+QUERY_LOG_BATCH_SIZE. The event loop never waits on the file, or on formatting the records. When the disk can't keep up, the
+queue fills up and new events are dropped (and counted) rather than slowing requests down.
+
+Two kinds of events are logged, one JSON object per line:
+* "request": a query answered by the server, with its caching strategy, source ("cache_l1", "cache_l2", "llm", "coalesced",
+  "error"), the stage of the hybrid strategy that answered, the latency and whether it was a forceRefresh
+* "llm_call": a call to the LLM, with the model, its latency and token usage; it is joined to the request(s) it answered by
+  `query_hash`
+Every event has `ts` (unix time) and `query_hash` (BLAKE2b of the canonical query, see `cache_key.py`); request events also
+have the query itself, unless QUERY_LOG_QUERIES is FALSE. The request events of a log are a trace of the workload, which the
+load test (`--replay`) and the evaluation harness (`--replay`) can send again: see `read_query_log`.
+
+Sampling is by query rather than by request: a query is either logged every time or never, so a sampled log still has the
+repeats that make cache hits, and an LLM call is logged if its requests are.
+
+The file is rotated once it reaches QUERY_LOG_MAX_BYTES: `path` becomes `path.1`, `path.1` becomes `path.2` and so on, and
+the oldest of the QUERY_LOG_BACKUPS is deleted.
+
+Configuration (all optional):
+* QUERY_LOG: FALSE disables the log, defaults to enabled
+* QUERY_LOG_PATH: defaults to logs/llm_queries.jsonl
+* QUERY_LOG_QUERIES: FALSE leaves the query text out of the request events (which then can't be replayed)
+* QUERY_LOG_SAMPLE_RATE: fraction of the queries logged, defaults to 1
+* QUERY_LOG_MAX_BYTES: defaults to 100MB
+* QUERY_LOG_BACKUPS: rotated files kept, defaults to 5
+* QUERY_LOG_QUEUE_SIZE: events waiting to be written before new ones are dropped, defaults to 10000
+* QUERY_LOG_BATCH_SIZE: records per write, defaults to 1000
+* QUERY_LOG_FLUSH_INTERVAL: seconds, defaults to 1
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from src.utils.cache_key import canonical_query
+
+def query_hash(query: str) -> str:
+    return hashlib.blake2b(canonical_query(query).encode(), digest_size=8).hexdigest()
+
+def read_query_log(path: str) -> list[str]:
+    """The queries of the request events of a log, in the order they were served."""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("event") == "request" and record.get("query") is not None:
+                queries.append(record["query"])
+    return queries
+
+class QueryLogger:
+    def __init__(
+        self,
+        path: str,
+        enabled: bool = True,
+        include_queries: bool = True,
+        sample_rate: float = 1.0,
+        max_bytes: int = 100 * 1024 * 1024,
+        backups: int = 5,
+        max_queue_size: int = 10_000,
+        batch_size: int = 1000,
+        flush_interval: float = 1.0,
+    ):
+        self.path = path
+        self.enabled = enabled
+        self.include_queries = include_queries
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._pending: deque[tuple] = deque() # appending is thread-safe, and much cheaper than a queue.Queue
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def sampled(self, digest: str) -> bool:
+        return self.sample_rate >= 1 or int(digest, 16) / 2**64 < self.sample_rate
+
+    def record_request(self, query: str, source: str, latency: float, stage: str | None = None, force_refresh: bool = False) -> None:
+        """Logs a query answered by the server. Never blocks."""
+        self._record("request", query, {
+            "strategy": os.environ.get("CACHING_STRATEGY"),
+            "source": source,
+            "stage": stage,
+            "latency": latency,
+            "force_refresh": force_refresh,
+        })
+
+    def record_llm_call(self, query: str, model: str | None, latency: float, input_tokens: int = 0, output_tokens: int = 0) -> None:
+        """Logs a call to the LLM and its token usage. Never blocks."""
+        self._record("llm_call", query, {
+            "model": model,
+            "latency": latency,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        })
+
+    def _record(self, event: str, query: str, fields: dict) -> None:
+        if not self.enabled:
+            return
+        # The query is only hashed here if it's needed to sample it, the writer thread hashes it otherwise
+        digest = query_hash(query) if self.sample_rate < 1 else None
+        if digest is not None and not self.sampled(digest):
+            return
+        if len(self._pending) >= self.max_queue_size:
+            self.dropped += 1
+            return
+        self._pending.append((time.time(), event, query, digest, fields))
+        if self._thread is None:
+            self._start()
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.flush_interval):
+            self._drain()
+        self._drain()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _drain(self) -> None:
+        """Writes everything queued so far, in batches of up to `batch_size` records."""
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error writing the query log: {e}")
+
+    def _write(self, batch: list[tuple]) -> None:
+        lines = []
+        for ts, event, query, digest, fields in batch:
+            record = {"ts": round(ts, 3), "event": event, "query_hash": digest or query_hash(query)}
+            if event == "request" and self.include_queries:
+                record["query"] = query
+            record.update(fields)
+            record["latency"] = round(record["latency"], 6)
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        data = ("\n".join(lines) + "\n").encode()
+
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab")
+        if self._file.tell() > 0 and self._file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self.written += len(batch)
+
+    def _rotate(self) -> None:
+        self._file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "wb")
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Writes whatever is still queued (waiting up to `timeout` seconds) and stops the writer thread."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+query_log = QueryLogger(
+    os.getenv("QUERY_LOG_PATH", "logs/llm_queries.jsonl"),
+    enabled=os.getenv("QUERY_LOG") != "FALSE",
+    include_queries=os.getenv("QUERY_LOG_QUERIES") != "FALSE",
+    sample_rate=float(os.getenv("QUERY_LOG_SAMPLE_RATE", "1")),
+    max_bytes=int(os.getenv("QUERY_LOG_MAX_BYTES", str(100 * 1024 * 1024))),
+    backups=int(os.getenv("QUERY_LOG_BACKUPS", "5")),
+    max_queue_size=int(os.getenv("QUERY_LOG_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("QUERY_LOG_BATCH_SIZE", "1000")),
+    flush_interval=float(os.getenv("QUERY_LOG_FLUSH_INTERVAL", "1")),
+)
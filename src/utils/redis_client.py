@@ -1,63 +1,112 @@
 """
 This file abstracts away the redis client to ensure that the same redis instance is being used everywhere.
+
+The client is an asyncio client (`redis.asyncio`) so that cache reads/writes never block the event loop that is serving requests.
+Connections come from a bounded, blocking pool: when every connection is busy, callers wait (up to REDIS_POOL_TIMEOUT seconds) for one to be released instead of opening an unbounded number of sockets.
+
+The cache can outgrow a single redis node, so the backend is configurable (CACHE_BACKEND). Every backend has the command API
+of `redis.asyncio.Redis`, so the rest of the code uses `redis_client` and `redis_binary_client` the same way whatever it is:
+* "single" (default): one redis node at REDIS_HOST:REDIS_PORT
+* "cluster": a Redis Cluster, discovered from the REDIS_NODES startup nodes. Pipelines are split per node by the client.
+* "sharded": client-side consistent hashing over the independent redis nodes of REDIS_NODES (see `sharded_redis.py`)
+Cost-aware eviction (`eviction.py`) keeps its bookkeeping in Lua scripts that touch any cache key, so it needs the single backend.
+
+Configuration (all optional):
+* REDIS_HOST: defaults to "redis" (the docker compose service). Set to localhost to run scripts from outside the container.
+* REDIS_PORT: defaults to 6379
+* REDIS_MAX_CONNECTIONS: size of the connection pool per worker process (and per node), defaults to 50
+* REDIS_POOL_TIMEOUT: seconds to wait for a free connection before raising, defaults to 5
+* REDIS_SOCKET_TIMEOUT: seconds to wait on a single redis command before raising, defaults to 5
+* CACHE_BACKEND: "single", "cluster" or "sharded", defaults to "single"
+* REDIS_NODES: comma-separated host:port nodes of the cluster and sharded backends, defaults to REDIS_HOST:REDIS_PORT
+* REDIS_VIRTUAL_NODES: points of each node on the hash ring of the sharded backend, defaults to 160
 """
 import os
-import redis
-from redis.commands.search.field import VectorField, TextField
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.commands.search.query import Query
+import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster, ClusterNode
+from src.utils.sharded_redis import ShardedRedis
+
+def redis_nodes() -> list[tuple[str, int]]:
+    """The (host, port) of every node of the cluster and sharded backends."""
+    nodes = os.getenv("REDIS_NODES")
+    if not nodes:
+        return [(os.getenv('REDIS_HOST', 'redis'), int(os.getenv('REDIS_PORT', '6379')))]
+    return [(host, int(port)) for host, port in (node.strip().rsplit(":", 1) for node in nodes.split(",") if node.strip())]
+
+def create_connection_pool(decode_responses: bool = True, host: str | None = None, port: int | None = None) -> redis.BlockingConnectionPool:
+    return redis.BlockingConnectionPool(
+        host=host or os.getenv('REDIS_HOST', 'redis'), # This approach allows the redis host to be set to localhost too, which enables objects outside the docker container to interact with it too (useful for quickly running tests).
+        port=port or int(os.getenv('REDIS_PORT', '6379')),
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+        timeout=float(os.getenv('REDIS_POOL_TIMEOUT', '5')),
+        socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', '5')),
+        decode_responses=decode_responses
+    )
+
+def create_client(decode_responses: bool = True) -> tuple[redis.Redis | RedisCluster | ShardedRedis, list[redis.BlockingConnectionPool]]:
+    """Creates a client of the configured backend. Returns it with its connection pools (the cluster client manages its own)."""
+    backend = os.getenv("CACHE_BACKEND", "single")
+    match backend:
+        case "cluster":
+            client = RedisCluster(
+                startup_nodes=[ClusterNode(host, port) for host, port in redis_nodes()],
+                max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+                socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', '5')),
+                decode_responses=decode_responses,
+            )
+            return client, []
+        case "sharded":
+            nodes = redis_nodes()
+            pools = [create_connection_pool(decode_responses, host, port) for host, port in nodes]
+            client = ShardedRedis(
+                [redis.Redis(connection_pool=pool) for pool in pools],
+                [f"{host}:{port}" for host, port in nodes],
+                virtual_nodes=int(os.getenv("REDIS_VIRTUAL_NODES", "160")),
+            )
+            return client, pools
+        case "single":
+            pass
+        case _:
+            print(f"Unknown cache backend: {backend}. Using a single redis node")
+    pool = create_connection_pool(decode_responses)
+    return redis.Redis(connection_pool=pool), [pool]
 
 # Initialize Redis client
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'redis'), # This approach allows the redis host to be set to localhost too, which enables objects outside the docker container to interact with it too (useful for quickly running tests).
-    port=6379,
-    decode_responses=True
-)
-
-
-# TODO: I was trying to implement a vector embedding cache, but it's not working as expected. Some issue with syncing with redis.
-# def create_vector_index() -> str:
-#     """
-#     Creates the vector index if it doesn't already exist.
-    
-#     Args:
-#         index_name: The name of the index to create (default: "idx:vector_cache")
-#     """
-#     index_name = "idx:vector_cache"
-    
-#     # Check if index already exists
-#     try:
-#         redis_client.ft(index_name).info()
-#         return index_name  # Index exists, no need to create it
-#     except redis.ResponseError as e:
-#         expected_error: bool = "Unknown index name" in str(e)
-#         if not expected_error:
-#             raise e
-    
-#     # Define the schema for our vector index
-#     schema = (
-#         TextField("$.id", as_name="id"),
-#         TextField("$.query", as_name="query"),
-#         TextField("$.response", as_name="response"),
-#         VectorField(
-#             "$.query_embedding",
-#             "FLAT",
-#             {
-#                 "TYPE": "FLOAT32",
-#                 "DIM": 384,  # all-MiniLM-L6-v2 dimension
-#                 "DISTANCE_METRIC": "COSINE",
-#             },
-#             as_name="query_embedding",
-#         ),
-#     )
-    
-#     definition = IndexDefinition(prefix=["vector_cache:"], index_type=IndexType.JSON)
-    
-#     # Create the index
-#     redis_client.ft(index_name).create_index(
-#         fields=schema,
-#         definition=definition
-#     )
-#     return index_name
-
-# create_vector_index() 
\ No newline at end of file
+redis_client, connection_pools = create_client()
+
+# Returns raw bytes instead of decoding to str, for values that aren't text (eg: float32 embeddings)
+redis_binary_client, binary_connection_pools = create_client(decode_responses=False)
+
+async def close_redis_client() -> None:
+    """Closes the clients and disconnects every pooled connection. Call this once on shutdown."""
+    await redis_client.aclose()
+    await redis_binary_client.aclose()
+    for pool in connection_pools + binary_connection_pools:
+        await pool.disconnect()
+
+def _checked_out(pool) -> int | None:
+    """
+    How many connections of a pool (or cluster node) are checked out. redis-py doesn't expose it, so this reads its private
+    attributes, and returns None rather than failing if a version of redis-py doesn't have them.
+    """
+    in_use = getattr(pool, "_in_use_connections", None)
+    if in_use is not None:
+        return len(in_use)
+    connections, free = getattr(pool, "_connections", None), getattr(pool, "_free", None)
+    if connections is not None and free is not None:
+        return len(connections) - len(free)
+    return None
+
+def _total(values: list[int | None]) -> int | None:
+    return None if None in values else sum(values)
+
+def pool_utilisation() -> dict[str, int | None]:
+    """
+    Returns how many pooled connections are currently checked out vs the pool size (summed over the nodes). Either is None
+    if it can't be read from this version of redis-py.
+    """
+    pools = redis_client.get_nodes() if isinstance(redis_client, RedisCluster) else connection_pools
+    return {
+        "in_use": _total([_checked_out(pool) for pool in pools]),
+        "max": _total([getattr(pool, "max_connections", None) for pool in pools]),
+    }
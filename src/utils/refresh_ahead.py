@@ -0,0 +1,164 @@
+"""
+Refreshes entries of the exact match store in the background, so that callers don't pay for an LLM call when a popular
+entry expires.
+
+* Stale-while-revalidate: entries are kept in redis for CACHE_STALE_TTL seconds past their (soft) TTL, up to their hard TTL
+  (see `ttl_policy.py`). A hit on an entry past its soft TTL is still answered from the cache, and starts a refresh.
+* Refresh-ahead: a hit on an entry in the last REFRESH_AHEAD_FRACTION of its soft TTL starts a refresh if the entry is hot,
+  ie: this worker has seen at least REFRESH_AHEAD_MIN_RATE hits per minute on it. Cold entries are left to expire. The L1
+  copy of an entry expires when its refresh-ahead window starts, so that the hits in that window reach redis.
+
+A refresh is an LLM call at background priority (see `upstream_scheduler.py`), coalesced with any concurrent call for the
+same query, whose response is cached like any other. Only one refresh of an entry runs at a time across workers: the worker
+that starts it holds the `refresh_lock:<cache key>` key for REFRESH_LOCK_TTL seconds, which also stops the entry from being
+refreshed again before then if the refresh failed. While the upstream is failing, stale entries keep being served until
+their hard TTL.
+
+Refreshes have their own budget on top of the upstream scheduler's: at most REFRESH_MAX_CONCURRENCY at a time and
+REFRESH_PER_MINUTE per minute, per worker. Refreshes over budget are skipped (a later hit tries again) rather than queued, so
+they never pile up in front of interactive misses.
+
+Configuration (all optional):
+* CACHE_STALE_TTL: seconds, defaults to 0 (no stale-while-revalidate), see `ttl_policy.py`
+* REFRESH_AHEAD_FRACTION: defaults to 0 (no refresh-ahead), eg: 0.1 for the last 10% of the TTL
+* REFRESH_AHEAD_MIN_RATE: hits per minute, defaults to 1
+* REFRESH_MAX_CONCURRENCY: defaults to 4
+* REFRESH_PER_MINUTE: defaults to 60
+* REFRESH_LOCK_TTL: seconds, defaults to 60
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from src.utils.redis_client import redis_client
+from src.utils.coalesce_requests import coalesce
+from src.utils.upstream_scheduler import TokenBucket, BACKGROUND
+from src.utils.ttl_policy import stale_ttl
+from src.utils.cache_key import cache_key
+
+LOCK_PREFIX = "refresh_lock:"
+MAX_TRACKED_KEYS = 10_000 # hit rates are only tracked for the most recently hit keys
+
+_worker_id = uuid.uuid4().hex
+
+async def refresh_query(query: str) -> None:
+    """Queries the LLM again; `query_llm` caches the new response."""
+    # Imported here since query_llm depends on the cache modules, which depend on this one
+    from src.utils.query_llm import query_llm
+    await coalesce(query, lambda: query_llm(query, {}, BACKGROUND))
+
+class Refresher:
+    def __init__(
+        self,
+        refresh: Callable[[str], Awaitable[None]],
+        ahead_fraction: float,
+        min_rate: float,
+        max_concurrency: int,
+        per_minute: float,
+        lock_ttl: int,
+    ):
+        self.refresh = refresh
+        self.ahead_fraction = ahead_fraction
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.lock_ttl = lock_ttl
+        self.budget = TokenBucket(per_minute)
+        self._hits: OrderedDict[str, tuple[float, int]] = OrderedDict() # key -> (time of the first hit, hits)
+        self._running: dict[str, asyncio.Task] = {}
+        self.stale_hits = 0
+        self.refreshed_stale = 0
+        self.refreshed_ahead = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def is_enabled(self) -> bool:
+        return self.ahead_fraction > 0 or stale_ttl() > 0
+
+    def record_hit(self, key: str) -> None:
+        """Counts a hit on an entry (from L1 or redis), to tell which entries are hot enough to be refreshed ahead."""
+        if self.ahead_fraction <= 0:
+            return
+        first_hit, hits = self._hits.pop(key, (time.monotonic(), 0))
+        self._hits[key] = (first_hit, hits + 1)
+        if len(self._hits) > MAX_TRACKED_KEYS:
+            self._hits.popitem(last=False)
+
+    def hit_rate(self, key: str) -> float:
+        """Hits per minute on the entry since its first tracked hit."""
+        first_hit, hits = self._hits.get(key, (0.0, 0))
+        if hits < 2:
+            return 0.0
+        return (hits - 1) / max(time.monotonic() - first_hit, 1.0) * 60
+
+    def local_ttl(self, remaining_ttl: float, age: float | None) -> float:
+        """How long an L1 copy of an entry can be kept: until its refresh-ahead window starts, or its soft TTL without one."""
+        if self.ahead_fraction <= 0 or age is None:
+            return remaining_ttl
+        return remaining_ttl - (age + remaining_ttl) * self.ahead_fraction
+
+    def on_hit(self, key: str, remaining_ttl: float, age: float | None) -> None:
+        """
+        Called on every redis hit with what's left of the entry's soft TTL (negative once it's stale) and its age, if known.
+        Starts a refresh if the entry is stale, or hot and about to expire.
+        """
+        self.record_hit(key)
+        if remaining_ttl <= 0:
+            self.stale_hits += 1
+            self.schedule(key)
+        elif self.local_ttl(remaining_ttl, age) <= 0 and self.hit_rate(key) >= self.min_rate:
+            self.schedule(key, ahead=True)
+
+    def schedule(self, key: str, ahead: bool = False) -> bool:
+        """Starts refreshing the entry in the background, unless it already is or that would exceed the budget."""
+        if key in self._running:
+            return False
+        if len(self._running) >= self.max_concurrency or self.budget.time_until_available(1) > 0:
+            self.skipped += 1
+            return False
+        self.budget.consume(1)
+        self._hits.pop(key, None) # the refreshed entry starts afresh
+        task = asyncio.create_task(self._refresh(key, ahead))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+        return True
+
+    async def _refresh(self, key: str, ahead: bool) -> None:
+        try:
+            if not await redis_client.set(f"{LOCK_PREFIX}{cache_key(key)}", _worker_id, nx=True, ex=self.lock_ttl):
+                self.budget.consume(-1) # another worker is refreshing it
+                return
+            if ahead:
+                self.refreshed_ahead += 1
+            else:
+                self.refreshed_stale += 1
+            await self.refresh(key)
+        except Exception as e:
+            self.errors += 1
+            print(f"Error refreshing the cache entry of {key!r}: {e}")
+
+    async def close(self) -> None:
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "stale_hits": self.stale_hits,
+            "refreshed_stale": self.refreshed_stale,
+            "refreshed_ahead": self.refreshed_ahead,
+            "skipped": self.skipped,
+            "errors": self.errors,
+        }
+
+refresher = Refresher(
+    refresh_query,
+    ahead_fraction=float(os.getenv("REFRESH_AHEAD_FRACTION", "0")),
+    min_rate=float(os.getenv("REFRESH_AHEAD_MIN_RATE", "1")),
+    max_concurrency=int(os.getenv("REFRESH_MAX_CONCURRENCY", "4")),
+    per_minute=float(os.getenv("REFRESH_PER_MINUTE", "60")),
+    lock_ttl=int(os.getenv("REFRESH_LOCK_TTL", "60")),
+)
@@ -0,0 +1,151 @@
+"""
+Client-side sharding of the cache over several independent redis nodes (the "sharded" backend, see `redis_client.py`).
+
+Keys are spread over the nodes by consistent hashing: each node is placed at REDIS_VIRTUAL_NODES points of a hash ring, and
+a key belongs to the first node clockwise from the key's hash. Adding or removing a node only moves the keys of its
+neighbouring arcs (about 1/N of the keys) instead of reshuffling everything, and the virtual nodes keep the shards even.
+Like in Redis Cluster, only the part of a key inside `{...}` is hashed if there is one, so related keys can be kept together.
+
+`ShardedRedis` has the command API of `redis.asyncio.Redis` that the cache uses, so the rest of the code doesn't need to know
+which backend it talks to:
+* single-key commands (get, set, hset, expire, xadd, eval with its keys on one node, ...) are sent to the key's node
+* pipelines queue their commands per node, execute every node's pipeline concurrently (one round-trip per node involved),
+  and return the replies in the order the commands were queued
+* scan_iter scans every node, and ping, flushdb and aclose apply to all of them
+* pub/sub (publish and pubsub) goes through the first node, so that every worker subscribes where messages are published
+"""
+import asyncio
+import bisect
+import hashlib
+from typing import AsyncIterator
+import redis.asyncio as redis
+
+def hash_key(key: str | bytes) -> int:
+    if isinstance(key, str):
+        key = key.encode()
+    # Hash tags: only hash what's inside the first {...}, if it isn't empty
+    start = key.find(b"{")
+    if start != -1:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes: list[str], virtual_nodes: int = 160):
+        points = sorted((hash_key(f"{node}#{i}"), shard) for shard, node in enumerate(nodes) for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str | bytes) -> int:
+        """The index of the node that `key` belongs to."""
+        position = bisect.bisect(self._hashes, hash_key(key))
+        return self._shards[position % len(self._shards)]
+
+class ShardedRedis:
+    def __init__(self, clients: list[redis.Redis], nodes: list[str], virtual_nodes: int = 160):
+        self.clients = clients
+        self.ring = HashRing(nodes, virtual_nodes)
+
+    def client_for(self, key: str | bytes) -> redis.Redis:
+        return self.clients[self.ring.shard_for(key)]
+
+    def __getattr__(self, name: str):
+        if not callable(getattr(redis.Redis, name, None)):
+            raise AttributeError(name)
+        async def command(key, *args, **kwargs):
+            return await getattr(self.client_for(key), name)(key, *args, **kwargs)
+        return command
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args):
+        # Every key of the script must be on the node of the first one (eg: by sharing a hash tag)
+        client = self.client_for(keys_and_args[0]) if numkeys else self.clients[0]
+        return await client.eval(script, numkeys, *keys_and_args)
+
+    async def xread(self, streams: dict, *args, **kwargs):
+        (stream,) = streams # a single stream, read from its node
+        return await self.client_for(stream).xread(streams, *args, **kwargs)
+
+    async def delete(self, *keys) -> int:
+        by_shard: dict[int, list] = {}
+        for key in keys:
+            by_shard.setdefault(self.ring.shard_for(key), []).append(key)
+        deleted = await asyncio.gather(*(self.clients[shard].delete(*shard_keys) for shard, shard_keys in by_shard.items()))
+        return sum(deleted)
+
+    async def publish(self, channel, message) -> int:
+        return await self.clients[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.clients[0].pubsub(**kwargs)
+
+    async def scan_iter(self, match=None, count=None, **kwargs) -> AsyncIterator:
+        for client in self.clients:
+            async for key in client.scan_iter(match=match, count=count, **kwargs):
+                yield key
+
+    async def ping(self) -> bool:
+        return all(await asyncio.gather(*(client.ping() for client in self.clients)))
+
+    async def flushdb(self, **kwargs) -> bool:
+        return all(await asyncio.gather(*(client.flushdb(**kwargs) for client in self.clients)))
+
+    def pipeline(self, transaction: bool = False) -> "ShardedPipeline":
+        if transaction:
+            raise ValueError("Transactions can't span the nodes of a sharded redis backend")
+        return ShardedPipeline(self)
+
+    async def aclose(self) -> None:
+        await asyncio.gather(*(client.aclose() for client in self.clients))
+
+class ShardedPipeline:
+    """Queues commands per node; `execute` sends one pipeline to each node involved, concurrently."""
+    def __init__(self, sharded: ShardedRedis):
+        self.sharded = sharded
+        self._commands: list[tuple[int, str, tuple, dict]] = [] # (shard, command, args, kwargs), in the order they were queued
+
+    async def __aenter__(self) -> "ShardedPipeline":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._commands = []
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def __getattr__(self, name: str):
+        if not callable(getattr(redis.Redis, name, None)):
+            raise AttributeError(name)
+        def queue(key, *args, **kwargs) -> "ShardedPipeline":
+            self._commands.append((self.sharded.ring.shard_for(key), name, (key, *args), kwargs))
+            return self
+        return queue
+
+    def eval(self, script: str, numkeys: int, *keys_and_args) -> "ShardedPipeline":
+        shard = self.sharded.ring.shard_for(keys_and_args[0]) if numkeys else 0
+        self._commands.append((shard, "eval", (script, numkeys, *keys_and_args), {}))
+        return self
+
+    def publish(self, channel, message) -> "ShardedPipeline":
+        self._commands.append((0, "publish", (channel, message), {}))
+        return self
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        commands, self._commands = self._commands, []
+        by_shard: dict[int, list[int]] = {}
+        for position, (shard, *_) in enumerate(commands):
+            by_shard.setdefault(shard, []).append(position)
+
+        async def execute_shard(shard: int, positions: list[int]) -> list:
+            async with self.sharded.clients[shard].pipeline(transaction=False) as pipe:
+                for position in positions:
+                    _, name, args, kwargs = commands[position]
+                    getattr(pipe, name)(*args, **kwargs)
+                return await pipe.execute(raise_on_error=raise_on_error)
+
+        replies = [None] * len(commands)
+        shard_replies = await asyncio.gather(*(execute_shard(shard, positions) for shard, positions in by_shard.items()))
+        for positions, shard_reply in zip(by_shard.values(), shard_replies):
+            for position, reply in zip(positions, shard_reply):
+                replies[position] = reply
+        return replies
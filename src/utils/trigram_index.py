@@ -0,0 +1,81 @@
+"""
+A process-local inverted index of character trigrams, for finding near-duplicate strings without an embedding model.
+
+Each string is represented by the set of its character trigrams (padded, so that word starts count too), and the similarity
+of two strings is the Jaccard similarity of their sets: |A ∩ B| / |A ∪ B|. The index maps every trigram to the strings that
+contain it.
+
+A search doesn't scan every posting list of the query: a string whose Jaccard similarity with the query is at least t shares
+at least t * |A| of the query's |A| trigrams, so it must contain one of any |A| - ceil(t * |A|) + 1 of them. Only the posting
+lists of that many of the query's rarest trigrams are scanned to collect candidates, which are then scored exactly.
+"""
+import math
+from collections import defaultdict
+
+def trigrams(text: str) -> frozenset[str]:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def jaccard(a: frozenset[str], b: frozenset[str]) -> float:
+    if not a and not b:
+        return 1.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+class TrigramIndex:
+    def __init__(self):
+        self._postings: defaultdict[str, set[str]] = defaultdict(set) # trigram -> strings that contain it
+        self._trigrams: dict[str, frozenset[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._trigrams)
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._trigrams
+
+    def add(self, text: str) -> None:
+        if text in self._trigrams:
+            return
+        grams = trigrams(text)
+        self._trigrams[text] = grams
+        for gram in grams:
+            self._postings[gram].add(text)
+
+    def remove(self, text: str) -> None:
+        grams = self._trigrams.pop(text, None)
+        if grams is None:
+            return
+        for gram in grams:
+            posting = self._postings[gram]
+            posting.discard(text)
+            if not posting:
+                del self._postings[gram]
+
+    def search(self, text: str, threshold: float, k: int = 3) -> list[tuple[str, float]]:
+        """Returns up to `k` indexed strings at least `threshold` similar to `text`, as (string, similarity), most similar first."""
+        query = trigrams(text)
+        if not query:
+            return []
+        # Rarest trigrams first, and only as many as needed to find every string above the threshold
+        grams = sorted(query, key=lambda gram: len(self._postings.get(gram, ())))
+        prefix_length = len(query) - math.ceil(threshold * len(query)) + 1
+        candidates = set()
+        for gram in grams[:prefix_length]:
+            candidates.update(self._postings.get(gram, ()))
+
+        # Strings of very different lengths can't be similar enough either: |B| must be within [t * |A|, |A| / t]
+        min_size, max_size = threshold * len(query), len(query) / threshold if threshold > 0 else math.inf
+        matches = []
+        for candidate in candidates:
+            candidate_grams = self._trigrams[candidate]
+            if not min_size <= len(candidate_grams) <= max_size:
+                continue
+            similarity = jaccard(query, candidate_grams)
+            if similarity >= threshold:
+                matches.append((candidate, similarity))
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches[:k]
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._trigrams.clear()
@@ -0,0 +1,193 @@
+"""
+Decides how long a response is cached for (see `calculate_TTL`), based on how time-sensitive its query is.
+
+Queries are classified with precompiled keyword patterns into categories, each with its own TTL. The categories are checked
+from the shortest TTL to the longest and the first match wins, so "what's the latest news today" is cached for as long as
+"today" allows. Queries that match no category are considered evergreen and get the default TTL. A TTL of 0 means the
+response isn't cached at all (eg: "what time is it in Tokyo?").
+
+The TTLs (and patterns, which are matched against the lowercased query) of the built-in categories can be overridden, and
+new categories added, with a JSON file:
+    {"default_ttl": 2592000, "categories": [{"name": "daily", "ttl": 43200}, {"name": "sports", "ttl": 1800, "patterns": ["\\\\bmatch\\\\b"]}]}
+
+Optionally (TTL_ADAPTIVE=TRUE, exact match strategy only), TTLs also adapt to how entries are used:
+* a redis hit extends the entry's TTL by TTL_HIT_EXTENSION times its base TTL, up to TTL_MAX_FACTOR times the base TTL
+* when a refresh (eg: forceRefresh) produces a different answer than the cached one, the TTL of that query is multiplied by
+  TTL_CHANGE_FACTOR (down to TTL_MIN_FACTOR), for this write and every later one. The factors are kept in the
+  `ttl_adjustments` redis hash so that every worker uses them.
+
+Entries of the exact match store can also outlive their TTL (the soft TTL) by CACHE_STALE_TTL seconds (up to their hard TTL):
+in between, they are still served but refreshed in the background (see `refresh_ahead.py`). Their redis expiry is the
+hard TTL, so the soft TTLs above are the redis TTL minus CACHE_STALE_TTL.
+
+Configuration (all optional):
+* TTL_POLICY: "keywords" (default) or "fixed" (always the default TTL)
+* TTL_POLICY_FILE: path of a JSON file overriding the categories, as above
+* TTL_ADAPTIVE: set to "TRUE" to enable adaptive TTLs
+* TTL_HIT_EXTENSION: defaults to 0.25
+* TTL_MAX_FACTOR: defaults to 2
+* TTL_CHANGE_FACTOR: defaults to 0.5
+* TTL_MIN_FACTOR: defaults to 0.0625
+* CACHE_STALE_TTL: seconds, defaults to 0 (entries expire at their TTL)
+"""
+import asyncio
+import json
+import os
+import re
+from dataclasses import dataclass
+from src.utils.redis_client import redis_client
+from src.utils.cache_key import cache_key
+
+DEFAULT_TTL = 60*60*24*30 # 1 month
+ADJUSTMENTS_KEY = "ttl_adjustments"
+
+# Topics that change over time (prices, scores, office holders, ...) are only matched together with a cue that the question
+# is about their present value ("current", "today", "now", "these days", "who is the ..."), so that evergreen and historical
+# questions about them ("how does the stock market work", "who was the president in 1990") get the default TTL. Clock
+# questions must be about the clock itself ("what's the time in tokyo?", not "what's the time complexity of quicksort?").
+_PRESENT = r"(?:current|latest|live|today'?s|tonight'?s)"
+_QUOTED = r"(?:stock|share|gold|oil|bitcoin|crypto\w*)"
+# Kings and queens are left out: they reign for decades, and "who is the king of pop" isn't about a monarch
+_OFFICES = r"(?:president|prime minister|chancellor|ceo|pope|mayor|governor|leader)"
+_NOW = r"(?:now|right now|today|nowadays|these days|currently)"
+_END = r"\s*[?.!]*\s*$"
+# What "current" is followed by when it's the noun ("what is current in a circuit?", "current flows through ...") or the
+# state of a program ("how do I get the current date in python?") rather than the present. Clock questions are matched above.
+_NOT_PRESENT = (
+    r"(?:in|of|through|flows?|and|or|vs|versus|is|was|are|at|to|from|for|on|with|by|into|density|source|divider|limit\w*"
+    r"|date|time|timestamp|directory|working|folder|path|url|page|user|thread|process|branch|line|window)"
+)
+
+# (name, ttl in seconds, patterns), from the most to the least time-sensitive
+DEFAULT_CATEGORIES: list[tuple[str, int, list[str]]] = [
+    ("clock", 0, [
+        rf"\b(current|local) (date|time)( now)?{_END}", r"\bwhat time is it\b", r"\btime (is it )?now\b",
+        rf"\bwhat(?:'s| is) the (current |local )?(date|time)( {_NOW}| in [a-z .]+)?{_END}",
+    ]),
+    ("realtime", 60*10, [
+        r"\bright now\b", r"\blive (scores?|results?|updates?|streams?|coverage)\b", r"\bweather (in|at|for|like|today|tomorrow|now)\b",
+        r"\bforecast (for|in)\b", r"\btraffic (in|on|at|near|like)\b", r"\bair quality (in|at|today|now)\b",
+        rf"\b{_PRESENT} scores?\b", r"\bwhat(?:'s| is) the score\b", r"\bscore of (the|tonight'?s|today'?s) (game|match)\b",
+        rf"\b{_PRESENT} {_QUOTED} prices?\b", rf"\b{_QUOTED} prices? (today|now)\b", r"\bprice of (bitcoin|gold|crude|oil|\w+ stock|\w+ shares?)\b",
+        r"\b(current|today'?s|latest) exchange rates?\b", r"\bexchange rate (today|now|for|between|from)\b",
+        r"\bstock market (today|now|this week)\b", r"\bhow (is|did) the stock market do(ing)?\b", r"\btrading at\b",
+    ]),
+    ("daily", 60*60*6, [
+        r"\btoday\b", r"\btonight\b", r"\byesterday\b", r"\btomorrow\b", r"\bthis (morning|afternoon|evening)\b",
+        r"\b(latest|today'?s|breaking|recent|current) news\b", r"\bnews (about|on|from)\b", r"\bheadlines?\b",
+        rf"\b{_PRESENT} (price|cost) of\b", rf"\b(price|cost) of .+ {_NOW}{_END}", rf"\bhow much (is|are|does|do) .+ cost {_NOW}{_END}",
+    ]),
+    ("weekly", 60*60*24, [
+        r"\b(this|next|last) (week|weekend)\b", r"\bupcoming\b", r"\bschedule (for|of)\b", r"\btrending\b",
+        r"\bbox office\b", r"\bopening hours\b",
+    ]),
+    ("recent", 60*60*24*7, [
+        rf"\bcurrent (?!{_NOT_PRESENT}\b)\w", r"\bcurrently\b", r"\blatest\b", r"\bnewest\b", r"\brecent(ly)?\b",
+        rf"\bnow{_END}", r"\bnowadays\b", r"\bthese days\b", r"\bthis (month|year|season)\b",
+        rf"\bwho(?:'s| is) (the )?{_OFFICES}\b", rf"\bwho (runs|leads|governs)\b", r"\breigning\b",
+        r"\bwhat(?:'s| is) the population\b", r"\bhow many people live in\b", r"\b(is|are) (the )?(most|least) populous\b",
+    ]),
+]
+
+@dataclass
+class TTLCategory:
+    name: str
+    ttl: int
+    pattern: re.Pattern
+
+class KeywordTTLPolicy:
+    def __init__(self, categories: list[tuple[str, int, list[str]]], default_ttl: int = DEFAULT_TTL):
+        self.default_ttl = default_ttl
+        # Compiled once, so classifying a query is a few regex searches. Lowercasing the query up front is about twice as
+        # fast as matching case-insensitively, so the patterns are written in lowercase.
+        self.categories = [
+            TTLCategory(name, ttl, re.compile("|".join(f"(?:{pattern})" for pattern in patterns)))
+            for name, ttl, patterns in sorted(categories, key=lambda category: category[1])
+        ]
+
+    def classify(self, query: str) -> TTLCategory | None:
+        query = query.lower()
+        for category in self.categories:
+            if category.pattern.search(query):
+                return category
+        return None
+
+    def ttl(self, query: str) -> int:
+        category = self.classify(query)
+        return category.ttl if category is not None else self.default_ttl
+
+class FixedTTLPolicy:
+    def __init__(self, default_ttl: int = DEFAULT_TTL):
+        self.default_ttl = default_ttl
+
+    def ttl(self, query: str) -> int:
+        return self.default_ttl
+
+def load_categories(path: str | None) -> tuple[list[tuple[str, int, list[str]]], int]:
+    """Returns the built-in categories and default TTL, with the overrides of the JSON file at `path` (if any) applied."""
+    categories = {name: (name, ttl, patterns) for name, ttl, patterns in DEFAULT_CATEGORIES}
+    if not path:
+        return list(categories.values()), DEFAULT_TTL
+    with open(path) as f:
+        config = json.load(f)
+    for override in config.get("categories", []):
+        name = override["name"]
+        _, ttl, patterns = categories.get(name, (name, DEFAULT_TTL, []))
+        categories[name] = (name, int(override.get("ttl", ttl)), override.get("patterns", patterns))
+    return list(categories.values()), int(config.get("default_ttl", DEFAULT_TTL))
+
+def create_policy() -> KeywordTTLPolicy | FixedTTLPolicy:
+    categories, default_ttl = load_categories(os.getenv("TTL_POLICY_FILE"))
+    match os.getenv("TTL_POLICY", "keywords"):
+        case "fixed":
+            return FixedTTLPolicy(default_ttl)
+        case "keywords":
+            return KeywordTTLPolicy(categories, default_ttl)
+        case policy:
+            print(f"Unknown TTL policy: {policy}. Using keywords")
+            return KeywordTTLPolicy(categories, default_ttl)
+
+def stale_ttl() -> int:
+    """How long entries are served stale after their (soft) TTL, while they are refreshed."""
+    return int(os.getenv("CACHE_STALE_TTL", "0"))
+
+def is_adaptive() -> bool:
+    return os.getenv("TTL_ADAPTIVE") == "TRUE"
+
+async def get_adjustments(queries: list[str]) -> list[float]:
+    """The TTL factors of the given queries (1.0 for queries whose answer has never changed)."""
+    if not is_adaptive() or not queries:
+        return [1.0] * len(queries)
+    factors = await redis_client.hmget(ADJUSTMENTS_KEY, [cache_key(query) for query in queries])
+    return [float(factor) if factor is not None else 1.0 for factor in factors]
+
+def shortened_factor(factor: float) -> float:
+    """The new TTL factor of a query whose answer has just changed."""
+    change_factor = float(os.getenv("TTL_CHANGE_FACTOR", "0.5"))
+    return max(float(os.getenv("TTL_MIN_FACTOR", "0.0625")), factor * change_factor)
+
+_extension_tasks: set[asyncio.Task] = set()
+
+def extend_on_hit(query: str, remaining_ttl: float) -> None:
+    """
+    Extends the TTL of an entry that was just hit, in the background so the hit isn't delayed.
+    `remaining_ttl` is what's left of its soft TTL.
+    """
+    if not is_adaptive() or remaining_ttl <= 0:
+        return
+    task = asyncio.create_task(_extend(query, remaining_ttl))
+    # Keep a reference until it's done, otherwise the task can be garbage collected mid-way
+    _extension_tasks.add(task)
+    task.add_done_callback(_extension_tasks.discard)
+
+async def _extend(query: str, remaining_ttl: float) -> None:
+    try:
+        (factor,) = await get_adjustments([query])
+        base_ttl = ttl_policy.ttl(query) * factor
+        extended_ttl = min(remaining_ttl + base_ttl * float(os.getenv("TTL_HIT_EXTENSION", "0.25")), base_ttl * float(os.getenv("TTL_MAX_FACTOR", "2")))
+        if extended_ttl > remaining_ttl:
+            await redis_client.expire(cache_key(query), round(extended_ttl) + stale_ttl(), gt=True)
+    except Exception as e:
+        print(f"Error extending the TTL of a cache entry: {e}")
+
+ttl_policy = create_policy()
@@ -0,0 +1,222 @@
+"""
+Schedules calls to the upstream LLM so that bursts of cache misses don't exceed the provider's rate limits.
+
+Every call first waits for a slot from the `UpstreamScheduler`, which enforces:
+* a token bucket of requests per minute (LLM_REQUESTS_PER_MINUTE, defaults to 500)
+* a token bucket of LLM tokens per minute (LLM_TOKENS_PER_MINUTE, defaults to 30000), using an estimate that is corrected
+  with the actual usage once the call returns
+* a cap on concurrent calls (LLM_MAX_CONCURRENCY, defaults to 50)
+
+Waiting calls are served in priority order, so interactive requests go ahead of background work (forceRefresh, batch jobs, ...).
+
+The limits adapt to throttling: a 429 pauses every call for the Retry-After period and halves the effective rates, which then
+recover gradually as calls succeed. `call_with_retries` retries throttled and transient failures with jittered exponential backoff.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+Result = TypeVar("Result")
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60 # tokens per second
+        self.rate_factor = 1.0 # lowered while the upstream is throttling us
+        self.tokens = per_minute
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate * self.rate_factor)
+        self._updated_at = now
+
+    def time_until_available(self, amount: float) -> float:
+        """Seconds until `amount` tokens can be consumed (0 if they can be consumed now)."""
+        self._refill()
+        # A single request larger than the bucket can never fit, so it only waits for the bucket to be full
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / (self.rate * self.rate_factor))
+
+    def consume(self, amount: float) -> None:
+        """Takes tokens out of the bucket; a negative amount returns them. The bucket may go into debt."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class UpstreamScheduler:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_concurrency: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.throttled = 0
+        self._waiting: list[tuple[int, int, float, asyncio.Future]] = [] # heap of (priority, arrival order, estimated tokens, future)
+        self._arrivals = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: asyncio.TimerHandle | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, future in self._waiting if not future.done())
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE, estimated_tokens: float = 0) -> AsyncIterator[float]:
+        """Waits for permission to call the upstream. Yields how long the caller waited, in seconds."""
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._arrivals), estimated_tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release() # the slot was granted just as the caller was cancelled
+            raise
+        try:
+            yield time.monotonic() - start
+        finally:
+            self._release()
+
+    def record_usage(self, estimated_tokens: float, actual_tokens: float) -> None:
+        """Corrects the token bucket once the real token usage of a call is known."""
+        self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def record_throttled(self, retry_after: float | None) -> None:
+        """The upstream returned a 429: pause all calls for `retry_after` seconds and halve the effective rates."""
+        self.throttled += 1
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        for bucket in (self.requests, self.tokens):
+            bucket.rate_factor = max(0.1, bucket.rate_factor * 0.5)
+
+    def record_success(self) -> None:
+        for bucket in (self.requests, self.tokens):
+            bucket.rate_factor = min(1.0, bucket.rate_factor + 0.05)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "throttled": self.throttled,
+            "rate_factor": self.requests.rate_factor,
+        }
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Grants slots to the highest priority waiters for as long as the limits allow."""
+        while self._waiting and self.in_flight < self.max_concurrency:
+            _, _, estimated_tokens, future = self._waiting[0]
+            if future.done(): # cancelled while waiting
+                heapq.heappop(self._waiting)
+                continue
+            wait = max(
+                self._paused_until - time.monotonic(),
+                self.requests.time_until_available(1),
+                self.tokens.time_until_available(estimated_tokens),
+            )
+            if wait > 0:
+                self._schedule_wakeup(wait)
+                return
+            heapq.heappop(self._waiting)
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float) -> None:
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+def retry_after_seconds(error: "openai.APIStatusError") -> float | None:
+    """Reads the Retry-After (or retry-after-ms) header of an error response, if there is one."""
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass # an HTTP date rather than a number of seconds; fall back to our own backoff
+    return None
+
+def is_retryable(error: Exception) -> bool:
+    import openai # only imported once a call fails, since importing it is slow (see `query_llm.get_client`)
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+async def call_with_retries(
+    scheduler: "UpstreamScheduler",
+    call: Callable[[], Awaitable[Result]],
+    priority: int = INTERACTIVE,
+    estimated_tokens: float = 0,
+    timing: dict[str, float] | None = None,
+) -> Result:
+    """
+    Makes an upstream call through the scheduler, retrying throttled and transient failures with jittered exponential
+    backoff (or the Retry-After the upstream asked for). The total time spent waiting for slots is added to
+    timing['upstream_queue_wait'].
+    """
+    async with holding_slot_with_retries(scheduler, call, priority, estimated_tokens, timing) as result:
+        return result
+
+@asynccontextmanager
+async def holding_slot_with_retries(
+    scheduler: "UpstreamScheduler",
+    call: Callable[[], Awaitable[Result]],
+    priority: int = INTERACTIVE,
+    estimated_tokens: float = 0,
+    timing: dict[str, float] | None = None,
+) -> AsyncIterator[Result]:
+    """
+    Same as `call_with_retries`, but the slot of the successful attempt is held until the `async with` block exits, eg:
+    while the stream the call returned is being consumed.
+    """
+    max_retries = int(os.getenv("LLM_MAX_RETRIES", "4"))
+    base_delay = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+    for attempt in range(max_retries + 1):
+        async with scheduler.slot(priority, estimated_tokens) as queue_wait:
+            if timing is not None:
+                timing['upstream_queue_wait'] = timing.get('upstream_queue_wait', 0.0) + queue_wait
+            try:
+                result = await call()
+            except Exception as e:
+                if attempt == max_retries or not is_retryable(e):
+                    raise
+                import openai
+                retry_after = retry_after_seconds(e) if isinstance(e, openai.APIStatusError) else None
+                if isinstance(e, openai.RateLimitError):
+                    scheduler.record_throttled(retry_after)
+                    # The scheduler is paused for the Retry-After period, so the next slot() waits for it
+                    delay = 0.0 if retry_after is not None else None
+                else:
+                    delay = retry_after # a 5xx with a Retry-After only delays this caller
+            else:
+                scheduler.record_success()
+                # Outside the try, so that errors of the caller's block aren't retried
+                yield result
+                return
+        # The slot has been given back, so that other calls can use it while this one waits
+        if delay is None:
+            # Full jitter, so that callers that failed at the same time don't all retry at the same time
+            delay = random.uniform(0, base_delay * 2 ** attempt)
+        await asyncio.sleep(delay)
+
+upstream_scheduler = UpstreamScheduler(
+    requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500")),
+    tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE", "30000")),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "50")),
+)
@@ -0,0 +1,381 @@
+"""
+The semantic cache used by the "vector_embedding" caching strategy.
+
+Redis is the durable store: every entry is a hash at `vector_cache:<id>`, where the id is the namespaced fingerprint of the
+query (`<namespace>:<digest>`, see `cache_key.py`), holding the query, the response (as an encoded
+`CacheEntry`, see `cache_entry.py`) and the float32 query embedding (as raw bytes), and it expires after `calculate_TTL` seconds like any other cache entry.
+Every write is also appended to the `vector_changelog` redis stream.
+
+Each worker keeps a local `VectorIndex` over the embeddings so that similarity search doesn't need a round-trip to redis.
+The index is built by scanning the `vector_cache:<namespace>:*` hashes when it's first used (or at startup), and is then kept up
+to date incrementally: writes from this worker are added directly, and writes from other workers are picked up from the changelog
+stream. Entries written for another model or instructions (whose id isn't the one their query would have here) are left out.
+Entries that have expired in redis are dropped from the index lazily, when a search finds them.
+
+With VECTOR_INDEX_SNAPSHOT set to a directory, workers open the index from the latest on-disk snapshot there instead (see
+`index_snapshot.py`), memory-mapped and shared between the worker processes, and catch up on the entries written since from
+the changelog stream. If the changelog no longer goes back to the snapshot (or redis was flushed), the index is rebuilt
+from redis as usual. Snapshots are written by `src/scripts/snapshot_vector_index.py`.
+
+The IVF centroids can be trained offline (eg: by `src/scripts/bulk_load.py`) and stored at `vector_index:centroids`, in
+which case workers start with a trained index instead of training one themselves once enough entries are loaded.
+
+Configuration (all optional):
+* SIMILARITY_THRESHOLD: minimum cosine similarity for a cache hit, defaults to 0.85
+* VECTOR_INDEX_NLIST / VECTOR_INDEX_NPROBE: see `VectorIndex`
+* VECTOR_INDEX_SNAPSHOT: directory of the index snapshots, unset by default (always build the index from redis)
+"""
+import asyncio
+import os
+import numpy as np
+from redis.exceptions import ResponseError
+from src.utils.redis_client import redis_binary_client
+from src.utils.vector_index import VectorIndex, train_centroids
+from src.utils.cache_entry import CacheEntry, encode_entry, decode_entry
+from src.utils.get_embeddings import DEFAULT_EMBEDDING_MODEL
+from src.utils.cache_key import canonical_query, fingerprint, namespace
+from src.utils import eviction, verifier, index_snapshot, metrics
+
+KEY_PREFIX = "vector_cache:"
+CHANGELOG_STREAM = "vector_changelog"
+CHANGELOG_MAX_LENGTH = 100_000
+SCAN_BATCH_SIZE = 1000
+CANDIDATES_PER_SEARCH = 3
+CENTROIDS_KEY = "vector_index:centroids"
+
+def stream_id(message_id: bytes | str) -> tuple[int, int]:
+    """Parses a redis stream message id ("<milliseconds>-<sequence>"), so that ids can be compared."""
+    milliseconds, sequence = (message_id.decode() if isinstance(message_id, bytes) else message_id).split("-")
+    return int(milliseconds), int(sequence)
+
+def entry_id(query: str, cache_namespace: str | None = None) -> str:
+    """Entry ids are derived from the query so that re-caching a query overwrites its previous entry."""
+    return fingerprint(canonical_query(query), cache_namespace)
+
+def scope() -> str:
+    """Identifies the namespace, model and instructions the entry ids are derived for, eg: to check a snapshot still applies."""
+    return entry_id("")
+
+def queue_write(pipe, query: str, entry: CacheEntry, query_embedding: np.ndarray, ttl: int) -> None:
+    """Adds the commands that write an entry (and append it to the changelog) to a redis pipeline."""
+    key = f"{KEY_PREFIX}{entry_id(query)}"
+    fields = {
+        "query": query.encode(),
+        "response": encode_entry(entry),
+        "embedding": np.asarray(query_embedding, dtype=np.float32).tobytes(),
+    }
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, ttl)
+    if eviction.is_enabled():
+        cost = eviction.entry_cost(query, entry.response, entry.input_tokens, entry.output_tokens)
+        eviction.track(pipe, key, len(key) + sum(len(value) for value in fields.values()), cost)
+    pipe.xadd(CHANGELOG_STREAM, {"id": entry_id(query)}, maxlen=CHANGELOG_MAX_LENGTH, approximate=True)
+
+async def save_centroids(centroids: np.ndarray) -> None:
+    """Stores trained IVF centroids, for workers to use when they build their index."""
+    centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+    await redis_binary_client.hset(CENTROIDS_KEY, mapping={"dim": centroids.shape[1], "centroids": centroids.tobytes()})
+
+async def load_centroids() -> np.ndarray | None:
+    stored = await redis_binary_client.hgetall(CENTROIDS_KEY)
+    if not stored:
+        return None
+    return np.frombuffer(stored[b"centroids"], dtype=np.float32).reshape(-1, int(stored[b"dim"]))
+
+class VectorCache:
+    def __init__(self):
+        self.index: VectorIndex | None = None
+        self._last_changelog_id = "0-0"
+        self._load_lock = asyncio.Lock()
+        self._loaded = False
+        self._sync_task: asyncio.Task | None = None
+        self._following_changelog = False
+        self._training_task: asyncio.Task | None = None
+
+    async def ensure_loaded(self) -> None:
+        """
+        Builds the local index on first use and starts following the changelog. The index is opened from the snapshot if
+        there's a usable one, and built from redis otherwise.
+        """
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            if not await self._load_snapshot():
+                await self._load_from_redis()
+
+            self._loaded = True
+            self._following_changelog = True
+            self._sync_task = asyncio.create_task(self._follow_changelog())
+
+    async def save_snapshot(self, directory: str) -> str | None:
+        """Writes the local index to a new snapshot (see `index_snapshot.py`). Returns its path, or None if the index is empty."""
+        await self.ensure_loaded()
+        # Catch up to the end of the changelog first, so that workers opening the snapshot have as little to replay as possible
+        while await self._read_changelog():
+            pass
+        if self._training_task is not None:
+            await self._training_task
+        if self.index is None or len(self.index) == 0:
+            return None
+        # Copied on the event loop, so that the changelog position matches the index even if entries keep arriving
+        arrays = self.index.to_arrays()
+        changelog_id = self._last_changelog_id.decode() if isinstance(self._last_changelog_id, bytes) else self._last_changelog_id
+        changelog_entries = await self._changelog_entries_until(changelog_id)
+        return await asyncio.to_thread(
+            index_snapshot.save_snapshot, directory, arrays, changelog_id, os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL),
+            changelog_entries, scope(),
+        )
+
+    async def search(self, query_embedding: np.ndarray, similarity_threshold: float | None = None, query: str | None = None) -> str | None:
+        """
+        Returns the cached response of the most similar cached query, if it is at least `similarity_threshold` similar.
+        If the verifier is enabled and `query` is given, the candidates are checked by the verifier instead (see `verifier.py`).
+        """
+        if query is not None and verifier.is_enabled():
+            return (await self.search_many(np.asarray(query_embedding)[None, :], similarity_threshold, [query]))[0]
+        await self.ensure_loaded()
+        if similarity_threshold is None:
+            similarity_threshold = float(os.getenv("SIMILARITY_THRESHOLD", "0.85"))
+        if self.index is None:
+            return None
+
+        with metrics.timed("ann_search"):
+            matches = self.index.search(query_embedding, k=CANDIDATES_PER_SEARCH)
+        for candidate_id, similarity in matches:
+            if similarity < similarity_threshold:
+                break
+            response = await redis_binary_client.hget(f"{KEY_PREFIX}{candidate_id}", "response")
+            if response is None:
+                self.index.remove(candidate_id) # expired in redis
+                continue
+            entry = decode_entry(response)
+            if entry is not None:
+                eviction.record_hit(f"{KEY_PREFIX}{candidate_id}")
+                return entry.response
+        return None
+
+    async def search_many(
+        self, query_embeddings: np.ndarray, similarity_threshold: float | None = None, queries: list[str] | None = None,
+    ) -> list[str | None]:
+        """
+        Same as `search` for each row of `query_embeddings` (and each of `queries`), with one index search for all of them
+        and one redis round-trip for all the candidate responses.
+        """
+        await self.ensure_loaded()
+        if similarity_threshold is None:
+            similarity_threshold = float(os.getenv("SIMILARITY_THRESHOLD", "0.85"))
+        if self.index is None or len(query_embeddings) == 0:
+            return [None] * len(query_embeddings)
+
+        verify = queries is not None and verifier.is_enabled()
+        k = CANDIDATES_PER_SEARCH
+        if verify:
+            # The verifier is stricter than the similarity threshold, so it is given more (and less similar) candidates
+            k, similarity_threshold = verifier.candidate_settings()
+        with metrics.timed("ann_search"):
+            candidates = [
+                [candidate_id for candidate_id, similarity in matches if similarity >= similarity_threshold]
+                for matches in self.index.search_many(query_embeddings, k=k)
+            ]
+        candidate_ids = list({candidate_id: None for matches in candidates for candidate_id in matches})
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for candidate_id in candidate_ids:
+                pipe.hget(f"{KEY_PREFIX}{candidate_id}", "response")
+            responses = dict(zip(candidate_ids, await pipe.execute()))
+
+        entries = {candidate_id: decode_entry(response) for candidate_id, response in responses.items() if response is not None}
+        candidates = [[candidate_id for candidate_id in matches if entries.get(candidate_id) is not None] for matches in candidates]
+        if verify:
+            # The candidates of every query are scored in one batch
+            best_matches = await verifier.best_matches([
+                (query, [entries[candidate_id].query or "" for candidate_id in matches]) for query, matches in zip(queries, candidates)
+            ])
+            hit_ids = [matches[best] if best is not None else None for matches, best in zip(candidates, best_matches)]
+        else:
+            hit_ids = [matches[0] if matches else None for matches in candidates]
+
+        results = []
+        for hit_id in hit_ids:
+            if hit_id is not None:
+                eviction.record_hit(f"{KEY_PREFIX}{hit_id}")
+            results.append(entries[hit_id].response if hit_id is not None else None)
+        for candidate_id, response in responses.items():
+            if response is None:
+                self.index.remove(candidate_id) # expired in redis
+        return results
+
+    async def add(self, query: str, response_text: str | CacheEntry, query_embedding: np.ndarray, ttl: int) -> None:
+        await self.add_many([(query, response_text, query_embedding, ttl)])
+
+    async def add_many(self, entries: list[tuple[str, str | CacheEntry, np.ndarray, int]]) -> None:
+        """
+        Writes (query, response, embedding, ttl) entries to redis in one pipeline and adds them to the local index.
+        The response can be a CacheEntry, to store its metadata too.
+        """
+        await self.ensure_loaded()
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for query, response_text, query_embedding, ttl in entries:
+                entry = response_text if isinstance(response_text, CacheEntry) else CacheEntry(response_text, query)
+                queue_write(pipe, query, entry, query_embedding, ttl)
+            await pipe.execute()
+
+        for query, _, query_embedding, _ in entries:
+            self._add_to_index(entry_id(query), np.asarray(query_embedding, dtype=np.float32))
+
+    def clear(self) -> None:
+        """Forgets the local index (eg: after the redis db has been flushed). It is rebuilt from redis on next use."""
+        self._stop_following_changelog()
+        self.index = None
+        self._loaded = False
+        self._sync_task = None
+
+    async def close(self) -> None:
+        self._stop_following_changelog()
+        if self._training_task is not None:
+            self._training_task.cancel()
+
+    def _stop_following_changelog(self) -> None:
+        # The flag is checked as well as cancelling, since a blocking XREAD can absorb the cancellation
+        self._following_changelog = False
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+
+    async def _load_snapshot(self) -> bool:
+        """Opens the index from the current snapshot and catches up from the changelog. Returns False if there's no usable snapshot."""
+        directory = os.getenv("VECTOR_INDEX_SNAPSHOT")
+        if not directory:
+            return False
+        snapshot = await asyncio.to_thread(
+            index_snapshot.load_snapshot,
+            directory,
+            os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL),
+            int(os.getenv("VECTOR_INDEX_NLIST", "1024")),
+            int(os.getenv("VECTOR_INDEX_NPROBE", "8")),
+            scope(),
+        )
+        if snapshot is None:
+            return False
+        index, meta = snapshot
+        # The entries written since the snapshot can only be caught up if the (capped) changelog still holds all of them
+        if not await self._changelog_reaches(meta):
+            print("The vector index snapshot is older than the changelog, rebuilding the index from redis")
+            return False
+
+        self.index = index
+        self._last_changelog_id = meta["changelog_id"]
+        while await self._read_changelog():
+            pass
+        if self.index.should_train() and self._training_task is None:
+            self._training_task = asyncio.create_task(self._train_index())
+        return True
+
+    async def _changelog_entries_until(self, last_id: str) -> int | None:
+        """How many entries had been added to the changelog up to `last_id`, or None if redis doesn't count them (before 7.0)."""
+        try:
+            info = await redis_binary_client.xinfo_stream(CHANGELOG_STREAM)
+        except ResponseError:
+            return 0 # no changelog yet
+        if info.get("entries-added") is None:
+            return None
+        # The entries added since `last_id` are the newest ones, so they are all still in the stream
+        newer = 0
+        if stream_id(info["last-generated-id"]) > stream_id(last_id):
+            newer = len(await redis_binary_client.xrange(CHANGELOG_STREAM, min=f"({last_id}", max=info["last-generated-id"]))
+        return info["entries-added"] - newer
+
+    async def _changelog_reaches(self, meta: dict) -> bool:
+        """Whether every changelog entry written after the snapshot is still in the stream, ie: none of them has been trimmed."""
+        last_id = meta["changelog_id"]
+        try:
+            info = await redis_binary_client.xinfo_stream(CHANGELOG_STREAM)
+        except ResponseError:
+            return last_id == "0-0" # the changelog is gone, eg: redis was flushed
+        if meta.get("changelog_entries") is not None and info.get("entries-added") is not None:
+            # Trimming removes the oldest entries first, so the newer ones are all there as long as the stream is long enough
+            return info["length"] >= info["entries-added"] - meta["changelog_entries"]
+        # Otherwise, it does if the last entry the snapshot includes hasn't been trimmed yet
+        if last_id == "0-0":
+            return not info["length"]
+        return bool(await redis_binary_client.xrange(CHANGELOG_STREAM, min=last_id, max=last_id, count=1))
+
+    async def _load_from_redis(self) -> None:
+        # Remember where the changelog ends *before* scanning, so writes that happen during the scan are replayed afterwards
+        latest = await redis_binary_client.xrevrange(CHANGELOG_STREAM, count=1)
+        self._last_changelog_id = latest[0][0] if latest else "0-0"
+        centroids = await load_centroids()
+        if centroids is not None:
+            self._create_index(centroids.shape[1])
+            self.index.set_centroids(centroids)
+
+        batch = []
+        async for key in redis_binary_client.scan_iter(match=f"{KEY_PREFIX}{namespace()}:*", count=SCAN_BATCH_SIZE):
+            batch.append(key)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                await self._load_keys(batch)
+                batch = []
+        await self._load_keys(batch)
+
+    async def _load_keys(self, keys: list[bytes]) -> None:
+        if not keys:
+            return
+        async with redis_binary_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hmget(key, "embedding", "query")
+            fields = await pipe.execute()
+        for key, (embedding, query) in zip(keys, fields):
+            key_id = key.decode()[len(KEY_PREFIX):]
+            if embedding is not None and query is not None and entry_id(query.decode()) == key_id:
+                self._add_to_index(key_id, np.frombuffer(embedding, dtype=np.float32))
+
+    def _create_index(self, dim: int) -> None:
+        self.index = VectorIndex(
+            dim=dim,
+            nlist=int(os.getenv("VECTOR_INDEX_NLIST", "1024")),
+            nprobe=int(os.getenv("VECTOR_INDEX_NPROBE", "8")),
+        )
+
+    def _add_to_index(self, entry_id: str, embedding: np.ndarray) -> None:
+        if self.index is None:
+            self._create_index(len(embedding))
+        self.index.add(entry_id, embedding)
+        if self.index.should_train() and self._training_task is None:
+            self._training_task = asyncio.create_task(self._train_index())
+
+    async def _train_index(self) -> None:
+        """Trains the IVF centroids in a thread, so the event loop keeps serving requests meanwhile."""
+        try:
+            sample = self.index.sample(self.index.train_size)
+            centroids = await asyncio.to_thread(train_centroids, sample, self.index.nlist)
+            self.index.set_centroids(centroids)
+        finally:
+            self._training_task = None
+
+    async def _follow_changelog(self) -> None:
+        """Adds entries written by other workers to the local index as they appear in the changelog stream."""
+        while self._following_changelog:
+            try:
+                await self._read_changelog(block=1000)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error while following the vector cache changelog: {e}")
+                await asyncio.sleep(1)
+
+    async def _read_changelog(self, block: int | None = None) -> int:
+        """Loads the entries of the next changelog messages that aren't in the index yet. Returns the number of messages read."""
+        streams = await redis_binary_client.xread({CHANGELOG_STREAM: self._last_changelog_id}, count=SCAN_BATCH_SIZE, block=block)
+        read = 0
+        for _, messages in streams:
+            new_ids = []
+            for message_id, fields in messages:
+                self._last_changelog_id = message_id
+                changed_id = fields[b"id"].decode()
+                if self.index is None or changed_id not in self.index:
+                    new_ids.append(f"{KEY_PREFIX}{changed_id}".encode())
+            await self._load_keys(new_ids)
+            read += len(messages)
+        return read
+
+vector_cache = VectorCache()
@@ -0,0 +1,236 @@
+"""
+A process-local approximate nearest neighbour (ANN) index over float32 embeddings, implemented with NumPy.
+
+It is an IVF (inverted file) index: the embedding space is partitioned into `nlist` clusters with k-means, every vector is
+stored in the list of its closest centroid, and a search only scans the `nprobe` lists whose centroids are closest to the query.
+Until there are enough vectors to train the centroids, everything lives in a single list and searches are exact.
+
+Vectors are expected to be unit-normalized, so the inner product is the cosine similarity.
+Each list keeps its vectors in one contiguous, geometrically grown float32 array so that scanning it is a single matrix-vector product.
+An index can also be rebuilt around existing arrays without copying them (`from_arrays`), eg: memory-mapped from a snapshot
+(see `index_snapshot.py`). A list only gets its own copy of its vectors once it's modified.
+"""
+import numpy as np
+
+class _InvertedList:
+    def __init__(self, dim: int, capacity: int = 16):
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.ids: list[str] = []
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, ids: list[str]) -> "_InvertedList":
+        """Wraps existing vectors (which may be memory-mapped) without copying them; they're only copied when the list grows."""
+        inverted_list = cls.__new__(cls)
+        inverted_list.vectors = vectors
+        inverted_list.ids = ids
+        return inverted_list
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, entry_id: str, vector: np.ndarray) -> int:
+        size = len(self.ids)
+        if size == self.vectors.shape[0]:
+            # A list loaded empty from a snapshot has no capacity to double
+            grown = np.empty((max(16, size * 2), self.vectors.shape[1]), dtype=np.float32)
+            grown[:size] = self.vectors
+            self.vectors = grown
+        self.vectors[size] = vector
+        self.ids.append(entry_id)
+        return size
+
+    def pop(self, position: int) -> str | None:
+        """Removes the entry at `position` by moving the last entry into its slot. Returns the id of the moved entry, if any."""
+        last = len(self.ids) - 1
+        moved_id = None
+        if position != last:
+            self.vectors[position] = self.vectors[last]
+            moved_id = self.ids[last]
+            self.ids[position] = moved_id
+        self.ids.pop()
+        return moved_id
+
+    def active_vectors(self) -> np.ndarray:
+        return self.vectors[:len(self.ids)]
+
+class VectorIndex:
+    def __init__(self, dim: int, nlist: int = 1024, nprobe: int = 8, train_factor: int = 16):
+        """
+        Args:
+            dim: dimension of the embeddings
+            nlist: number of clusters once the index is trained
+            nprobe: number of clusters scanned per search; higher is more accurate but slower
+            train_factor: the index is trained once it holds nlist * train_factor vectors
+        """
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = nlist * train_factor
+        self.centroids: np.ndarray | None = None
+        self._lists = [_InvertedList(dim)]
+        self._positions: dict[str, tuple[int, int]] = {} # entry id -> (list number, position in that list)
+
+    @classmethod
+    def from_arrays(
+        cls, centroids: np.ndarray | None, vectors: np.ndarray, ids: list[str], list_sizes: list[int], nlist: int = 1024, nprobe: int = 8,
+    ) -> "VectorIndex":
+        """
+        Rebuilds an index from the output of `to_arrays`. The vectors aren't copied: each list is a view of `vectors`.
+        `nlist` is only used if the index isn't trained (otherwise it's the number of centroids).
+        """
+        index = cls(dim=vectors.shape[1], nlist=len(centroids) if centroids is not None else nlist, nprobe=nprobe)
+        index.centroids = centroids
+        index._lists = []
+        start = 0
+        for list_number, size in enumerate(list_sizes):
+            list_ids = ids[start:start + size]
+            index._lists.append(_InvertedList.from_vectors(vectors[start:start + size], list_ids))
+            index._positions.update((entry_id, (list_number, position)) for position, entry_id in enumerate(list_ids))
+            start += size
+        return index
+
+    def to_arrays(self) -> tuple[np.ndarray | None, np.ndarray, list[str], list[int]]:
+        """Returns the centroids, every vector (grouped by list), their ids and the size of each list, eg: to save a snapshot."""
+        vectors = np.concatenate([inverted_list.active_vectors() for inverted_list in self._lists])
+        ids = [entry_id for inverted_list in self._lists for entry_id in inverted_list.ids]
+        return self.centroids, vectors, ids, [len(inverted_list) for inverted_list in self._lists]
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, entry_id: str) -> bool:
+        return entry_id in self._positions
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def should_train(self) -> bool:
+        return not self.is_trained and len(self) >= self.train_size
+
+    def add(self, entry_id: str, vector: np.ndarray) -> None:
+        """Adds a vector, replacing any existing vector with the same id."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        if entry_id in self._positions:
+            self.remove(entry_id)
+        list_number = self._assign(vector[np.newaxis, :])[0] if self.is_trained else 0
+        position = self._lists[list_number].append(entry_id, vector)
+        self._positions[entry_id] = (list_number, position)
+
+    def remove(self, entry_id: str) -> bool:
+        location = self._positions.pop(entry_id, None)
+        if location is None:
+            return False
+        list_number, position = location
+        moved_id = self._lists[list_number].pop(position)
+        if moved_id is not None:
+            self._positions[moved_id] = (list_number, position)
+        return True
+
+    def search(self, query: np.ndarray, k: int = 3) -> list[tuple[str, float]]:
+        """Returns up to k (id, cosine similarity) pairs, most similar first."""
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        if self.is_trained:
+            centroid_scores = self.centroids @ query
+            nprobe = min(self.nprobe, self.nlist)
+            probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            probed = [0]
+
+        all_scores, all_ids = [], []
+        for list_number in probed:
+            inverted_list = self._lists[list_number]
+            if len(inverted_list):
+                all_scores.append(inverted_list.active_vectors() @ query)
+                all_ids.extend(inverted_list.ids)
+        if not all_ids:
+            return []
+
+        scores = np.concatenate(all_scores)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(all_ids[i], float(scores[i])) for i in top]
+
+    def search_many(self, queries: np.ndarray, k: int = 3) -> list[list[tuple[str, float]]]:
+        """
+        Same as `search` for each row of `queries`, but scores every query with one matrix product over the union of the
+        lists they probe, rather than one matrix-vector product per query and list.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self.is_trained:
+            nprobe = min(self.nprobe, self.nlist)
+            probed = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probed = np.zeros((len(queries), 1), dtype=np.int64)
+
+        list_numbers = [list_number for list_number in np.unique(probed) if len(self._lists[list_number])]
+        if not list_numbers:
+            return [[] for _ in queries]
+        vectors = np.concatenate([self._lists[list_number].active_vectors() for list_number in list_numbers])
+        ids = [entry_id for list_number in list_numbers for entry_id in self._lists[list_number].ids]
+        vector_lists = np.repeat(list_numbers, [len(self._lists[list_number]) for list_number in list_numbers])
+
+        scores = queries @ vectors.T
+        # Only keep the vectors of the lists each query probes, as `search` would
+        probes = np.zeros((len(queries), len(self._lists)), dtype=bool)
+        probes[np.arange(len(queries))[:, np.newaxis], probed] = True
+        scores[~probes[:, vector_lists]] = -np.inf
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(scores, top):
+            candidates = candidates[np.argsort(-row[candidates])]
+            results.append([(ids[i], float(row[i])) for i in candidates if row[i] != -np.inf])
+        return results
+
+    def sample(self, size: int, seed: int = 0) -> np.ndarray:
+        """Returns up to `size` randomly chosen vectors, used to train the centroids."""
+        vectors = np.concatenate([inverted_list.active_vectors() for inverted_list in self._lists])
+        if len(vectors) > size:
+            vectors = vectors[np.random.default_rng(seed).choice(len(vectors), size, replace=False)]
+        return vectors
+
+    def set_centroids(self, centroids: np.ndarray) -> None:
+        """Switches the index to the given centroids and moves every stored vector into the list of its closest centroid."""
+        ids = [entry_id for inverted_list in self._lists for entry_id in inverted_list.ids]
+        vectors = np.concatenate([inverted_list.active_vectors() for inverted_list in self._lists])
+
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.nlist = len(self.centroids)
+        self._lists = [_InvertedList(self.dim) for _ in range(self.nlist)]
+        self._positions = {}
+        assignments = self._assign(vectors) if len(vectors) else []
+        for entry_id, vector, list_number in zip(ids, vectors, assignments):
+            position = self._lists[list_number].append(entry_id, vector)
+            self._positions[entry_id] = (list_number, position)
+
+    def _assign(self, vectors: np.ndarray, chunk_size: int = 8192) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            assignments[start:start + chunk_size] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Runs spherical k-means and returns `nlist` unit-normalized centroids.
+    This is CPU heavy, so callers on the event loop should run it in a thread.
+    """
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        # Sum the vectors of each cluster by sorting them by cluster and reducing each contiguous run
+        counts = np.bincount(assignments, minlength=nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(vectors[np.argsort(assignments, kind="stable")], starts[counts > 0])
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # Re-seed empty clusters with random vectors so that every list ends up being used
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms[empty] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
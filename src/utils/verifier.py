@@ -0,0 +1,114 @@
+"""
+Optionally verifies the hits of the semantic (vector embedding) cache with a cross-encoder, before they are served.
+
+A cosine similarity threshold on its own either lets false hits through ("meaning of life" vs "meaning of death") or misses
+paraphrases, since embeddings are computed for each query separately. A cross-encoder reads both queries together and is
+much better at telling whether they ask the same thing, but is too slow to compare a query against the whole cache. So the
+ANN index proposes the top VERIFIER_TOP_K candidates above a loose similarity (VERIFIER_MIN_SIMILARITY), the cross-encoder
+scores each (query, cached query) pair, and the best candidate is a hit if its score is at least VERIFIER_THRESHOLD.
+
+Pairs from concurrent requests are micro-batched into one model call (see `micro_batcher.py`). Verification has a strict
+latency budget (VERIFIER_TIMEOUT_MS): if the scores aren't ready in time, the lookup is a miss and the query goes to the LLM.
+
+The model is only loaded the first time it's needed. The threshold depends on the model; `evaluate_caching_strategies.py
+--verifier-thresholds ...` reports the hit accuracy and lookup latency of several thresholds, to pick one.
+
+Configuration (all optional):
+* VERIFIER: set to "TRUE" to enable verification
+* VERIFIER_MODEL: a sentence-transformers CrossEncoder, defaults to cross-encoder/quora-distilroberta-base (trained on
+  duplicate questions; scores are probabilities)
+* VERIFIER_THRESHOLD: minimum score for a hit, defaults to 0.5
+* VERIFIER_TIMEOUT_MS: defaults to 50
+* VERIFIER_TOP_K: candidates scored per query, defaults to 5
+* VERIFIER_MIN_SIMILARITY: minimum cosine similarity for a candidate to be scored, defaults to 0.5
+* VERIFIER_BATCH_SIZE / VERIFIER_BATCH_WAIT_MS: micro-batching of the pairs, default to 64 and 2
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from src.utils.micro_batcher import MicroBatcher
+
+DEFAULT_VERIFIER_MODEL = "cross-encoder/quora-distilroberta-base"
+
+_cross_encoder = None
+_batcher: MicroBatcher[tuple[str, str], float] | None = None
+_counts = {"accepted": 0, "rejected": 0, "timeouts": 0}
+
+def is_enabled() -> bool:
+    return os.getenv("VERIFIER") == "TRUE"
+
+def get_cross_encoder():
+    """Returns the cross-encoder, loading it on first use."""
+    global _cross_encoder
+    if _cross_encoder is None:
+        from sentence_transformers import CrossEncoder
+        _cross_encoder = CrossEncoder(os.getenv("VERIFIER_MODEL", DEFAULT_VERIFIER_MODEL), device="cpu")
+    return _cross_encoder
+
+def set_cross_encoder(cross_encoder) -> None:
+    """
+    Replaces the cross-encoder. Anything with a sentence-transformers style `predict(list[tuple[str, str]]) -> array`
+    method works, which lets tests use a stub instead of downloading a model.
+    """
+    global _cross_encoder
+    _cross_encoder = cross_encoder
+
+def score_batch(pairs: list[tuple[str, str]]) -> np.ndarray:
+    """Scores several (query, cached query) pairs in one model call."""
+    return np.asarray(get_cross_encoder().predict(pairs), dtype=np.float32).reshape(len(pairs))
+
+def get_batcher() -> MicroBatcher[tuple[str, str], float]:
+    global _batcher
+    if _batcher is None:
+        _batcher = MicroBatcher(
+            score_batch,
+            max_batch_size=int(os.getenv("VERIFIER_BATCH_SIZE", "64")),
+            max_wait_ms=float(os.getenv("VERIFIER_BATCH_WAIT_MS", "2")),
+            executor=ThreadPoolExecutor(max_workers=1, thread_name_prefix="verifier"),
+        )
+    return _batcher
+
+def candidate_settings() -> tuple[int, float]:
+    """How many ANN candidates to verify per query, and the minimum cosine similarity to be one."""
+    return int(os.getenv("VERIFIER_TOP_K", "5")), float(os.getenv("VERIFIER_MIN_SIMILARITY", "0.5"))
+
+async def best_match(query: str, cached_queries: list[str]) -> int | None:
+    """
+    Returns the position of the cached query that best matches `query`, if it scores at least VERIFIER_THRESHOLD.
+    Returns None if none does, or if the scores weren't ready within VERIFIER_TIMEOUT_MS.
+    """
+    return (await best_matches([(query, cached_queries)]))[0]
+
+async def best_matches(lookups: list[tuple[str, list[str]]]) -> list[int | None]:
+    """Same as `best_match` for several (query, cached queries) lookups, whose pairs are submitted together."""
+    pairs = [(query, cached_query) for query, cached_queries in lookups for cached_query in cached_queries]
+    if not pairs:
+        return [None] * len(lookups)
+    try:
+        scores = await asyncio.wait_for(
+            get_batcher().submit_many(pairs), timeout=float(os.getenv("VERIFIER_TIMEOUT_MS", "50")) / 1000,
+        )
+    except asyncio.TimeoutError:
+        _counts["timeouts"] += sum(1 for _, cached_queries in lookups if cached_queries)
+        return [None] * len(lookups)
+
+    threshold = float(os.getenv("VERIFIER_THRESHOLD", "0.5"))
+    results, offset = [], 0
+    for _, cached_queries in lookups:
+        lookup_scores = scores[offset:offset + len(cached_queries)]
+        offset += len(cached_queries)
+        if not cached_queries:
+            results.append(None)
+            continue
+        best = int(np.argmax(lookup_scores))
+        if lookup_scores[best] < threshold:
+            _counts["rejected"] += 1
+            results.append(None)
+        else:
+            _counts["accepted"] += 1
+            results.append(best)
+    return results
+
+def stats() -> dict:
+    return {**_counts, "batcher": get_batcher().stats()}
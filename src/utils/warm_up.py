@@ -0,0 +1,123 @@
+"""
+Warms up a worker off the request path.
+
+Importing the server only loads what every strategy needs. What the caching strategy (CACHING_STRATEGY) needs on top of that
+is loaded by the first request that uses it: the local indexes of the fuzzy and vector caches, the embedding model, the
+verifier's cross-encoder and the OpenAI client. That would make the first requests of every worker slow, so at startup the
+same components are loaded in the background instead, concurrently, while the worker already accepts requests.
+
+`GET /ready` reports whether the warm-up is done (and how long each component took), for load balancers and orchestrators
+to only send traffic to warm workers. A component that fails to load (eg: redis is unreachable) keeps the worker unready,
+with its error reported, and is retried with exponential backoff until it loads: the worker becomes ready once the
+outage is over, without being restarted.
+
+Configuration (all optional):
+* WARM_UP: set to "FALSE" to skip the warm-up, so that components are only loaded on first use
+* WARM_UP_RETRY_DELAY: seconds before the first retry of a component that failed to load, defaults to 1
+* WARM_UP_MAX_RETRY_DELAY: seconds, the retry delay doubles up to this, defaults to 60
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+from src.utils.redis_client import redis_client
+from src.utils.query_cache import strategy_stores
+from src.utils.vector_cache import vector_cache
+from src.utils.fuzzy_cache import fuzzy_cache
+from src.utils.get_embeddings import embed_batch
+from src.utils.query_llm import get_client
+from src.utils import verifier
+
+WARM_UP_TEXT = "How do I warm up a cache?"
+
+async def load_embedding_model() -> None:
+    # Embedding a text also runs the model once, which is slower the first time
+    await asyncio.to_thread(embed_batch, [WARM_UP_TEXT])
+
+async def load_verifier_model() -> None:
+    await asyncio.to_thread(verifier.score_batch, [(WARM_UP_TEXT, WARM_UP_TEXT)])
+
+async def load_llm_client() -> None:
+    await asyncio.to_thread(get_client)
+
+def components(strategy: str | None) -> dict[str, Callable[[], Awaitable[None]]]:
+    """What the caching strategy loads on first use, by name."""
+    stores = strategy_stores(strategy)
+    loaders: dict[str, Callable[[], Awaitable[None]]] = {"llm_client": load_llm_client}
+    if stores:
+        loaders["redis"] = redis_client.ping
+    if "fuzzy" in stores:
+        loaders["fuzzy_index"] = fuzzy_cache.ensure_loaded
+    if "vector" in stores:
+        loaders["vector_index"] = vector_cache.ensure_loaded
+        loaders["embedding_model"] = load_embedding_model
+        if verifier.is_enabled():
+            loaders["verifier_model"] = load_verifier_model
+    return loaders
+
+class WarmUp:
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.attempts: dict[str, int] = {}
+        self.pending: set[str] = set()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Starts loading the components of the caching strategy in the background."""
+        self.durations, self.errors, self.attempts = {}, {}, {}
+        if os.getenv("WARM_UP") == "FALSE":
+            self.pending = set()
+            return
+        loaders = components(os.getenv("CACHING_STRATEGY"))
+        self.pending = set(loaders)
+        self._task = asyncio.create_task(self._run(loaders))
+
+    @property
+    def ready(self) -> bool:
+        return not self.pending and not self.errors
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pending": sorted(self.pending),
+            "durations": dict(self.durations),
+            "errors": dict(self.errors),
+            "attempts": dict(self.attempts),
+        }
+
+    async def wait(self) -> None:
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, loaders: dict[str, Callable[[], Awaitable[None]]]) -> None:
+        await asyncio.gather(*(self._load(name, load) for name, load in loaders.items()))
+
+    async def _load(self, name: str, load: Callable[[], Awaitable[None]]) -> None:
+        """Loads a component, retrying with exponential backoff until it succeeds (or the warm-up is stopped)."""
+        delay = float(os.getenv("WARM_UP_RETRY_DELAY", "1"))
+        max_delay = float(os.getenv("WARM_UP_MAX_RETRY_DELAY", "60"))
+        while True:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            start = time.perf_counter()
+            try:
+                await load()
+                self.durations[name] = time.perf_counter() - start
+                self.errors.pop(name, None)
+                self.pending.discard(name)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error while warming up {name}, retrying in {delay:g}s: {e}")
+                self.errors[name] = str(e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+warm_up = WarmUp()
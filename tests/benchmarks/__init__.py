@@ -0,0 +1,3 @@
+"""
+This file makes the benchmarks directory a Python package.
+""" 
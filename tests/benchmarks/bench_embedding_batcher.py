@@ -0,0 +1,70 @@
+"""
+Compares embedding throughput when every request is encoded on its own vs when concurrent requests are micro-batched.
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_embedding_batcher
+
+By default the real sentence-transformers model (EMBEDDING_MODEL) is used. Pass --stub to use a stand-in that sleeps
+like a model would (a fixed cost per encode call plus a smaller cost per text), so the script runs without downloading a model.
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from src.utils import get_embeddings
+from src.utils.micro_batcher import MicroBatcher
+
+CONCURRENCY_LEVELS = [1, 10, 100]
+
+class SleepingEmbedder:
+    def __init__(self, call_overhead_ms: float, per_text_ms: float, dim: int = 768):
+        self.call_overhead = call_overhead_ms / 1000
+        self.per_text = per_text_ms / 1000
+        self.dim = dim
+
+    def encode(self, texts: list[str], **kwargs) -> np.ndarray:
+        time.sleep(self.call_overhead + self.per_text * len(texts))
+        return np.ones((len(texts), self.dim), dtype=np.float32)
+
+async def run_clients(embed, clients: int, requests_per_client: int) -> float:
+    """Runs `clients` concurrent clients that each embed `requests_per_client` texts one after the other. Returns texts/sec."""
+    async def client(client_id: int):
+        for i in range(requests_per_client):
+            await embed(f"query {i} from client {client_id}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(clients)))
+    return clients * requests_per_client / (time.perf_counter() - start)
+
+async def main(args):
+    if args.stub:
+        get_embeddings.set_embedder(SleepingEmbedder(args.stub_call_overhead_ms, args.stub_per_text_ms))
+    get_embeddings.embed_batch(["warm up"]) # loads the model outside of the timed runs
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+
+    async def embed_per_request(text: str) -> np.ndarray:
+        return (await loop.run_in_executor(executor, get_embeddings.embed_batch, [text]))[0]
+
+    print(f"{'clients':>8} {'per-request (texts/s)':>22} {'batched (texts/s)':>18} {'mean batch':>11} {'p95 wait (ms)':>14}")
+    for clients in CONCURRENCY_LEVELS:
+        batcher = MicroBatcher(get_embeddings.embed_batch, args.batch_size, args.wait_ms, executor)
+        per_request = await run_clients(embed_per_request, clients, args.requests_per_client)
+        batched = await run_clients(batcher.submit, clients, args.requests_per_client)
+        stats = batcher.stats()
+        print(
+            f"{clients:>8} {per_request:>22.1f} {batched:>18.1f} {stats['batch_size']['mean']:>11.1f} "
+            f"{stats['queue_wait']['p95'] * 1000:>14.1f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests-per-client", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--wait-ms", type=float, default=2.0)
+    parser.add_argument("--stub", action="store_true")
+    parser.add_argument("--stub-call-overhead-ms", type=float, default=5.0)
+    parser.add_argument("--stub-per-text-ms", type=float, default=0.5)
+    asyncio.run(main(parser.parse_args()))
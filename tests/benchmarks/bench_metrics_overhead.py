@@ -0,0 +1,68 @@
+"""
+Measures what the Prometheus instrumentation (see `src/utils/metrics.py`) adds to every request.
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_metrics_overhead
+
+First, the metric calls a cache hit makes (timing its lookup, counting it and estimating what it saved) are timed on their
+own. Then `handle_query` is timed on a cache hit that costs nothing (the cache lookup is replaced by a dictionary lookup),
+with and without the instrumentation, so the difference is all of the instrumentation's overhead on the request path.
+"""
+import argparse
+import asyncio
+import time
+from src import server
+from src.utils import metrics
+from src.utils.query_cache import CacheHit
+
+QUERY = "How much does instrumenting a request cost?"
+RESPONSE = "A few microseconds: a histogram observation and two dictionary updates."
+
+class NoMetrics:
+    """The metrics module with every call a no-op."""
+    @staticmethod
+    def observe(stage: str, seconds: float) -> None:
+        pass
+
+    @staticmethod
+    def record_request(query: str, response: str, source: str) -> None:
+        pass
+
+def measure_calls(rounds: int) -> float:
+    """Returns the mean time of the metric calls of a cache hit, in microseconds."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with metrics.timed("cache_lookup"):
+            pass
+        metrics.record_request(QUERY, RESPONSE, "cache_l2")
+    return (time.perf_counter() - start) / rounds * 1e6
+
+async def measure_requests(rounds: int) -> float:
+    """Returns the mean time of `handle_query` on a cache hit, in microseconds."""
+    request = server.QueryRequest(query=QUERY)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await server.handle_query(request)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def main(args):
+    async def cache_hit(query: str, timing: dict | None = None) -> CacheHit:
+        return CacheHit(RESPONSE, "cache_l2")
+    server.query_cache = cache_hit
+
+    calls = measure_calls(args.rounds)
+    with_metrics = asyncio.run(measure_requests(args.rounds))
+    server.metrics = NoMetrics
+    without_metrics = asyncio.run(measure_requests(args.rounds))
+    server.metrics = metrics
+
+    print(f"metric calls of a cache hit: {calls:.2f} us")
+    print(f"{'':>16} {'us/request':>11}")
+    print(f"{'with metrics':>16} {with_metrics:>11.2f}")
+    print(f"{'without metrics':>16} {without_metrics:>11.2f}")
+    print(f"overhead: {with_metrics - without_metrics:.2f} us/request ({(with_metrics - without_metrics) / without_metrics:.1%})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=50_000)
+    main(parser.parse_args())
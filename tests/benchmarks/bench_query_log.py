@@ -0,0 +1,84 @@
+"""
+Measures how long logging an LLM call holds up the event loop, before and after the query log (see `src/utils/query_log.py`).
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_query_log
+
+The old way is timed as `query_llm` did it: three `logging.info` calls through a `FileHandler`, one of them with the repr of
+the whole OpenAI response, formatted and written on the calling thread. The new way is the `record_llm_call` and
+`record_request` calls of a miss, which only queue their records; the background thread's time to write them (until `close`
+returns) is reported separately, since it doesn't block the caller.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from src.utils.query_log import QueryLogger
+
+QUERY = "What are the main differences between the Responses API and the Chat Completions API?"
+OUTPUT_TEXT = "The Responses API is stateful and has built-in tools, while Chat Completions is stateless. " * 8
+
+def fake_response_repr() -> str:
+    """About the size of the repr of an OpenAI Response object of a short answer."""
+    return (
+        "Response(id='resp_0123456789abcdef', created_at=1760000000.0, error=None, incomplete_details=None, "
+        "instructions='You are a helpful assistant.', metadata={}, model='gpt-4o-2024-08-06', object='response', "
+        f"output=[ResponseOutputMessage(id='msg_0123456789abcdef', content=[ResponseOutputText(annotations=[], text={OUTPUT_TEXT!r}, "
+        "type='output_text', logprobs=[])], role='assistant', status='completed', type='message')], parallel_tool_calls=True, "
+        "temperature=1.0, tool_choice='auto', tools=[], top_p=1.0, max_output_tokens=None, previous_response_id=None, "
+        "reasoning=Reasoning(effort=None, summary=None), status='completed', text=ResponseTextConfig(format=ResponseFormatText(type='text')), "
+        "truncation='disabled', usage=ResponseUsage(input_tokens=36, input_tokens_details=InputTokensDetails(cached_tokens=0), "
+        "output_tokens=180, output_tokens_details=OutputTokensDetails(reasoning_tokens=0), total_tokens=216), user=None, store=True)"
+    )
+
+class FakeResponse:
+    def __repr__(self) -> str:
+        return fake_response_repr()
+
+def measure_file_handler(directory: str, rounds: int) -> float:
+    """Returns the mean time of logging a call the old way, in microseconds."""
+    logger = logging.getLogger("bench_query_log")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(directory, "llm_queries.txt"))
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    logger.addHandler(handler)
+    response = FakeResponse()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        logger.info(f"Query: {QUERY}")
+        logger.info(f"Response: {response}")
+        logger.info("="*50)
+    elapsed = time.perf_counter() - start
+    logger.removeHandler(handler)
+    handler.close()
+    return elapsed / rounds * 1e6
+
+def measure_query_log(directory: str, rounds: int) -> tuple[float, float]:
+    """Returns the mean time of logging a miss with the query log on the caller's thread, and overall, in microseconds."""
+    logger = QueryLogger(os.path.join(directory, "llm_queries.jsonl"), max_queue_size=rounds * 2)
+    start = time.perf_counter()
+    for i in range(rounds):
+        query = f"{QUERY} {i}"
+        logger.record_llm_call(query, "gpt-4o-2024-08-06", 0.8, input_tokens=36, output_tokens=180)
+        logger.record_request(query, "llm", 0.81)
+    caller = time.perf_counter() - start
+    logger.close(timeout=60)
+    total = time.perf_counter() - start
+    assert logger.stats()["dropped"] == 0
+    return caller / rounds * 1e6, total / rounds * 1e6
+
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        file_handler = measure_file_handler(directory, args.rounds)
+        caller, total = measure_query_log(directory, args.rounds)
+    print(f"{'':>28} {'us/miss':>9}")
+    print(f"{'FileHandler (caller)':>28} {file_handler:>9.2f}")
+    print(f"{'query log (caller)':>28} {caller:>9.2f}")
+    print(f"{'query log (incl. writer)':>28} {total:>9.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20_000)
+    main(parser.parse_args())
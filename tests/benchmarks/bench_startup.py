@@ -0,0 +1,86 @@
+"""
+Measures how long a worker takes to start serving: importing the server, running its startup, warming up (see
+`src/utils/warm_up.py`) and answering its first request, a cache hit. Each strategy is measured in a fresh interpreter, so
+that nothing is already imported or loaded.
+
+Run the script with (redis must be running, eg: `docker compose up -d redis`):
+    REDIS_HOST=localhost python3 -m tests.benchmarks.bench_startup [--strategies exact_match_only vector_embedding]
+
+The benchmark query is first cached in every store. Pass --no-warm-up to measure workers that load everything on first use
+(WARM_UP=FALSE) instead, whose first request then pays for it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+QUERY = "How long does a worker take to start serving requests?"
+RESPONSE = "About as long as it takes to import the server and load what its caching strategy needs."
+
+async def seed() -> None:
+    """Caches the benchmark query in the exact, fuzzy and vector stores, so that every strategy's first request is a hit."""
+    from src.scripts.bulk_load import write_chunk
+    from src.utils.cache_response import calculate_TTL
+    from src.utils.get_embeddings import embed_batch
+    from src.utils.redis_client import close_redis_client
+    await write_chunk([(QUERY, RESPONSE, calculate_TTL(QUERY))], embed_batch([QUERY]), {"exact", "fuzzy", "vector"})
+    await close_redis_client()
+
+def measure_worker() -> None:
+    """Runs in the fresh interpreter: starts the server in-process and prints its timings as JSON."""
+    start = time.perf_counter()
+    from src import server
+    import httpx
+    imported = time.perf_counter()
+
+    async def serve() -> dict:
+        async with server.lifespan(server.app):
+            started = time.perf_counter()
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://worker") as client:
+                while (status := (await client.get("/ready")).json())["pending"]:
+                    await asyncio.sleep(0.005)
+                ready = time.perf_counter()
+                response = (await client.post("/api/query", json={"query": QUERY})).json()
+                served = time.perf_counter()
+        return {
+            "import": imported - start,
+            "startup": started - imported,
+            "warm_up": ready - started,
+            "first_request": served - ready,
+            "served_at": time.time(),
+            "source": response["metadata"]["source"],
+            "errors": status["errors"],
+        }
+    print(json.dumps(asyncio.run(serve())))
+
+def main(args) -> None:
+    asyncio.run(seed())
+    print(f"{'strategy':<18} {'import':>8} {'startup':>8} {'warm-up':>8} {'1st req':>8} {'total':>8}  source")
+    for strategy in args.strategies:
+        env = {**os.environ, "CACHING_STRATEGY": strategy, "WARM_UP": "FALSE" if args.no_warm_up else "TRUE"}
+        spawned = time.time()
+        result = subprocess.run(
+            [sys.executable, "-m", "tests.benchmarks.bench_startup", "--worker"], env=env, capture_output=True, text=True, check=True,
+        )
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        total = timings["served_at"] - spawned # including the interpreter's own startup
+        print(
+            f"{strategy:<18} {timings['import']:>7.2f}s {timings['startup']:>7.2f}s {timings['warm_up']:>7.2f}s "
+            f"{timings['first_request']:>7.2f}s {total:>7.2f}s  {timings['source']}"
+        )
+        if timings["errors"]:
+            print(f"  warm-up errors: {timings['errors']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategies", nargs="+", default=["exact_match_only", "fuzzy", "vector_embedding", "hybrid"])
+    parser.add_argument("--no-warm-up", action="store_true", help="Load components on first use instead of warming them up")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        measure_worker()
+    else:
+        main(args)
@@ -0,0 +1,76 @@
+"""
+Measures how long the offline replay (see `src/evaluations/replay_trace.py`) takes on a large synthetic trace.
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_trace_replay [--requests 1000000] [--distinct-queries 50000] [--workers 4]
+
+The trace is made of groups of paraphrases (random words, some of them misspelled or swapped between the paraphrases of a
+group) with Zipf-distributed popularity. Instead of running an embedding model, each group gets a random direction and its
+paraphrases noisy copies of it, so that paraphrases are about 0.9 similar and other queries about 0. The time to prepare
+the trace (distinct queries, TTLs, trigram and embedding neighbours) and to replay a sweep of hybrid configurations (three
+similarity thresholds, two TTLs and two cache sizes) are reported separately.
+"""
+import argparse
+import time
+import numpy as np
+from src.evaluations.replay_trace import Trace, prepare, sweep, sweep_configs
+
+WORDS = 5000
+DIMENSIONS = 384
+
+def synthetic_trace(requests: int, distinct_queries: int, paraphrases: int = 4, seed: int = 0) -> tuple[Trace, np.ndarray]:
+    """Returns the trace and the embeddings of its distinct queries, in order of first appearance."""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocabulary = ["".join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(WORDS)]
+    groups = distinct_queries // paraphrases
+    queries, query_groups, seen = [], [], set()
+    for group in range(groups):
+        words = [vocabulary[i] for i in rng.integers(0, WORDS, size=rng.integers(4, 9))]
+        for _ in range(paraphrases):
+            variant = list(words)
+            position = rng.integers(0, len(variant))
+            variant[position] = vocabulary[rng.integers(0, WORDS)] if rng.random() < 0.5 else variant[position][:-1]
+            query = " ".join(variant)
+            if query not in seen: # every query is distinct, so that its embedding is the one `prepare` gives it
+                seen.add(query)
+                queries.append(query)
+                query_groups.append(group)
+
+    directions = rng.standard_normal((groups, DIMENSIONS)).astype(np.float32)
+    embeddings = directions[query_groups] + 0.35 * rng.standard_normal((len(queries), DIMENSIONS)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    popularity = 1 / np.arange(1, len(queries) + 1) ** 0.9
+    picks = rng.choice(len(queries), size=requests, p=popularity / popularity.sum())
+    trace = Trace(
+        queries=[queries[i] for i in picks],
+        timestamps=np.arange(requests) / 100.0, # 100 requests per second
+        groups=[query_groups[i] for i in picks],
+    )
+    # The embeddings of the distinct queries, in the order `prepare` numbers them
+    _, first = np.unique(picks, return_index=True)
+    order = picks[np.sort(first)]
+    return trace, embeddings[order]
+
+def main(args):
+    start = time.perf_counter()
+    trace, embeddings = synthetic_trace(args.requests, args.distinct_queries)
+    generated = time.perf_counter()
+    model = prepare(trace, ["hybrid"], min_similarity=0.8, min_fuzzy_similarity=0.7, embeddings=embeddings, workers=args.workers)
+    prepared = time.perf_counter()
+    configs = sweep_configs(["hybrid"], [0.8, 0.85, 0.9], [0.8], [None, 3600], [0, args.distinct_queries // 10])
+    results = sweep(model, configs, args.workers)
+    replayed = time.perf_counter()
+
+    print(f"{args.requests} requests, {len(model.miss_costs)} distinct queries (generated in {generated - start:.1f}s)")
+    print(f"prepared in {prepared - generated:.1f}s, replayed {len(configs)} configurations in {replayed - prepared:.1f}s "
+          f"({(replayed - prepared) / len(configs):.1f}s each with {args.workers or 'one per CPU'} workers)")
+    print(results[["similarity_threshold", "ttl", "cache_size", "hit_rate", "false_hit_rate", "cost"]].to_string(index=False))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1_000_000)
+    parser.add_argument("--distinct-queries", type=int, default=50_000)
+    parser.add_argument("--workers", type=int)
+    main(parser.parse_args())
@@ -0,0 +1,52 @@
+"""
+Measures how fast `calculate_TTL` classifies queries, which it does for every cache write.
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_ttl_classifier
+
+The queries are the past and test queries of the evaluation dataset. For comparison, the same patterns are also run
+without precompiling them (compiling on every call, bypassing the `re` module's cache), which is what the policy avoids.
+"""
+import argparse
+import re
+import time
+from collections import Counter
+import pandas as pd
+from src.utils.ttl_policy import KeywordTTLPolicy, DEFAULT_CATEGORIES
+
+def load_queries() -> list[str]:
+    past = pd.read_csv("src/evaluations/past_queries.csv")["QueryText"]
+    test = pd.read_csv("src/evaluations/test_queries.csv")["QueryText"]
+    return [query for query in pd.concat([past, test]).tolist() if isinstance(query, str)]
+
+def classify_uncompiled(query: str) -> str | None:
+    for name, _, patterns in sorted(DEFAULT_CATEGORIES, key=lambda category: category[1]):
+        re.purge()
+        if re.search("|".join(f"(?:{pattern})" for pattern in patterns), query.lower()):
+            return name
+    return None
+
+def measure(classify, queries: list[str], rounds: int) -> float:
+    """Returns the mean time per classification, in microseconds."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            classify(query)
+    return (time.perf_counter() - start) / (rounds * len(queries)) * 1e6
+
+def main(args):
+    queries = load_queries()
+    policy = KeywordTTLPolicy(DEFAULT_CATEGORIES)
+    categories = Counter(category.name if category else "evergreen" for category in map(policy.classify, queries))
+    print(f"{len(queries)} queries: " + ", ".join(f"{name} {count}" for name, count in categories.most_common()))
+
+    precompiled = measure(policy.classify, queries, args.rounds)
+    uncompiled = measure(classify_uncompiled, queries, max(1, args.rounds // 100))
+    print(f"{'':>12} {'us/query':>9} {'queries/s':>11}")
+    print(f"{'precompiled':>12} {precompiled:>9.2f} {1e6 / precompiled:>11.0f}")
+    print(f"{'uncompiled':>12} {uncompiled:>9.2f} {1e6 / uncompiled:>11.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=1000)
+    main(parser.parse_args())
@@ -0,0 +1,68 @@
+"""
+Benchmarks lookups in the local ANN index used by the vector_embedding caching strategy.
+
+Run the script with:
+    python3 -m tests.benchmarks.bench_vector_index --entries 1000000 --dim 384 --nlist 4096 --nprobe 8
+
+Random clustered vectors stand in for real query embeddings, so no embedding model or redis instance is needed.
+Recall is measured against an exact (brute force) search over the same vectors.
+"""
+import argparse
+import statistics
+import time
+import numpy as np
+from src.utils.vector_index import VectorIndex, train_centroids
+
+def make_vectors(count: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """Generates unit vectors scattered around `clusters` random topics, which is closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    chunk_size = 100_000
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        chunk = centres[rng.integers(0, clusters, size)] + rng.standard_normal((size, dim)).astype(np.float32) * 0.6
+        vectors[start:start + size] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+    return vectors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.entries, args.dim, clusters=args.nlist)
+    index = VectorIndex(dim=args.dim, nlist=args.nlist, nprobe=args.nprobe)
+
+    build_start = time.perf_counter()
+    sample = vectors[np.random.default_rng(1).choice(len(vectors), min(len(vectors), index.train_size), replace=False)]
+    index.set_centroids(train_centroids(sample, args.nlist))
+    for i, vector in enumerate(vectors):
+        index.add(str(i), vector)
+    print(f"Built index over {len(index)} vectors in {time.perf_counter() - build_start:.1f} seconds")
+
+    # Queries are noisy copies of stored vectors, like a reworded version of a cached query
+    rng = np.random.default_rng(2)
+    targets = rng.choice(len(vectors), args.queries, replace=False)
+    queries = vectors[targets] + rng.standard_normal((args.queries, args.dim)).astype(np.float32) * 0.02
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    latencies = []
+    hits = 0
+    for query, target in zip(queries, targets):
+        start = time.perf_counter()
+        results = index.search(query, k=3)
+        latencies.append(time.perf_counter() - start)
+        exact = int(np.argmax(vectors @ query))
+        hits += results[0][0] == str(exact)
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    print(f"Median lookup latency: {statistics.median(latencies_ms):.3f} ms")
+    print(f"95th percentile lookup latency: {statistics.quantiles(latencies_ms, n=20)[18]:.3f} ms")
+    print(f"Recall@1 vs exact search: {hits / args.queries:.2%}")
+
+if __name__ == "__main__":
+    main()
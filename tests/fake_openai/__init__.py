@@ -0,0 +1,3 @@
+"""
+This file makes the fake_openai directory a Python package.
+""" 
@@ -0,0 +1,90 @@
+"""
+A local stand-in for the OpenAI Responses API, used to test how the system behaves under throttling without spending money.
+
+It answers `POST /v1/responses` with a canned answer after a configurable latency, and returns 429s (with a Retry-After
+header) once more than FAKE_OPENAI_REQUESTS_PER_MINUTE requests have been made in the current minute.
+(FAKE_OPENAI_WINDOW_SECONDS shortens the window, eg: for tests.)
+
+Run it with:
+    FAKE_OPENAI_REQUESTS_PER_MINUTE=60 FAKE_OPENAI_LATENCY_MS=500 uvicorn tests.fake_openai.server:app --port 8001
+
+and point the caching system at it:
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake ...
+"""
+import asyncio
+import os
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="Fake OpenAI API")
+
+class FixedWindowLimiter:
+    def __init__(self, requests_per_window: int, window_seconds: float = 60):
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.window_start: float | None = None # the first window starts with the first request
+        self.count = 0
+        self.throttled = 0
+
+    def allow(self) -> float | None:
+        """Returns None if the request is allowed, otherwise the number of seconds until the window resets."""
+        now = time.monotonic()
+        if self.window_start is None or now - self.window_start >= self.window_seconds:
+            self.window_start, self.count = now, 0
+        if self.count < self.requests_per_window:
+            self.count += 1
+            return None
+        self.throttled += 1
+        return self.window_seconds - (now - self.window_start)
+
+limiter = FixedWindowLimiter(
+    requests_per_window=int(os.getenv("FAKE_OPENAI_REQUESTS_PER_MINUTE", "60")),
+    window_seconds=float(os.getenv("FAKE_OPENAI_WINDOW_SECONDS", "60")),
+)
+
+def make_response(query: str, model: str) -> dict:
+    answer = f"This is a fake answer to: {query}"
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": model,
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": answer, "annotations": []}],
+        }],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": len(query) // 4,
+            "output_tokens": len(answer) // 4,
+            "total_tokens": len(query) // 4 + len(answer) // 4,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens_details": {"reasoning_tokens": 0},
+        },
+    }
+
+@app.post("/v1/responses")
+async def create_response(request: Request):
+    retry_after = limiter.allow()
+    if retry_after is not None:
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": f"{retry_after:.3f}"},
+            content={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+        )
+
+    body = await request.json()
+    await asyncio.sleep(float(os.getenv("FAKE_OPENAI_LATENCY_MS", "0")) / 1000)
+    return make_response(body["input"], body["model"])
+
+@app.get("/stats")
+def stats():
+    return {"requests_in_window": limiter.count, "throttled": limiter.throttled}
@@ -31,10 +31,26 @@ class LoadTestResults:
     def percentile_95_response_time(self) -> float:
         return statistics.quantiles(self.response_times, n=20)[18]
 
+    @property
+    def cache_hit_response_times(self) -> List[float]:
+        return [q['response_time'] for q in self.query_details if q['source'].startswith('cache')]
+
+    @property
+    def cache_hit_percentile_95_response_time(self) -> float:
+        hit_times = self.cache_hit_response_times
+        if len(hit_times) < 2:
+            return hit_times[0] if hit_times else 0.0
+        return statistics.quantiles(hit_times, n=20)[18]
+
     @property
     def cache_hit_rate(self) -> float:
         return (self.cache_hits / self.total_requests) * 100
 
+    def tier_hit_rate(self, source: str) -> float:
+        """Percentage of all requests that were answered by the given cache tier ("cache_l1" or "cache_l2")."""
+        tier_hits = sum(1 for q in self.query_details if q['source'] == source)
+        return (tier_hits / self.total_requests) * 100
+
     @property
     def max_llm_query_time(self) -> float:
         llm_times = [t['llm_query'] for t in self.timing_details if 'llm_query' in t]
@@ -48,7 +64,8 @@ class LoadTestResults:
         print(f"Average response time: {self.average_response_time:.2f} seconds")
         print(f"Median response time: {self.median_response_time:.2f} seconds")
         print(f"95th percentile response time: {self.percentile_95_response_time:.2f} seconds")
-        print(f"Cache hit rate: {self.cache_hit_rate:.1f}%")
+        print(f"Cache hit rate: {self.cache_hit_rate:.1f}% (L1: {self.tier_hit_rate('cache_l1'):.1f}%, L2: {self.tier_hit_rate('cache_l2'):.1f}%)")
+        print(f"95th percentile cache hit response time: {self.cache_hit_percentile_95_response_time * 1000:.2f} ms")
         
         # Print timing analysis
         if self.timing_details:
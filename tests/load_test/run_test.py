@@ -4,6 +4,13 @@ This script tests the performance of the API under load conditions.
 Run the script with:
     DISABLE_AUTO_CACHE=TRUE python3 -m tests.load_test.run_test
 
+To check how latency scales with concurrency, pass several concurrency levels. Each level is run as a separate
+load test and a summary table (including the cache hit p95, which should stay flat as concurrency grows) is printed:
+    DISABLE_AUTO_CACHE=TRUE python3 -m tests.load_test.run_test --concurrency 10 50 100 200 400
+
+To replay the queries of a production query log (see src/utils/query_log.py) instead of queries.csv:
+    DISABLE_AUTO_CACHE=TRUE python3 -m tests.load_test.run_test --replay logs/llm_queries.jsonl
+
 # Notes:
 DISABLE_AUTO_CACHE must be set to "TRUE" to prevent affecting the actual cache
 
@@ -15,29 +22,34 @@ For example:
     docker exec llm-response-caching-system-redis-1 redis-cli FLUSHALL
 """
 
+import argparse
 import asyncio
 import aiohttp
 import time
 import os
-from typing import Dict
+from typing import Dict, List
 
 from .models import LoadTestResults
 from .api_client import send_query
-from .utils import load_queries_from_csv
+from .utils import load_queries_from_csv, load_queries_from_log
 
-async def run_load_test(num_requests: int = 100) -> LoadTestResults:
-    """Run a load test with the specified number of concurrent requests."""
-    # Read queries from CSV file
-    queries = load_queries_from_csv('tests/load_test/queries.csv', num_requests)
+async def run_load_test(num_requests: int = 100, replay: str | None = None) -> LoadTestResults:
+    """Run a load test with the specified number of concurrent requests, replaying the queries of a query log if given."""
+    # Read queries from the query log or the CSV file
+    if replay:
+        queries = load_queries_from_log(replay, num_requests)
+    else:
+        queries = load_queries_from_csv('tests/load_test/queries.csv', num_requests)
     
     test_start_time = time.time()
-    async with aiohttp.ClientSession() as session:
+    # limit=0 removes aiohttp's default cap of 100 open connections, so that every request is actually in flight at once
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
         tasks = [send_query(session, query) for query in queries]
         results = await asyncio.gather(*tasks)
     
     total_time = time.time() - test_start_time
     response_times = [r["response_time"] for r in results]
-    cache_hits = sum(1 for r in results if r["source"] == "cache")
+    cache_hits = sum(1 for r in results if r["source"].startswith("cache"))
     timing_details = [r["timing"] for r in results]
     
     return LoadTestResults(
@@ -50,12 +62,40 @@ async def run_load_test(num_requests: int = 100) -> LoadTestResults:
         timing_details=timing_details
     )
 
+async def run_concurrency_sweep(concurrency_levels: List[int], replay: str | None = None) -> Dict[int, LoadTestResults]:
+    """Run one load test per concurrency level, one after the other."""
+    sweep_results = {}
+    for num_requests in concurrency_levels:
+        sweep_results[num_requests] = await run_load_test(num_requests, replay)
+    return sweep_results
+
+def print_sweep_summary(sweep_results: Dict[int, LoadTestResults]) -> None:
+    print("\nConcurrency Sweep Summary:")
+    print(f"{'concurrency':>12} {'req/s':>10} {'p95 (s)':>10} {'hit rate':>10} {'L1 hits':>8} {'L2 hits':>8} {'hit p95 (ms)':>14}")
+    for num_requests, results in sweep_results.items():
+        print(
+            f"{num_requests:>12} {results.requests_per_second:>10.2f} {results.percentile_95_response_time:>10.2f} "
+            f"{results.cache_hit_rate:>9.1f}% {results.tier_hit_rate('cache_l1'):>7.1f}% {results.tier_hit_rate('cache_l2'):>7.1f}% "
+            f"{results.cache_hit_percentile_95_response_time * 1000:>14.2f}"
+        )
+
 if __name__ == "__main__":
     if os.environ.get("DISABLE_AUTO_CACHE") != "TRUE":
         print("Warning: DISABLE_AUTO_CACHE is not set to TRUE. Please run the script with:")
         print("DISABLE_AUTO_CACHE=TRUE python3 tests/load_test.py")
         exit(1)
     
-    results = asyncio.run(run_load_test())
-    results.print_results()
-    results.save_to_csv()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[100], help="number of concurrent requests; pass several values to run a sweep")
+    parser.add_argument("--replay", help="JSONL query log to take the queries from, instead of queries.csv")
+    args = parser.parse_args()
+
+    if len(args.concurrency) == 1:
+        results = asyncio.run(run_load_test(args.concurrency[0], args.replay))
+        results.print_results()
+        results.save_to_csv()
+    else:
+        sweep_results = asyncio.run(run_concurrency_sweep(args.concurrency, args.replay))
+        for results in sweep_results.values():
+            results.print_results()
+        print_sweep_summary(sweep_results)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import csv
 from typing import List
+from src.utils.query_log import read_query_log
 
 def load_queries_from_csv(file_path: str, num_requests: int) -> List[str]:
     """Load queries from CSV file and repeat them to reach desired number of requests."""
@@ -9,4 +10,9 @@ def load_queries_from_csv(file_path: str, num_requests: int) -> List[str]:
         queries = [row['query'] for row in reader]
     
     # Repeat queries to reach desired number of requests
-    return [queries[i % len(queries)] for i in range(num_requests)] 
\ No newline at end of file
+    return [queries[i % len(queries)] for i in range(num_requests)]
+
+def load_queries_from_log(file_path: str, num_requests: int) -> List[str]:
+    """Load the queries of a query log (see src/utils/query_log.py), in the order they were served, repeated to reach the desired number of requests."""
+    queries = read_query_log(file_path)
+    return [queries[i % len(queries)] for i in range(num_requests)]